@@ -1,89 +1,159 @@
 # -*- coding: utf-8 -*-
-import smtplib
 import unittest
 import shutil
 import datetime
 import os
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST, SERVER_NAME, SENDER_EMAIL, EMAILS
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST, SERVER_NAME, REPLICATION_TARGET
 from mail import Email
-from file_rotation import Database, get_filename_from_datetime
+from file_rotation import Database, iter_databases, get_filename_from_datetime
+from verification import Throttle, verify_database
+from size_history import SizeHistory, analyze
+from render import render_table
+from replication import get_replication_lag
+
+
+SNAPSHOT_JOBS = 4
+
+DatabaseStatus = collections.namedtuple('DatabaseStatus', [
+    'server', 'name', 'last_daily', 'last_weekly', 'last_monthly', 'state', 'integrity', 'size', 'replication',
+])
+
+
+def get_state(last_daily, last_weekly, last_monthly, now=None):
+    """
+    Args:
+        last_daily, last_weekly, last_monthly (datetime.datetime or None)
+    Returns:
+        state (str)
+    """
+    now = now or datetime.datetime.now()
+    if not last_daily:
+        return "Journalière manquante"
+    if now - last_daily > datetime.timedelta(days=0 + 2):
+        return "Journalière : il y a {} jours".format((now - last_daily).days)
+    if not last_weekly:
+        return "Hebdomadaire manquante"
+    if not last_monthly:
+        return "Mensuelle manquante"
+    if now - last_weekly > datetime.timedelta(days=7 + 2):
+        return "Hebdomadaire : il y a {} jours".format((now - last_weekly).days)
+    if now - last_monthly > datetime.timedelta(days=30 + 2):
+        return "Hebdomadaire : il y a {} jours".format((now - last_monthly).days)
+    return "OK"
 
 
 class BCEmail(Email):
     backup_root = BACKUP_ROOT_PROD
     title = "Rapport de sauvegardes"
+    throttle = None
+    replication_target = REPLICATION_TARGET
+
+    def get_database_integrity(self, database):
+        if self.throttle is None:
+            self.throttle = Throttle()
+        errors = verify_database(database, self.throttle)
+        if not errors:
+            return "OK"
+        (tier, dt), error = max(errors.items())
+        return "{} corrompue(s), dont {}/{} : {}".format(len(errors), tier, get_filename_from_datetime(dt), error)
+
+    def get_database_size(self, database):
+        """Only the dumps added since the previous report are appended to the size history"""
+        if not os.path.isdir(database.path):
+            return "Historique insuffisant"
+        anomaly, summary = analyze(SizeHistory(database.path).update(database))
+        return summary
 
     def get_database_state(self, database):
-        now = datetime.datetime.now()
-        if not database.last_daily_datetime:
-            return "Journalière manquante"
-        if now - database.last_daily_datetime > datetime.timedelta(days=0 + 2):
-            return "Journalière : il y a {} jours".format((now - database.last_daily_datetime).days)
-        if not database.last_weekly_datetime:
-            return "Hebdomadaire manquante"
-        if not database.last_monthly_datetime:
-            return "Mensuelle manquante"
-        if now - database.last_weekly_datetime > datetime.timedelta(days=7 + 2):
-            return "Hebdomadaire : il y a {} jours".format((now - database.last_weekly_datetime).days)
-        if now - database.last_monthly_datetime > datetime.timedelta(days=30 + 2):
-            return "Hebdomadaire : il y a {} jours".format((now - database.last_monthly_datetime).days)
-        return "OK"
-
-    def get_database_summary(self, database):
-        """
+        return get_state(database.last_daily_datetime, database.last_weekly_datetime, database.last_monthly_datetime)
+
+    def get_database_replication(self, database):
+        lag = get_replication_lag(database)
+        if lag is None:
+            return "OK"
+        return "En retard : il y a {} jours".format(lag.days)
+
+    def get_database_status(self, database):
+        """Every tier of the database is read once
         Args:
             database (Database)
         Returns:
-            body (str)
-            plain (str)
+            status (DatabaseStatus)
         """
-        items = [
-            database.server,
-            database.name,
-            database.last_daily_datetime or "inexistante",
-            database.last_weekly_datetime or "inexistante",
-            database.last_monthly_datetime or "inexistante",
-            self.get_database_state(database)
-        ]
-        line = "".join(["<td>%s</td>" % str(item) for item in items])
-        body = "<tr>" + line + "</tr>"
-        plain = "| ".join(["{:<30}".format(str(item)) for item in items]) + "\n"
-        return body, plain
-
-    def get_summary(self):
+        last_daily = database.last_daily_datetime
+        last_weekly = database.last_weekly_datetime
+        last_monthly = database.last_monthly_datetime
+        return DatabaseStatus(
+            server=database.server,
+            name=database.name,
+            last_daily=last_daily,
+            last_weekly=last_weekly,
+            last_monthly=last_monthly,
+            state=get_state(last_daily, last_weekly, last_monthly),
+            integrity=self.get_database_integrity(database),
+            size=self.get_database_size(database),
+            replication=self.get_database_replication(database) if self.replication_target else None,
+        )
+
+    def get_statuses(self, jobs=SNAPSHOT_JOBS):
+        """Snapshot of all databases, read with several threads for network mounts. No directory is created.
+        Returns:
+            statuses (list(DatabaseStatus)) sorted by server and database
+        """
+        if self.throttle is None:
+            self.throttle = Throttle()
+        databases = [Database(server, name, self.backup_root, create=False) for server, name in iter_databases(self.backup_root)]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(self.get_database_status, databases))
+
+    def get_database_items(self, status):
+        """
+        Args:
+            status (DatabaseStatus)
+        Returns:
+            items (list)
+        """
+        return [
+            status.server,
+            status.name,
+            status.last_daily or "inexistante",
+            status.last_weekly or "inexistante",
+            status.last_monthly or "inexistante",
+            status.state,
+            status.integrity,
+            status.size,
+        ] + ([status.replication] if self.replication_target else [])
+
+    def get_summary(self, statuses=None):
         """
+        Args:
+            statuses (list(DatabaseStatus)) snapshot to render, taken now if not given
         Returns:
-            body (str)
-            plain (str)
+            section (render.Section)
         """
+        if statuses is None:
+            statuses = self.get_statuses()
         headers = [
             "Serveur",
             "Base",
             "Journalière",
             "Hebdomadaire",
             "Mensuelle",
-            "Etat"
-        ]
-        headline = "".join(["<th>%s</th>" % header for header in headers])
-        body =  "<h1>Rapport de sauvegardes</h1><table><thead><tr>" + headline + "</tr></thead><tbody>"
-        plain = "| ".join(["{:<30}".format(header) for header in headers]) + "\n"
-        plain += "-" * (len(headers) * 32 - 2) + "\n"
-        for server in os.listdir(BACKUP_ROOT_PROD):
-            for name in os.listdir(os.path.join(BACKUP_ROOT_PROD, server)):
-                database = Database(server, name)
-                db_body, db_plain = self.get_database_summary(database)
-                body += db_body
-                plain += db_plain
-        body += "</tbody></table>"
-        return body, plain
+            "Etat",
+            "Intégrité",
+            "Taille",
+        ] + (["Réplication"] if self.replication_target else [])
+        return render_table("Rapport de sauvegardes", headers, (self.get_database_items(status) for status in statuses))
 
 
 if __name__ == "__main__":
     message = BCEmail()
     
-    body, plain = message.get_summary()
-    message.attach_all(body, plain)
+    message.attach_section(message.get_summary())
 
     message.send()
 
@@ -119,3 +189,46 @@ class BackupCheckTest(unittest.TestCase):
 
         self.database.rotate()
         self.assertEqual(self.email.get_database_state(self.database), "OK")
+
+    def test_get_database_integrity(self):
+        self.assertEqual(self.email.get_database_integrity(self.database), "OK")
+        self._generate_data(self.database, 'daily', self.now)
+        self.assertEqual(
+            self.email.get_database_integrity(self.database),
+            "1 corrompue(s), dont daily/{} : File is not a zip file".format(get_filename_from_datetime(self.now))
+        )
+
+    def test_get_summary(self):
+        os.makedirs(os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database9', 'daily'))
+        self._generate_data(self.database, 'daily', self.now)
+        statuses = self.email.get_statuses(jobs=2)
+        self.assertEqual([(status.name, status.last_daily, status.state) for status in statuses], [
+            ('Database2', self.now, "Hebdomadaire manquante"),
+            ('Database9', None, "Journalière manquante"),
+        ])
+        # The report never creates directories
+        self.assertNotIn('weekly', os.listdir(os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database9')))
+        body, plain, attachments = self.email.get_summary(statuses)
+        self.assertEqual(body.count("<tr>"), 3)
+        self.email.attach_section(self.email.get_summary(statuses))
+        self.assertEqual(self.email.get_content_type(), 'multipart/mixed')
+
+    def test_get_database_replication(self):
+        self.assertEqual(self.email.get_database_replication(self.database), "OK")
+        self._generate_data(self.database, 'weekly', self.now - datetime.timedelta(days=8))
+        self.assertEqual(self.email.get_database_replication(self.database), "En retard : il y a 8 jours")
+        self.email.replication_target = '/mnt/replica'
+        body, plain, attachments = self.email.get_summary(self.email.get_statuses())
+        self.assertIn("<th>Réplication</th>", body)
+        self.assertIn("<td>En retard : il y a 8 jours</td>", body)
+
+    def test_get_database_size(self):
+        self.assertEqual(self.email.get_database_size(self.database), "Historique insuffisant")
+        past = time.time() - 3600
+        for day in range(10):
+            self._generate_data(self.database, 'daily', self.now - datetime.timedelta(days=10 - day))
+            os.utime(self.database.dump_path('daily', self.now - datetime.timedelta(days=10 - day)), (past, past))
+        # Dumps still being uploaded are not recorded
+        self._generate_data(self.database, 'daily', self.now)
+        self.assertEqual(self.email.get_database_size(self.database), "0.0 B, +0%/mois")
+        self.assertEqual(len(SizeHistory(self.database.path).read()), 10)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import zipfile
+import argparse
+import datetime
+import unittest
+import subprocess
+import collections
+
+from conf import BACKUP_ROOT_TEST
+from file_rotation import Database, ROTATION_JOBS, rotate_fleet, purge_for_space
+from backup_check import BCEmail
+from verification import Throttle, verify_zip
+
+
+AUDIT_EVENTS = collections.Counter()
+## Audited operations (open, os.scandir, os.remove, os.link...) of the running stage, Python has no hook for stat
+audit_hook_installed = False
+
+def audit_hook(event, args):
+    AUDIT_EVENTS[event] += 1
+
+def install_audit_hook():
+    """Audit hooks can't be removed, it is installed once and only counts"""
+    global audit_hook_installed
+    if not audit_hook_installed:
+        sys.addaudithook(audit_hook)
+        audit_hook_installed = True
+
+def read_proc_io():
+    """
+    Returns:
+        io (dict(str -> int)) read/write syscalls and bytes of the process, empty where /proc is not available
+    """
+    try:
+        with open('/proc/self/io') as file:
+            return {key: int(value) for key, value in (line.split(': ') for line in file)}
+    except OSError:
+        return dict()
+
+
+DiskUsage = collections.namedtuple('DiskUsage', ['total', 'used', 'free'])
+END_RECORD = struct.Struct('<4s4H2LH')
+## End of central directory: signature, disk numbers, entries, size and offset of the central directory, comment length
+
+
+def get_sparse_zip(size):
+    """A valid zip with one small stored member, padded to size by a hole before its central directory
+    Returns:
+        head (bytes) written at the start of the file
+        tail (bytes) central directory and end record, written at size - len(tail)
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('dump.sql', b'SELECT 1;\n')
+    data = buffer.getvalue()
+    fields = list(END_RECORD.unpack(data[-END_RECORD.size:]))
+    head, directory = data[:fields[6]], data[fields[6]:-END_RECORD.size]
+    # Readers find the central directory from the end record, whatever lies between it and the member
+    fields[6] = max(size - len(directory) - END_RECORD.size, len(head))
+    return head, directory + END_RECORD.pack(*fields)
+
+def generate_tree(backup_root, servers, databases, days, size, now=None):
+    """Daily dumps of every database as sparse zips: a few real blocks for the purge to account, then a hole
+    Args:
+        servers, databases (int) per server
+        days (int) of daily dumps per database
+        size (int) apparent size of each dump
+    Returns:
+        files (int)
+    """
+    now = (now or datetime.datetime.now()).replace(microsecond=0)
+    head, tail = get_sparse_zip(size)
+    files = 0
+    for server in range(servers):
+        for index in range(databases):
+            database = Database('server{:02d}'.format(server), 'database{:03d}'.format(index), backup_root)
+            for day in range(days):
+                with open(database.dump_path('daily', now - datetime.timedelta(days=day)), 'wb') as file:
+                    file.write(head)
+                    file.seek(max(size - len(tail), len(head)))
+                    file.write(tail)
+                files += 1
+    return files
+
+
+class Stage:
+    """Wall and CPU time, IO syscalls and audited operations of a block"""
+    name = None
+
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+
+    def __enter__(self):
+        AUDIT_EVENTS.clear()
+        self.io = read_proc_io()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        self.extra = dict()
+        return self.extra
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        io = read_proc_io()
+        self.results[self.name] = dict(
+            seconds=seconds,
+            cpu_seconds=time.process_time() - self.cpu,
+            io={key: io[key] - self.io[key] for key in io},
+            operations=dict(AUDIT_EVENTS.most_common()),
+            **self.extra
+        )
+
+
+def run_benchmark(backup_root, servers, databases, days, size, jobs=ROTATION_JOBS):
+    """Generate a tree in backup_root then time each stage of a run on it
+    Returns:
+        results (dict) JSON serializable
+    """
+    install_audit_hook()
+    try:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        version = None
+    stages = dict()
+    with Stage('generate', stages) as extra:
+        extra['files'] = generate_tree(backup_root, servers, databases, days, size)
+
+    for name in ('rotate', 'rotate_unchanged'):
+        with Stage(name, stages) as extra:
+            plans, failures = rotate_fleet(jobs, backup_root=backup_root)
+            extra['failures'] = len(failures)
+            extra['promotions'] = sum(len(plan.promotions) for plan in plans)
+            extra['deletions'] = sum(len(plan.deletions) for plan in plans)
+            extra['bytes_written'] = sum(plan.bytes_written for plan in plans)
+            extra['bytes_freed'] = sum(plan.bytes_freed for plan in plans)
+
+    # Simulated partition 95% full where every deletion frees one dump
+    total = servers * databases * days * size / 0.95
+    calls = []
+    def disk_usage(path):
+        used = total * 0.95 - len(calls) * 20 * size
+        calls.append(path)
+        return DiskUsage(total, used, total - used)
+
+    with Stage('purge_for_space', stages) as extra:
+        deleted, freed = purge_for_space(0.9, 0.8, backup_root=backup_root, batch_size=20, disk_usage=disk_usage)
+        extra['deletions'] = len(deleted)
+
+    with Stage('report', stages) as extra:
+        email = BCEmail(backup_root)
+        # Verification at full speed, without the production VERIFY_MAX_BYTES_PER_SECOND cap
+        email.throttle = Throttle(None)
+        section = email.get_summary()
+        extra['html_bytes'] = len(section.body.encode())
+
+    return dict(
+        version=version,
+        python=sys.version.split()[0],
+        date=datetime.datetime.now().isoformat(timespec='seconds'),
+        parameters=dict(servers=servers, databases=databases, days=days, size=size, jobs=jobs),
+        stages=stages,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time rotation, purge and report on a generated backup tree")
+    parser.add_argument('--root', default=os.path.join(BACKUP_ROOT_TEST, 'benchmark'),
+                        help="directory of the generated tree, emptied before and after the run")
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--databases', type=int, default=20, help="per server")
+    parser.add_argument('--days', type=int, default=365, help="daily dumps per database")
+    parser.add_argument('--size', type=int, default=200 * 1024 * 1024, help="apparent size of each dump")
+    parser.add_argument('--jobs', type=int, default=ROTATION_JOBS)
+    parser.add_argument('--output', help="JSON results, printed if not given")
+    parser.add_argument('--keep', action='store_true', help="keep the generated tree")
+    args = parser.parse_args()
+    shutil.rmtree(args.root, ignore_errors=True)
+    try:
+        results = run_benchmark(args.root, args.servers, args.databases, args.days, args.size, args.jobs)
+    finally:
+        if not args.keep:
+            shutil.rmtree(args.root, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.join(BACKUP_ROOT_TEST, 'benchmark')
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_run_benchmark(self):
+        results = run_benchmark(self.root, servers=2, databases=2, days=60, size=10 * 1024 * 1024, jobs=2)
+        json.dumps(results)
+        stages = results['stages']
+        self.assertEqual(list(stages), ['generate', 'rotate', 'rotate_unchanged', 'purge_for_space', 'report'])
+        self.assertEqual(stages['generate']['files'], 240)
+        self.assertGreater(stages['generate']['operations']['open'], 240)
+        self.assertEqual(stages['rotate']['failures'], 0)
+        self.assertGreater(stages['rotate']['promotions'], 0)
+        self.assertEqual(stages['rotate_unchanged']['promotions'], 0)
+        self.assertGreater(stages['purge_for_space']['deletions'], 0)
+        # Sparse dumps: the tree takes a few blocks per dump, each of them a valid zip
+        entries = list(os.scandir(Database('server00', 'database000', self.root).daily_path))
+        self.assertLess(sum(entry.stat().st_blocks for entry in entries), 60 * 64)
+        self.assertEqual(entries[0].stat().st_size, 10 * 1024 * 1024)
+        self.assertIsNone(verify_zip(entries[0].path))
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import datetime
+import sqlite3
+import shutil
+import unittest
+import contextlib
+from array import array
+
+from conf import BACKUP_ROOT_TEST
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_timestamp(dt):
+    """Backup datetimes are naive local times, they are stored as seconds since EPOCH without timezone"""
+    return int((dt - EPOCH).total_seconds())
+
+def from_timestamp(timestamp):
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+class Catalog:
+    """On-disk index of the dumps of one database, stored in <server>/<database>/.catalog.sqlite
+
+    A tier is only listed again when the mtime of its directory changes, and only new files and the ones still
+    being uploaded are stat'ed.
+    """
+    filename = '.catalog.sqlite'
+    tiers = ('daily', 'weekly', 'monthly')
+    # A directory modified less than RACY_NS before it was scanned may change again without its mtime moving
+    RACY_NS = 2 * 10**9
+    # Files still being uploaded keep changing size, they are stat'ed again until they are old enough
+    STABLE_NS = 60 * 10**9
+    path = None
+    parse = None
+
+    def __init__(self, path, parse):
+        """
+        Args:
+            path (str) database directory
+            parse (function) filename -> timestamp (int), raises ValueError for files that are not dumps
+        """
+        self.path = path
+        self.parse = parse
+
+    @property
+    def catalog_path(self):
+        return os.path.join(self.path, self.filename)
+
+    @contextlib.contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.catalog_path, timeout=60)
+        try:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS tiers (tier TEXT PRIMARY KEY, mtime_ns INTEGER, scanned_ns INTEGER);
+                CREATE TABLE IF NOT EXISTS dumps (
+                    tier TEXT, filename TEXT, timestamp INTEGER, size INTEGER, mtime_ns INTEGER,
+                    PRIMARY KEY (tier, filename)
+                );
+                CREATE INDEX IF NOT EXISTS dumps_tier_timestamp ON dumps (tier, timestamp);
+                CREATE TABLE IF NOT EXISTS malformed (tier TEXT, filename TEXT, PRIMARY KEY (tier, filename));
+                CREATE TABLE IF NOT EXISTS verifications (
+                    inode INTEGER, size INTEGER, mtime_ns INTEGER, error TEXT, verified_ns INTEGER,
+                    PRIMARY KEY (inode, size, mtime_ns)
+                );
+                CREATE TABLE IF NOT EXISTS members (
+                    inode INTEGER, size INTEGER, mtime_ns INTEGER, name TEXT, header_offset INTEGER,
+                    compress_size INTEGER, file_size INTEGER, crc INTEGER, compress_type INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS members_dump ON members (inode, size, mtime_ns);
+            """)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def refresh(self, connection, tier):
+        """Bring the catalog of a tier up to date with its directory"""
+        tier_path = os.path.join(self.path, tier)
+        mtime_ns = os.stat(tier_path).st_mtime_ns
+        row = connection.execute("SELECT mtime_ns, scanned_ns FROM tiers WHERE tier = ?", (tier,)).fetchone()
+        now_ns = time.time_ns()
+        if row and row[0] == mtime_ns and row[1] - mtime_ns > self.RACY_NS:
+            unstable = connection.execute(
+                "SELECT filename FROM dumps WHERE tier = ? AND mtime_ns > ?", (tier, row[1] - self.STABLE_NS)
+            ).fetchall()
+            for filename, in unstable:
+                self.update(connection, tier, filename)
+            if unstable:
+                connection.execute("UPDATE tiers SET scanned_ns = ? WHERE tier = ?", (now_ns, tier))
+            return
+        known = {filename for filename, in connection.execute("SELECT filename FROM dumps WHERE tier = ?", (tier,))}
+        known |= {filename for filename, in connection.execute("SELECT filename FROM malformed WHERE tier = ?", (tier,))}
+        present = {entry.name: entry for entry in os.scandir(tier_path) if entry.is_file()}
+        removed = [(tier, filename) for filename in known - set(present)]
+        connection.executemany("DELETE FROM dumps WHERE tier = ? AND filename = ?", removed)
+        connection.executemany("DELETE FROM malformed WHERE tier = ? AND filename = ?", removed)
+        if row:
+            # Dumps still being uploaded at the previous scan may have grown since
+            unstable = connection.execute(
+                "SELECT filename FROM dumps WHERE tier = ? AND mtime_ns > ?", (tier, row[1] - self.STABLE_NS)
+            ).fetchall()
+            connection.executemany("UPDATE dumps SET size = ?, mtime_ns = ? WHERE tier = ? AND filename = ?", [
+                (present[filename].stat().st_size, present[filename].stat().st_mtime_ns, tier, filename)
+                for filename, in unstable if filename in present
+            ])
+        rows, malformed = [], []
+        for filename in set(present) - known:
+            try:
+                timestamp = self.parse(filename)
+            except ValueError:
+                malformed.append((tier, filename))
+                continue
+            stat = present[filename].stat()
+            rows.append((tier, filename, timestamp, stat.st_size, stat.st_mtime_ns))
+        connection.executemany("INSERT INTO dumps VALUES (?, ?, ?, ?, ?)", rows)
+        connection.executemany("INSERT INTO malformed VALUES (?, ?)", malformed)
+        connection.execute("INSERT OR REPLACE INTO tiers VALUES (?, ?, ?)", (tier, mtime_ns, now_ns))
+
+    def update(self, connection, tier, filename):
+        try:
+            stat = os.stat(os.path.join(self.path, tier, filename))
+        except FileNotFoundError:
+            connection.execute("DELETE FROM dumps WHERE tier = ? AND filename = ?", (tier, filename))
+            return
+        connection.execute(
+            "UPDATE dumps SET size = ?, mtime_ns = ? WHERE tier = ? AND filename = ?",
+            (stat.st_size, stat.st_mtime_ns, tier, filename)
+        )
+
+    def rebuild(self):
+        """Drop everything and scan all tiers again, for when the catalog drifted"""
+        with self.connect() as connection:
+            connection.execute("DELETE FROM dumps")
+            connection.execute("DELETE FROM malformed")
+            connection.execute("DELETE FROM tiers")
+            for tier in self.tiers:
+                self.refresh(connection, tier)
+
+    def timeline(self, tier):
+        """
+        Returns:
+            timestamps (array('q')) sorted
+        """
+        with self.connect() as connection:
+            self.refresh(connection, tier)
+            rows = connection.execute("SELECT timestamp FROM dumps WHERE tier = ? ORDER BY timestamp", (tier,))
+            return array('q', (timestamp for timestamp, in rows))
+
+    def malformed(self):
+        """Files of the tiers that are not dumps, as of the last refresh of each tier
+        Returns:
+            paths (list(str)) tier/filename
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT tier, filename FROM malformed ORDER BY tier, filename")
+            return [os.path.join(tier, filename) for tier, filename in rows]
+
+    def entries(self, tier):
+        """
+        Returns:
+            entries (list((datetime.datetime, int, int))) datetime, size and mtime_ns sorted by datetime
+        """
+        with self.connect() as connection:
+            self.refresh(connection, tier)
+            rows = connection.execute(
+                "SELECT timestamp, size, mtime_ns FROM dumps WHERE tier = ? ORDER BY timestamp", (tier,)
+            )
+            return [(from_timestamp(timestamp), size, mtime_ns) for timestamp, size, mtime_ns in rows]
+
+    def get_verification(self, stat):
+        """
+        Args:
+            stat (os.stat_result) of the dump
+        Returns:
+            verified (bool) False if this exact file was never verified
+            error (str or None)
+        """
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT error FROM verifications WHERE inode = ? AND size = ? AND mtime_ns = ?",
+                (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def set_verification(self, stat, error):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO verifications VALUES (?, ?, ?, ?, ?)",
+                (stat.st_ino, stat.st_size, stat.st_mtime_ns, error, time.time_ns())
+            )
+
+    def get_members(self, stat):
+        """
+        Args:
+            stat (os.stat_result) of the dump
+        Returns:
+            members (list(tuple) or None) name, header_offset, compress_size, file_size, crc and compress_type
+                in the order of the archive, None if this exact file was never indexed
+        """
+        with self.connect() as connection:
+            key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            rows = connection.execute(
+                "SELECT name, header_offset, compress_size, file_size, crc, compress_type FROM members "
+                "WHERE inode = ? AND size = ? AND mtime_ns = ? ORDER BY rowid", key
+            ).fetchall()
+        return rows or None
+
+    def set_members(self, stat, members):
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.connect() as connection:
+            connection.execute("DELETE FROM members WHERE inode = ?", (stat.st_ino,))
+            connection.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [key + tuple(member) for member in members])
+
+    def prune_verifications(self, inodes):
+        """Forget the verifications and member indexes of files that no longer exist
+        Args:
+            inodes (set(int)) inodes still present
+        """
+        with self.connect() as connection:
+            for table in ('verifications', 'members'):
+                known = {inode for inode, in connection.execute("SELECT DISTINCT inode FROM {}".format(table))}
+                connection.executemany("DELETE FROM {} WHERE inode = ?".format(table), [(inode,) for inode in known - inodes])
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database4')
+        for tier in Catalog.tiers:
+            os.makedirs(os.path.join(self.path, tier), exist_ok=True)
+        self.catalog = Catalog(self.path, lambda filename: to_timestamp(datetime.datetime.strptime(filename, "%Y_%m_%d_%H_%M_%S.dump.zip")))
+        self.daily_path = os.path.join(self.path, 'daily')
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _touch(self, filename, size=0):
+        with open(os.path.join(self.daily_path, filename), 'wb') as file:
+            file.write(b'0' * size)
+
+    def test_queries(self):
+        self.assertEqual(self.catalog.timeline('daily'), array('q'))
+        self._touch('2020_03_01_03_00_01.dump.zip', 10)
+        self._touch('2020_03_02_03_00_01.dump.zip', 20)
+        self.assertEqual([dt for dt, size, mtime_ns in self.catalog.entries('daily')],
+                         [datetime.datetime(2020, 3, 1, 3, 0, 1), datetime.datetime(2020, 3, 2, 3, 0, 1)])
+        self.assertEqual([size for dt, size, mtime_ns in self.catalog.entries('daily')], [10, 20])
+        self.assertEqual(self.catalog.timeline('daily'), array('q', [1583031601, 1583118001]))
+
+        self._touch('upload.tmp')
+        self.assertEqual(len(self.catalog.timeline('daily')), 2)
+        self.assertEqual(self.catalog.malformed(), ['daily/upload.tmp'])
+
+    def test_directory_mtime(self):
+        self._touch('2020_03_01_03_00_01.dump.zip')
+        # Pretend the directory has not changed for a while: the catalog trusts its previous scan
+        os.utime(self.daily_path, ns=(0, 0))
+        self.assertEqual(len(self.catalog.timeline('daily')), 1)
+        self._touch('2020_03_02_03_00_01.dump.zip')
+        os.utime(self.daily_path, ns=(0, 0))
+        self.assertEqual(len(self.catalog.timeline('daily')), 1)
+
+        self.catalog.rebuild()
+        self.assertEqual(len(self.catalog.timeline('daily')), 2)
+
+        os.remove(os.path.join(self.daily_path, '2020_03_01_03_00_01.dump.zip'))
+        self.assertEqual(len(self.catalog.timeline('daily')), 1)
+
+    def test_upload_during_rescan(self):
+        self._touch('2020_03_01_03_00_01.dump.zip', 1)
+        self.assertEqual([size for dt, size, mtime_ns in self.catalog.entries('daily')], [1])
+        # The upload goes on while another file changes the directory, which triggers a full rescan
+        self._touch('2020_03_01_03_00_01.dump.zip', 100)
+        self._touch('2020_03_02_03_00_01.dump.zip', 10)
+        os.utime(self.daily_path, ns=(0, 0))
+        self.assertEqual([size for dt, size, mtime_ns in self.catalog.entries('daily')], [100, 10])
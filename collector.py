@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import argparse
+import datetime
+import unittest
+
+from conf import BACKUP_ROOT_TEST, STATE_PATH, REPORT_SECRET
+from backup_check import BCEmail
+from file_rotation import Database, iter_databases
+from render import render_table, join_sections
+import spool
+
+
+REPORT_MAX_AGE = 24 * 3600
+## A server whose last report is older than this is reported late
+SPOOL_PATH = os.path.join(STATE_PATH, 'spool')
+
+
+def get_server_rows(payloads, expected, now=None):
+    """
+    Args:
+        payloads (list(dict)) last report of each server
+        expected (iterable(str)) servers which should have sent a report
+    Returns:
+        rows (list(list(str))) server, date of the last report and state
+    """
+    now = now or time.time()
+    timestamps = {payload['server']: payload['timestamp'] for payload in payloads}
+    rows = []
+    for server in sorted(set(expected) | set(timestamps)):
+        timestamp = timestamps.get(server)
+        if timestamp is None:
+            rows.append([server, "jamais", "Manquant"])
+            continue
+        date = datetime.datetime.fromtimestamp(timestamp).replace(microsecond=0)
+        if now - timestamp > REPORT_MAX_AGE:
+            rows.append([server, date, "En retard : il y a {} jours".format(int((now - timestamp) // 86400))])
+        else:
+            rows.append([server, date, "OK"])
+    return rows
+
+def merge_modules(payloads):
+    """One table per module with a Serveur column, so the servers can be compared
+    Returns:
+        sections (list(render.Section))
+    """
+    tables = dict()
+    for payload in payloads:
+        for result in payload['results']:
+            headers = tuple(result['headers'])
+            rows = tables.setdefault((result['title'], headers), [])
+            if result['error'] is not None:
+                rows.append([payload['server'], "Module indisponible : {}".format(result['error'])] + [''] * (len(headers) - 1))
+            else:
+                rows += [[payload['server']] + line for line in result['data']]
+    return [render_table(title, ('Serveur',) + headers, rows) for (title, headers), rows in tables.items()]
+
+
+class FleetEmail(BCEmail):
+    title = "Rapport de la flotte"
+    spool_path = SPOOL_PATH
+
+    def get_fleet_summary(self, now=None):
+        """Reports of the servers in the spool, then the backups of the storage server
+        Returns:
+            section (render.Section)
+        """
+        payloads = spool.read_payloads(self.spool_path)
+        expected = {server for server, name in iter_databases(self.backup_root)}
+        sections = [render_table("Serveurs", ["Serveur", "Dernier rapport", "Etat"], get_server_rows(payloads, expected, now))]
+        sections += merge_modules(payloads)
+        sections.append(self.get_summary())
+        return join_sections(sections)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the monitoring reports of the fleet with the backup report")
+    parser.add_argument('--listen', metavar='[HOST:]PORT',
+                        help="receive the reports pushed by monitoring.py (REPORT_COLLECTOR = 'host:port') instead of sending the mail, "
+                             "on 127.0.0.1 unless HOST is given")
+    args = parser.parse_args()
+    if args.listen:
+        host, _, port = args.listen.rpartition(':')
+        host = host or '127.0.0.1'
+        if REPORT_SECRET is None and host not in ('127.0.0.1', 'localhost', '::1'):
+            parser.error("REPORT_SECRET must be configured to receive reports from other hosts")
+        spool.SpoolServer((host, int(port)), SPOOL_PATH).serve_forever()
+    else:
+        message = FleetEmail()
+        message.attach_section(message.get_fleet_summary())
+        message.send()
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.email = FleetEmail(BACKUP_ROOT_TEST)
+        self.email.spool_path = os.path.join(BACKUP_ROOT_TEST, '.spool')
+        self.now = time.time()
+        Database('odoo1', 'prod', BACKUP_ROOT_TEST)
+        Database('odoo3', 'prod', BACKUP_ROOT_TEST)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _push(self, server, timestamp, results):
+        spool.push(self.email.spool_path, dict(server=server, timestamp=timestamp, results=results))
+
+    def test_get_fleet_summary(self):
+        disk = dict(module='DiskModule', title='Espace disque', headers=['Partition', 'Used'], duration=0.1)
+        self._push('odoo1', self.now - 3600, [dict(disk, data=[['/', '10.0 GiB']], error=None)])
+        self._push('odoo2', self.now - 3 * 86400, [dict(disk, data=None, error="OSError: boom")])
+        rows = get_server_rows(spool.read_payloads(self.email.spool_path), ['odoo1', 'odoo3'], self.now)
+        self.assertEqual([[server, state] for server, date, state in rows], [
+            ['odoo1', "OK"],
+            ['odoo2', "En retard : il y a 3 jours"],
+            ['odoo3', "Manquant"],
+        ])
+        body, plain, attachments = self.email.get_fleet_summary(self.now)
+        self.assertIn("<h1>Espace disque</h1><table><thead><tr><th>Serveur</th><th>Partition</th><th>Used</th>", body)
+        self.assertIn("<tr><td>odoo1</td><td>/</td><td>10.0 GiB</td></tr>", body)
+        self.assertIn("<tr><td>odoo2</td><td>Module indisponible : OSError: boom</td><td></td></tr>", body)
+        self.assertIn("<h1>Rapport de sauvegardes</h1>", body)
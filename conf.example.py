@@ -7,3 +7,11 @@ BACKUP_ROOT_PROD = '/var/backups/odoo'
 BACKUP_ROOT_TEST = '/var/backups/odoo/test'
 DISK_PARTITIONS = ['/']
 LOG_PATH = "/var/log"
+VERIFY_MAX_BYTES_PER_SECOND = 50 * 1024 * 1024
+METRICS_PATH = None
+STATE_PATH = '/var/lib/odoo-scripts'
+REPORT_COLLECTOR = None
+REPLICATION_TARGET = None
+REPLICATION_MAX_BYTES_PER_SECOND = 10 * 1024 * 1024
+SMTP_REQUIRE_TLS = False
+REPORT_SECRET = None
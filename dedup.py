@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import shutil
+import hashlib
+import sqlite3
+import zipfile
+import zlib
+import tempfile
+import unittest
+import contextlib
+
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST
+
+
+MANIFEST_SUFFIX = '.dump.manifest'
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def get_manifest_path(path):
+    """2020_03_01_03_00_01.dump.zip -> 2020_03_01_03_00_01.dump.manifest"""
+    assert path.endswith('.dump.zip')
+    return path[:-len('.dump.zip')] + MANIFEST_SUFFIX
+
+
+class ChunkStore:
+    """Content-addressed store shared by every database, in <backup root>/.chunks
+
+    Each zip member is stored once, zlib-compressed, under objects/<hash[:2]>/<hash>. A promoted dump
+    becomes a JSON manifest listing its members, objects are reference-counted in index.sqlite and
+    deleted with the last manifest using them.
+    """
+    dirname = '.chunks'
+    root = None
+
+    def __init__(self, backup_root=BACKUP_ROOT_PROD):
+        self.root = os.path.join(backup_root, self.dirname)
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Exclusive transaction, so a object cannot be deleted while another database references it"""
+        connection = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=600, isolation_level=None)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, stored INTEGER, refs INTEGER)")
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    @staticmethod
+    def hash_member(archive, info):
+        digest = hashlib.sha256()
+        with archive.open(info) as member:
+            for chunk in iter(lambda: member.read(READ_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def stage_object(self, archive, info):
+        """Compress a member into a temporary file of the store, renamed to its object path once referenced
+        Returns:
+            tmp (str) path of the temporary file
+            stored (int) bytes written
+        """
+        compressor = zlib.compressobj()
+        with tempfile.NamedTemporaryFile(dir=self.root, prefix='.', suffix='.tmp', delete=False) as tmp:
+            try:
+                with archive.open(info) as member:
+                    for chunk in iter(lambda: member.read(READ_CHUNK_SIZE), b''):
+                        tmp.write(compressor.compress(chunk))
+                tmp.write(compressor.flush())
+            except BaseException:
+                os.remove(tmp.name)
+                raise
+        return tmp.name, os.path.getsize(tmp.name)
+
+    def get_known_digests(self, digests):
+        """Read without the lock, only to skip compressing objects which are already stored
+        Returns:
+            digests (set(str))
+        """
+        connection = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=600)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, stored INTEGER, refs INTEGER)")
+            return {digest for digest in digests
+                    if connection.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone()}
+        finally:
+            connection.close()
+
+    def promote(self, source, destination):
+        """Store the members of a .dump.zip and write its manifest next to destination
+        Args:
+            source (str) path of the .dump.zip
+            destination (str) path the .dump.zip would have been copied to
+        Returns:
+            written (int) bytes physically written
+        """
+        manifest_path = get_manifest_path(destination)
+        if os.path.exists(manifest_path):
+            self.release(manifest_path)
+        written = 0
+        members = []
+        staged = {}
+        created = []
+        with zipfile.ZipFile(source) as archive:
+            try:
+                # Hash and check the CRC of every member first, a corrupted dump never touches the index
+                infos = [(info, self.hash_member(archive, info)) for info in archive.infolist()]
+                # New objects are compressed before the index is locked, the other databases keep rotating meanwhile
+                known = self.get_known_digests(digest for _, digest in infos)
+                for info, digest in infos:
+                    if digest not in known and digest not in staged:
+                        staged[digest] = self.stage_object(archive, info)
+                # One transaction for every member and the manifest: the references of a dump are counted
+                # only if its manifest exists
+                with self.transaction() as connection:
+                    for info, digest in infos:
+                        row = connection.execute("SELECT refs FROM objects WHERE digest = ?", (digest,)).fetchone()
+                        if row:
+                            connection.execute("UPDATE objects SET refs = refs + 1 WHERE digest = ?", (digest,))
+                        else:
+                            if digest not in staged:
+                                # Released by another database since it was looked up
+                                staged[digest] = self.stage_object(archive, info)
+                            tmp, stored = staged.pop(digest)
+                            path = self.object_path(digest)
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                            os.replace(tmp, path)
+                            created.append(path)
+                            written += stored
+                            connection.execute("INSERT INTO objects VALUES (?, ?, ?, 1)", (digest, info.file_size, stored))
+                        members.append(dict(
+                            name=info.filename,
+                            date_time=info.date_time,
+                            compress_type=info.compress_type,
+                            external_attr=info.external_attr,
+                            size=info.file_size,
+                            digest=digest,
+                        ))
+                    manifest = dict(size=os.path.getsize(source), members=members)
+                    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(manifest_path), delete=False) as tmp:
+                        json.dump(manifest, tmp)
+                    os.replace(tmp.name, manifest_path)
+            except BaseException:
+                # Rolled back: the objects written by this promotion are referenced by nothing
+                for path in created + [manifest_path]:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                raise
+            finally:
+                # Staged for a digest another promotion stored in the meantime
+                for tmp, _ in staged.values():
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(tmp)
+        written += os.path.getsize(manifest_path)
+        return written
+
+    @staticmethod
+    def read_manifest(manifest_path):
+        with open(manifest_path) as file:
+            return json.load(file)
+
+    def release(self, manifest_path):
+        """Delete a manifest and the objects no other manifest references, this is the purge of a deduplicated dump
+        Returns:
+            freed (int) bytes deleted from the store
+        """
+        freed = 0
+        members = self.read_manifest(manifest_path)['members']
+        with self.transaction() as connection:
+            for member in members:
+                connection.execute("UPDATE objects SET refs = refs - 1 WHERE digest = ?", (member['digest'],))
+            for digest, stored in connection.execute("SELECT digest, stored FROM objects WHERE refs <= 0").fetchall():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.object_path(digest))
+                freed += stored
+            connection.execute("DELETE FROM objects WHERE refs <= 0")
+            os.remove(manifest_path)
+        return freed
+
+    def open_member(self, member):
+        """
+        Yields:
+            chunk (bytes) uncompressed content of a manifest member
+        """
+        decompressor = zlib.decompressobj()
+        with open(self.object_path(member['digest']), 'rb') as file:
+            for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b''):
+                yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+    def materialize(self, manifest_path, destination):
+        """Rebuild a regular .dump.zip from a manifest"""
+        with zipfile.ZipFile(destination, 'w', allowZip64=True) as archive:
+            for member in self.read_manifest(manifest_path)['members']:
+                info = zipfile.ZipInfo(member['name'], tuple(member['date_time']))
+                info.compress_type = member['compress_type']
+                info.external_attr = member['external_attr']
+                info.file_size = member['size']
+                with archive.open(info, 'w', force_zip64=member['size'] > zipfile.ZIP64_LIMIT) as output:
+                    for chunk in self.open_member(member):
+                        output.write(chunk)
+
+    def verify(self, manifest_path, throttle=None):
+        """
+        Returns:
+            error (str or None)
+        """
+        try:
+            members = self.read_manifest(manifest_path)['members']
+            for member in members:
+                digest = hashlib.sha256()
+                for chunk in self.open_member(member):
+                    digest.update(chunk)
+                    if throttle:
+                        throttle.consume(len(chunk))
+                if digest.hexdigest() != member['digest']:
+                    return "{} : contenu altéré".format(member['name'])
+        except (OSError, ValueError, KeyError, zlib.error) as e:
+            return str(e) or e.__class__.__name__
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            logical (int) uncompressed bytes referenced by all manifests
+            stored (int) bytes actually used by the objects
+        """
+        with self.transaction() as connection:
+            logical, stored = connection.execute("SELECT SUM(size * refs), SUM(stored) FROM objects").fetchone()
+        return logical or 0, stored or 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['materialize'] and len(sys.argv) == 4:
+        ChunkStore().materialize(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:] == ['stats']:
+        logical, stored = ChunkStore().stats()
+        print("Referenced: {} bytes, stored: {} bytes, saved: {} bytes".format(logical, stored, logical - stored))
+    else:
+        print("Usage: dedup.py materialize <manifest> <destination.dump.zip> | dedup.py stats", file=sys.stderr)
+        sys.exit(2)
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ChunkStore(BACKUP_ROOT_TEST)
+        self.path = os.path.join(BACKUP_ROOT_TEST, 'dumps')
+        os.makedirs(self.path, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _generate_zip(self, filename, sql):
+        path = os.path.join(self.path, filename)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('dump.sql', sql)
+            archive.writestr('filestore/ab/abcdef', os.urandom(64 * 1024))
+        return path
+
+    def test_promote_materialize_release(self):
+        first = self._generate_zip('2020_03_01_03_00_01.dump.zip', 'week 1')
+        second = os.path.join(self.path, '2020_03_08_03_00_01.dump.zip')
+        # Same attachment, different dump.sql
+        with zipfile.ZipFile(first) as archive, zipfile.ZipFile(second, 'w', zipfile.ZIP_DEFLATED) as copy:
+            copy.writestr('dump.sql', 'week 2')
+            copy.writestr('filestore/ab/abcdef', archive.read('filestore/ab/abcdef'))
+
+        weekly = os.path.join(self.path, 'weekly')
+        os.makedirs(weekly)
+        stage_object = self.store.stage_object
+        def stage_unlocked(archive, info):
+            # Raises "database is locked" if the promotion holds the index while compressing
+            connection = sqlite3.connect(os.path.join(self.store.root, 'index.sqlite'), timeout=0, isolation_level=None)
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("ROLLBACK")
+            connection.close()
+            return stage_object(archive, info)
+        self.store.stage_object = stage_unlocked
+        self.store.promote(first, os.path.join(weekly, os.path.basename(first)))
+        del self.store.stage_object
+        written = self.store.promote(second, os.path.join(weekly, os.path.basename(second)))
+        self.assertLess(written, 1024)
+        self.assertEqual(sorted(os.listdir(weekly)), ['2020_03_01_03_00_01.dump.manifest', '2020_03_08_03_00_01.dump.manifest'])
+        self.assertEqual(sorted(os.listdir(self.store.root)), ['index.sqlite', 'objects'])
+        logical, stored = self.store.stats()
+        self.assertGreater(logical - stored, 64 * 1024 - 1024)
+
+        manifest = os.path.join(weekly, '2020_03_08_03_00_01.dump.manifest')
+        self.assertIsNone(self.store.verify(manifest))
+        restored = os.path.join(self.path, 'restored.zip')
+        self.store.materialize(manifest, restored)
+        with zipfile.ZipFile(restored) as archive, zipfile.ZipFile(second) as original:
+            self.assertIsNone(archive.testzip())
+            for name in original.namelist():
+                self.assertEqual(archive.read(name), original.read(name))
+
+        # The attachment is still referenced by the second manifest
+        self.store.release(os.path.join(weekly, '2020_03_01_03_00_01.dump.manifest'))
+        self.assertIsNone(self.store.verify(manifest))
+        self.assertGreater(self.store.release(manifest), 64 * 1024)
+        self.assertEqual(self.store.stats(), (0, 0))
+
+    def test_promote_corrupted(self):
+        path = os.path.join(self.path, '2020_03_01_03_00_01.dump.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('dump.sql', 'INSERT INTO res_partner VALUES (1);\n')
+            archive.writestr('filestore/ab/abcdef', b'attachment' * 100)
+        with open(path, 'r+b') as file:
+            data = file.read()
+            file.seek(data.index(b'attachment') + 10)
+            file.write(b'ATTACHMENT')
+        weekly = os.path.join(self.path, 'weekly')
+        os.makedirs(weekly)
+        # Retried by every rotation, the first member must not be referenced each time
+        for _ in range(3):
+            with self.assertRaises(zipfile.BadZipFile):
+                self.store.promote(path, os.path.join(weekly, os.path.basename(path)))
+        self.assertEqual(self.store.stats(), (0, 0))
+        self.assertEqual(os.listdir(weekly), [])
+        self.assertEqual(sorted(os.listdir(self.store.root)), ['index.sqlite', 'objects'])
@@ -3,47 +3,203 @@ import shutil, os
 import unittest
 import pathlib
 import datetime
-
-from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST
+import bisect
+import argparse
+import fcntl
+import contextlib
+import sys
+import traceback
+import zipfile
+import heapq
+import collections
+import time
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST, METRICS_PATH
+from catalog import Catalog, to_timestamp, from_timestamp
+from dedup import ChunkStore, MANIFEST_SUFFIX
+from prometheus import Metric, write_textfile
+from inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_ISDIR, IN_Q_OVERFLOW
+
+
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def promote_hardlink(source, destination):
+    """Only works when source and destination are on the same filesystem
+    Returns:
+        written (int) bytes physically written
+    """
+    os.link(source, destination)
+    return 0
+
+def promote_reflink(source, destination):
+    """Copy-on-write clone, only on btrfs/XFS
+    Returns:
+        written (int) bytes physically written
+    """
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise
+    shutil.copymode(source, destination)
+    return 0
+
+def promote_copy(source, destination):
+    """In-kernel copy with copy_file_range, falls back on shutil (sendfile)
+    Returns:
+        written (int) bytes physically written
+    """
+    written = 0
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            while True:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE)
+                if not copied:
+                    break
+                written += copied
+        except (AttributeError, OSError):
+            if written:
+                raise
+    if not written:
+        shutil.copyfile(source, destination)
+        written = os.path.getsize(destination)
+    shutil.copymode(source, destination)
+    return written
+
+def promote_auto(source, destination):
+    """Cheapest strategy available: hardlink, then reflink, then copy
+    Returns:
+        written (int) bytes physically written
+    """
+    for strategy in (promote_hardlink, promote_reflink):
+        try:
+            return strategy(source, destination)
+        except OSError:
+            pass
+    return promote_copy(source, destination)
+
+PROMOTION_STRATEGIES = {
+    'auto': promote_auto,
+    'hardlink': promote_hardlink,
+    'reflink': promote_reflink,
+    'copy': promote_copy,
+}
+# 'dedup' stores weekly/monthly dumps as manifests in the ChunkStore of the backup root
+PROMOTIONS = list(PROMOTION_STRATEGIES) + ['dedup']
 
 
 class RetentionPolicy:
     weeks = None
     months = None
+    promotion = 'auto'
+    days = None
 
-    def __init__(self, weeks, months):
+    def __init__(self, weeks, months, promotion='auto', days=None):
         assert isinstance(weeks, int)
         self.weeks = weeks
         assert isinstance(months, int)
         self.months = months
+        assert promotion in PROMOTIONS
+        self.promotion = promotion
+        # Number of daily dumps kept, None keeps them all
+        assert days is None or (isinstance(days, int) and days > 0)
+        self.days = days
 
 
 ## CONFIG
 DEFAULT_RETENTION_POLICY = RetentionPolicy(weeks=4, months=12)
 RETENTION_POLICIES = {}
 ## For each database, add a policy, otherwise the default policy will be used.
+ROTATION_JOBS = 4
+## Number of databases rotated at the same time
+BACKUP_HIGH_WATERMARK = None
+BACKUP_LOW_WATERMARK = 0.80
+DAILY_MIN_KEPT = 7
+## When the backup partition is used over BACKUP_HIGH_WATERMARK (ex: 0.90), the oldest daily dumps of all
+## databases are deleted until it is under BACKUP_LOW_WATERMARK, keeping at least DAILY_MIN_KEPT per database.
+RECONCILE_INTERVAL = 3600
+## In daemon mode, seconds between two full rotations catching the events that were missed
+RECOMPRESS_AFTER_DAYS = None
+RECOMPRESS_JOBS = 2
+## recompress.py repacks with LZMA the monthly dumps older than RECOMPRESS_AFTER_DAYS (ex: 90), in
+## RECOMPRESS_JOBS low-priority processes. None disables it.
+
+LZMA_SUFFIX = '.dump.lzma.zip'
+DUMP_SUFFIXES = ('.dump.zip', MANIFEST_SUFFIX, LZMA_SUFFIX)
+
+DAY = 24 * 3600
+DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def days_from_civil(year, month, day):
+    """Days between 1970-01-01 and a date of the proleptic Gregorian calendar"""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+DUMP_FILENAME = re.compile(r'(\d{4})_(\d\d)_(\d\d)_(\d\d)_(\d\d)_(\d\d)(?:%s)\Z' % "|".join(map(re.escape, DUMP_SUFFIXES)), re.ASCII)
+
+def parse_timestamp(filename):
+    """Fixed-format parser of %Y_%m_%d_%H_%M_%S<suffix>, much cheaper than strptime
+    Returns:
+        timestamp (int) seconds since catalog.EPOCH
+    Raises:
+        ValueError if the file is not a dump
+    """
+    match = DUMP_FILENAME.match(filename)
+    if not match:
+        raise ValueError("{} is not a backup".format(filename))
+    year, month, day, hour, minute, second = map(int, match.groups())
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if not (1 <= month <= 12 and 1 <= day <= DAYS_IN_MONTH[month] and (month != 2 or day <= 28 or leap)
+            and hour < 24 and minute < 60 and second < 60):
+        raise ValueError("{} is not a backup".format(filename))
+    return days_from_civil(year, month, day) * DAY + hour * 3600 + minute * 60 + second
 
 def get_datetime_from_filename(filename):
-    return datetime.datetime.strptime(filename, "%Y_%m_%d_%H_%M_%S.dump.zip")
+    return from_timestamp(parse_timestamp(filename))
 
 def get_filename_from_datetime(dt):
     return dt.strftime("%Y_%m_%d_%H_%M_%S.dump.zip")
 
+class DatabaseLocked(Exception):
+    pass
+
+
 class Database:
     backup_root = BACKUP_ROOT_PROD
     server = None
     name = None
-
-    def __init__(self, server, name, backup_root=BACKUP_ROOT_PROD):
+    timelines = None
+    read_only = False
+
+    def __init__(self, server, name, backup_root=BACKUP_ROOT_PROD, create=True, read_only=False):
+        """
+        Args:
+            create (bool) create the tier directories, reports open databases with create=False
+            read_only (bool) list the tiers without the catalog, nothing is written (--dry-run)
+        """
         self.backup_root = backup_root
+        self.read_only = read_only
         assert isinstance(server, str)
         self.server = server
         assert isinstance(name, str)
         self.name = name
+        self.timelines = dict()
 
-        os.makedirs(self.daily_path, exist_ok=True)
-        os.makedirs(self.weekly_path, exist_ok=True)
-        os.makedirs(self.monthly_path, exist_ok=True)
+        if create:
+            os.makedirs(self.daily_path, exist_ok=True)
+            os.makedirs(self.weekly_path, exist_ok=True)
+            os.makedirs(self.monthly_path, exist_ok=True)
 
     @property
     def path(self):
@@ -61,94 +217,558 @@ class Database:
     def monthly_path(self):
         return os.path.join(self.path, 'monthly')
 
+    def dump_path(self, tier, dt):
+        """Path of the dump, whatever the way it is stored"""
+        path = os.path.join(self.path, tier, get_filename_from_datetime(dt))
+        for suffix in DUMP_SUFFIXES[1:]:
+            if not os.path.exists(path) and os.path.exists(path[:-len('.dump.zip')] + suffix):
+                return path[:-len('.dump.zip')] + suffix
+        return path
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.path, '.lock')
+
+    @contextlib.contextmanager
+    def lock(self, blocking=False):
+        """Advisory lock so two runs never rotate the same database at the same time
+        Args:
+            blocking (bool) wait for the lock, for short operations that must not fail because of a rotation
+        Raises:
+            DatabaseLocked if another process holds the lock
+        """
+        with open(self.lock_path, 'w') as file:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                raise DatabaseLocked("{}/{} is locked by another run".format(self.server, self.name))
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
     @property
     def retention_policy(self):
         return RETENTION_POLICIES.get(self.server + "/" + self.name) or DEFAULT_RETENTION_POLICY
 
+    @property
+    def catalog(self):
+        return Catalog(self.path, parse_timestamp)
+
+    def timeline(self, tier):
+        """Sorted timestamps of a tier, kept in memory until the directory changes
+        Args:
+            tier (str) daily, weekly or monthly
+        Returns:
+            timestamps (array('q'))
+        """
+        try:
+            mtime_ns = os.stat(os.path.join(self.path, tier)).st_mtime_ns
+        except FileNotFoundError:
+            return array('q')
+        if self.read_only:
+            return self.scan(tier)[0]
+        cached = self.timelines.get(tier)
+        if cached and cached[0] == mtime_ns and cached[1] - mtime_ns > Catalog.RACY_NS:
+            return cached[2]
+        loaded_ns = time.time_ns()
+        timeline = self.catalog.timeline(tier)
+        self.timelines[tier] = (mtime_ns, loaded_ns, timeline)
+        return timeline
+
+    def list_datetimes(self, tier):
+        """
+        Args:
+            tier (str) daily, weekly or monthly
+        Returns:
+            datetimes (list(datetime.datetime)) sorted
+        """
+        return [from_timestamp(timestamp) for timestamp in self.timeline(tier)]
+
+    def last_datetime(self, tier):
+        timeline = self.timeline(tier)
+        return from_timestamp(timeline[-1]) if timeline else None
+
     @property
     def last_weekly_datetime(self):
-        filenames = os.listdir(self.weekly_path)
-        if not filenames:
-            return None
-        return max([get_datetime_from_filename(filename) for filename in filenames])
+        return self.last_datetime('weekly')
 
     @property
     def last_monthly_datetime(self):
-        filenames = os.listdir(self.monthly_path)
-        if not filenames:
-            return None
-        return max([get_datetime_from_filename(filename) for filename in filenames])
+        return self.last_datetime('monthly')
 
     @property
     def last_daily_datetime(self):
-        filenames = os.listdir(self.daily_path)
-        if not filenames:
-            return None
-        return max([get_datetime_from_filename(filename) for filename in filenames])
+        return self.last_datetime('daily')
 
     def first_daily_datetime(self, minimum=None):
-        filenames = os.listdir(self.daily_path)
-        if not filenames:
-            return None
-        datetimes = [get_datetime_from_filename(filename) for filename in filenames]
-        if minimum:
-            if isinstance(minimum, datetime.datetime):
-                minimum = minimum.date()
-            assert isinstance(minimum, datetime.date)
-            datetimes = list(filter(lambda dt: dt.date() >= minimum, datetimes))
-        return min(datetimes) if datetimes else None
+        if isinstance(minimum, datetime.date) and not isinstance(minimum, datetime.datetime):
+            minimum = datetime.datetime.combine(minimum, datetime.time.min)
+        timestamp = first_timestamp(self.timeline('daily'), to_timestamp(minimum) if minimum else None)
+        return from_timestamp(timestamp) if timestamp is not None else None
+
+    def count_older_than(self, tier, dt):
+        """Number of dumps of the tier strictly older than dt"""
+        return bisect.bisect_left(self.timeline(tier), to_timestamp(dt))
+
+    def entries(self, tier):
+        """
+        Returns:
+            entries (list((datetime.datetime, int, int))) datetime, size and mtime_ns sorted by datetime
+        """
+        if not os.path.isdir(os.path.join(self.path, tier)):
+            return []
+        return self.catalog.entries(tier)
+
+    def scan(self, tier):
+        """List a tier directly, without reading or updating the catalog
+        Returns:
+            timestamps (array('q')) sorted
+            malformed (list(str)) tier/filename of the files that are not dumps
+        """
+        timestamps, malformed = [], []
+        try:
+            entries = list(os.scandir(os.path.join(self.path, tier)))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                timestamps.append(parse_timestamp(entry.name))
+            except ValueError:
+                malformed.append(os.path.join(tier, entry.name))
+        return array('q', sorted(timestamps)), sorted(malformed)
+
+    def malformed_filenames(self):
+        """
+        Returns:
+            paths (list(str)) tier/filename of the files skipped because they are not dumps
+        """
+        if self.read_only:
+            return [path for tier in Catalog.tiers for path in self.scan(tier)[1]]
+        return self.catalog.malformed()
+
+    def plan(self, rotate=True, purge=True, now=None):
+        """Compute promotions and deletions from a single scan of the database
+        Args:
+            rotate (bool) plan promotions from daily to weekly/monthly
+            purge (bool) plan deletions of the weekly/monthly over the retention policy
+            now (datetime.datetime)
+        Returns:
+            plan (RotationPlan)
+        """
+        now = ((now or datetime.datetime.now()) - from_timestamp(0)).total_seconds()
+        policy = self.retention_policy
+        plan = RotationPlan(self)
+        daily = self.timeline('daily')
+        weekly = self.timeline('weekly')
+        monthly = self.timeline('monthly')
+        promotions = []
+        if rotate:
+            # Monthly
+            latest_monthly = monthly[-1] if monthly else None
+            if latest_monthly is not None:
+                latest_monthly = max(latest_monthly, now - 30 * DAY * policy.months)
+            while latest_monthly is None or latest_monthly < now - 30 * DAY:
+                minimum = latest_monthly + 30 * DAY if latest_monthly is not None else None
+                to_move = first_timestamp(daily, minimum)
+                if to_move is None:
+                    break
+                promotions.append(('monthly', to_move))
+                latest_monthly = to_move
+            # Weekly
+            latest_weekly = weekly[-1] if weekly else None
+            if latest_weekly is not None:
+                latest_weekly = max(latest_weekly, now - 7 * DAY * policy.weeks)
+            else:
+                latest_weekly = now - 7 * DAY * policy.weeks
+            while latest_weekly < now - 7 * DAY:
+                to_move = first_timestamp(daily, latest_weekly + 7 * DAY)
+                if to_move is None:
+                    break
+                promotions.append(('weekly', to_move))
+                latest_weekly = to_move
+        if purge:
+            promoted = {tier: {timestamp for promotion_tier, timestamp in promotions if promotion_tier == tier} for tier in ('weekly', 'monthly')}
+            weekly = sorted(set(weekly) | promoted['weekly'])
+            monthly = sorted(set(monthly) | promoted['monthly'])
+            plan.deletions += [('weekly', from_timestamp(timestamp)) for timestamp in weekly[:-policy.weeks]]
+            plan.deletions += [('monthly', from_timestamp(timestamp)) for timestamp in monthly[:-policy.months]]
+            if policy.days:
+                plan.deletions += [('daily', from_timestamp(timestamp)) for timestamp in daily[:-policy.days]]
+        plan.promotions = [(tier, from_timestamp(timestamp)) for tier, timestamp in promotions]
+        plan.malformed = self.malformed_filenames()
+        return plan
+
+    def execute(self, plan):
+        """Apply a plan computed by Database.plan
+        Args:
+            plan (RotationPlan)
+        Returns:
+            written (int) bytes physically written by the promotions
+        """
+        plan.bytes_freed = 0
+        if self.retention_policy.promotion == 'dedup':
+            promote = ChunkStore(self.backup_root).promote
+        else:
+            promote = PROMOTION_STRATEGIES[self.retention_policy.promotion]
+        plan.bytes_written = 0
+        for tier, dt in plan.promotions:
+            destination = os.path.join(self.path, tier, get_filename_from_datetime(dt))
+            # Never open an existing destination for writing, it may be a hardlink to the daily
+            if os.path.lexists(destination):
+                os.remove(destination)
+            plan.bytes_written += promote(os.path.join(self.daily_path, get_filename_from_datetime(dt)), destination)
+        for tier, dt in plan.deletions:
+            plan.bytes_freed += self.remove(tier, dt)
+        return plan.bytes_written
+
+    def remove(self, tier, dt):
+        """
+        Returns:
+            freed (int) bytes given back to the filesystem, 0 when other hardlinks remain
+        """
+        path = self.dump_path(tier, dt)
+        freed = get_freed_size(os.stat(path))
+        if path.endswith(MANIFEST_SUFFIX):
+            freed += ChunkStore(self.backup_root).release(path)
+        else:
+            os.remove(path)
+        return freed
 
     def rotate(self):
-        # Monthly
-        latest_monthly = self.last_monthly_datetime
-        if latest_monthly:
-            latest_monthly = max(latest_monthly, datetime.datetime.now() - datetime.timedelta(days=30 * self.retention_policy.months))
-        while not latest_monthly or latest_monthly < datetime.datetime.now() - datetime.timedelta(days=30):
-            minimum = latest_monthly + datetime.timedelta(days=30) if latest_monthly else None
-            to_move = self.first_daily_datetime(minimum=minimum)
-            if not to_move:
-                break
-            shutil.copy(
-                os.path.join(self.daily_path, get_filename_from_datetime(to_move)),
-                os.path.join(self.monthly_path, get_filename_from_datetime(to_move)),
-            )
-            latest_monthly = to_move
-        # Weekly
-        latest_weekly = self.last_weekly_datetime
-        if latest_weekly:
-            latest_weekly = max(latest_weekly, datetime.datetime.now() - datetime.timedelta(days=7 * self.retention_policy.weeks))
-        else:
-            latest_weekly = datetime.datetime.now() - datetime.timedelta(days=7 * self.retention_policy.weeks)
-        while not latest_weekly or latest_weekly < datetime.datetime.now() - datetime.timedelta(days=7):
-            minimum = latest_weekly + datetime.timedelta(days=7) if latest_weekly else None
-            to_move = self.first_daily_datetime(minimum=minimum)
-            if not to_move:
-                break
-            shutil.copy(
-                os.path.join(self.daily_path, get_filename_from_datetime(to_move)),
-                os.path.join(self.weekly_path, get_filename_from_datetime(to_move)),
-            )
-            latest_weekly = to_move
+        return self.execute(self.plan(purge=False))
 
     def purge(self):
-        weekly_files = os.listdir(self.weekly_path)
-        if weekly_files:
-            datetimes = list(sorted([get_datetime_from_filename(filename) for filename in weekly_files]))
-            for dt in datetimes[:-self.retention_policy.weeks]:
-                os.remove(os.path.join(self.weekly_path, get_filename_from_datetime(dt)))
-        monthly_files = os.listdir(self.monthly_path)
-        if monthly_files:
-            datetimes = list(sorted([get_datetime_from_filename(filename) for filename in monthly_files]))
-            for dt in datetimes[:-self.retention_policy.months]:
-                os.remove(os.path.join(self.monthly_path, get_filename_from_datetime(dt)))
-            
+        return self.execute(self.plan(rotate=False))
+
+
+class RotationPlan:
+    database = None
+    promotions = None
+    deletions = None
+    malformed = None
+    bytes_written = None
+    bytes_freed = None
+    duration = None
+
+    def __init__(self, database):
+        self.database = database
+        self.promotions = []
+        self.deletions = []
+        self.malformed = []
+
+    def summary(self):
+        summary = "{}/{}: {} promotion(s), {} deletion(s)".format(
+            self.database.server, self.database.name, len(self.promotions), len(self.deletions)
+        )
+        if self.bytes_written is not None:
+            summary += ", {} bytes written, {} bytes freed".format(self.bytes_written, self.bytes_freed)
+        return summary
+
+    def __str__(self):
+        lines = [self.summary()]
+        for tier, dt in self.promotions:
+            lines.append("  copy daily/{0} -> {1}/{0}".format(get_filename_from_datetime(dt), tier))
+        for tier, dt in self.deletions:
+            lines.append("  delete {}/{}".format(tier, get_filename_from_datetime(dt)))
+        for path in self.malformed:
+            lines.append("  skip {} (not a dump)".format(path))
+        return "\n".join(lines)
+
+
+def iter_databases(backup_root=BACKUP_ROOT_PROD):
+    """
+    Yields:
+        server (str)
+        name (str)
+    """
+    for server in sorted(os.listdir(backup_root)):
+        # Skips the shared stores such as .chunks
+        if server.startswith('.') or not os.path.isdir(os.path.join(backup_root, server)):
+            continue
+        for name in sorted(os.listdir(os.path.join(backup_root, server))):
+            if os.path.isdir(os.path.join(backup_root, server, name)):
+                yield server, name
+
+
+def rotate_database(server, name, dry_run=False, backup_root=BACKUP_ROOT_PROD):
+    """Rotate and purge one database under its lock
+    Returns:
+        plan (RotationPlan)
+    """
+    start = time.monotonic()
+    if dry_run:
+        return Database(server, name, backup_root, create=False, read_only=True).plan()
+    database = Database(server, name, backup_root)
+    with database.lock():
+        plan = database.plan()
+        database.execute(plan)
+    plan.duration = time.monotonic() - start
+    return plan
+
+
+def rotate_fleet(jobs=ROTATION_JOBS, dry_run=False, backup_root=BACKUP_ROOT_PROD):
+    """Rotate every database with a pool of workers, a failing database does not stop the others
+    Returns:
+        plans (list(RotationPlan))
+        failures (list((str, str)) database and formatted exception
+    """
+    plans, failures = [], []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            ("{}/{}".format(server, name), executor.submit(rotate_database, server, name, dry_run, backup_root))
+            for server, name in iter_databases(backup_root)
+        ]
+        for database, future in futures:
+            try:
+                plans.append(future.result())
+            except Exception:
+                failures.append((database, traceback.format_exc()))
+    return plans, failures
+
+
+def get_freed_size(stat):
+    """Space given back by deleting a file, nothing while another hardlink (weekly/monthly) keeps it"""
+    return stat.st_blocks * 512 if stat.st_nlink <= 1 else 0
+
+
+def purge_for_space(high=BACKUP_HIGH_WATERMARK, low=BACKUP_LOW_WATERMARK, minimum=DAILY_MIN_KEPT,
+                    backup_root=BACKUP_ROOT_PROD, batch_size=20, disk_usage=shutil.disk_usage):
+    """Delete daily dumps across all databases while the backup partition is over the high watermark
+
+    The database with the most daily dumps over the minimum loses its oldest one first, so every database
+    keeps a similar history. Dumps still hardlinked from weekly/monthly free nothing and are kept.
+    Args:
+        high (float) ratio of the partition used that triggers the purge, None to disable
+        low (float) ratio to go back under
+        minimum (int) daily dumps always kept per database
+    Returns:
+        deleted (list(str)) paths deleted
+        freed (int) bytes freed
+    """
+    deleted, freed = [], 0
+    if high is None:
+        return deleted, freed
+    usage = disk_usage(backup_root)
+    if usage.used / usage.total <= high:
+        return deleted, freed
+    queue = []
+    for server, name in iter_databases(backup_root):
+        database = Database(server, name, backup_root)
+        candidates = []
+        for dt in database.list_datetimes('daily')[:-minimum or None]:
+            stat = os.stat(database.dump_path('daily', dt))
+            if get_freed_size(stat):
+                candidates.append(dt)
+        if candidates:
+            heapq.heappush(queue, (-len(candidates), candidates[0], database.path, database, candidates))
+    while queue:
+        for _ in range(batch_size):
+            if not queue:
+                break
+            remaining, oldest, path, database, candidates = heapq.heappop(queue)
+            dump_path = database.dump_path('daily', candidates.pop(0))
+            try:
+                with database.lock():
+                    freed += database.remove('daily', oldest)
+                deleted.append(dump_path)
+            except (DatabaseLocked, FileNotFoundError):
+                pass
+            if candidates:
+                heapq.heappush(queue, (-len(candidates), candidates[0], path, database, candidates))
+        usage = disk_usage(backup_root)
+        if usage.used / usage.total <= low:
+            break
+    return deleted, freed
+
+
+def get_rotation_metrics(plans, failures, duration, purge_duration, purge_freed):
+    """
+    Args:
+        plans (list(RotationPlan)) executed plans
+        failures (list((str, str)))
+        duration (float) seconds taken by the rotation of the fleet
+        purge_duration (float) seconds taken by purge_for_space
+        purge_freed (int) bytes freed by purge_for_space
+    Returns:
+        metrics (list(Metric))
+    """
+    labels = [dict(server=plan.database.server, database=plan.database.name) for plan in plans]
+    return [
+        Metric('odoo_backup_rotation_last_run_timestamp_seconds', "End of the last rotation run", 'gauge', [({}, time.time())]),
+        Metric('odoo_backup_rotation_duration_seconds', "Duration of the rotation of the whole fleet", 'gauge', [({}, duration)]),
+        Metric('odoo_backup_rotation_failed_databases', "Databases whose rotation failed", 'gauge', [({}, len(failures))]),
+        Metric('odoo_backup_purge_duration_seconds', "Duration of the disk pressure purge", 'gauge', [({}, purge_duration)]),
+        Metric('odoo_backup_purge_freed_bytes', "Bytes freed by the disk pressure purge", 'gauge', [({}, purge_freed)]),
+        Metric('odoo_backup_database_rotation_duration_seconds', "Duration of the rotation of a database", 'gauge',
+               [(label, plan.duration) for label, plan in zip(labels, plans)]),
+        Metric('odoo_backup_database_written_bytes', "Bytes written by the promotions of the last rotation", 'gauge',
+               [(label, plan.bytes_written) for label, plan in zip(labels, plans)]),
+        Metric('odoo_backup_database_freed_bytes', "Bytes freed by the deletions of the last rotation", 'gauge',
+               [(label, plan.bytes_freed) for label, plan in zip(labels, plans)]),
+    ]
+
+
+def run_fleet(jobs=ROTATION_JOBS, backup_root=BACKUP_ROOT_PROD):
+    """Rotation, disk pressure purge and metrics of a whole run
+    Returns:
+        plans (list(RotationPlan))
+        failures (list((str, str)))
+        deleted (list(str)) daily dumps deleted by the disk pressure purge
+        freed (int) bytes freed by the disk pressure purge
+    """
+    start = time.monotonic()
+    plans, failures = rotate_fleet(jobs, backup_root=backup_root)
+    purge_start = time.monotonic()
+    deleted, freed = purge_for_space(backup_root=backup_root)
+    end = time.monotonic()
+    if METRICS_PATH:
+        write_textfile(
+            os.path.join(METRICS_PATH, 'odoo_rotation.prom'),
+            get_rotation_metrics(plans, failures, purge_start - start, end - purge_start, freed)
+        )
+    return plans, failures, deleted, freed
+
+
+class RotationDaemon:
+    """Rotate a database as soon as a daily dump is fully written in it
+
+    Watches <backup root>, every <server>, <server>/<database> and <server>/<database>/daily directory,
+    and runs a full rotation every reconcile_interval seconds for the events that were missed.
+    """
+    backup_root = BACKUP_ROOT_PROD
+    reconcile_interval = RECONCILE_INTERVAL
+    inotify = None
+    next_reconcile = None
+
+    def __init__(self, backup_root=BACKUP_ROOT_PROD, reconcile_interval=RECONCILE_INTERVAL):
+        self.backup_root = backup_root
+        self.reconcile_interval = reconcile_interval
+        self.inotify = Inotify()
+
+    def watch_tree(self):
+        """Adding a watch twice is harmless, so the whole tree is walked again when a directory appears"""
+        self.inotify.add_watch(self.backup_root, IN_CREATE | IN_MOVED_TO)
+        for server in os.listdir(self.backup_root):
+            if server.startswith('.') or not os.path.isdir(os.path.join(self.backup_root, server)):
+                continue
+            self.inotify.add_watch(os.path.join(self.backup_root, server), IN_CREATE | IN_MOVED_TO)
+        for server, name in iter_databases(self.backup_root):
+            database_path = os.path.join(self.backup_root, server, name)
+            self.inotify.add_watch(database_path, IN_CREATE | IN_MOVED_TO)
+            if os.path.isdir(os.path.join(database_path, 'daily')):
+                self.inotify.add_watch(os.path.join(database_path, 'daily'), IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    def reconcile(self):
+        plans, failures, deleted, freed = run_fleet(backup_root=self.backup_root)
+        for database, error in failures:
+            print("[{}] rotation failed\n{}".format(database, error), file=sys.stderr)
+        self.next_reconcile = time.monotonic() + self.reconcile_interval
+
+    def handle(self, path, mask, filename):
+        """
+        Returns:
+            plan (RotationPlan or None) the rotation triggered by the event
+        """
+        if mask & IN_Q_OVERFLOW:
+            self.reconcile()
+            return None
+        if mask & IN_ISDIR:
+            self.watch_tree()
+            return None
+        if not path or os.path.basename(path) != 'daily':
+            return None
+        try:
+            get_datetime_from_filename(filename)
+        except ValueError:
+            # Temporary upload name, the rename to the final name will come
+            return None
+        server, name = os.path.relpath(os.path.dirname(path), self.backup_root).split(os.sep)
+        try:
+            plan = rotate_database(server, name, backup_root=self.backup_root)
+        except Exception:
+            print("[{}/{}] rotation failed\n{}".format(server, name, traceback.format_exc()), file=sys.stderr)
+            return None
+        purge_for_space(backup_root=self.backup_root)
+        return plan
+
+    def run_once(self, timeout=None):
+        """Handle the pending events, waiting at most timeout seconds for them
+        Returns:
+            plans (list(RotationPlan))
+        """
+        plans = []
+        for path, mask, filename in self.inotify.read(timeout):
+            plan = self.handle(path, mask, filename)
+            if plan:
+                plans.append(plan)
+        return plans
+
+    def run(self):
+        self.watch_tree()
+        self.reconcile()
+        while True:
+            for plan in self.run_once(max(0, self.next_reconcile - time.monotonic())):
+                if plan.promotions or plan.deletions:
+                    print(plan.summary(), flush=True)
+            if time.monotonic() >= self.next_reconcile:
+                self.reconcile()
+
+
+def first_timestamp(timeline, minimum=None):
+    """First timestamp whose day is on or after minimum's day
+    Args:
+        timeline (array('q')) sorted
+        minimum (int or float) timestamp
+    Returns:
+        timestamp (int or None)
+    """
+    index = 0
+    if minimum is not None:
+        index = bisect.bisect_left(timeline, minimum - minimum % DAY)
+    return timeline[index] if index < len(timeline) else None
+
 
 if __name__ == "__main__":
-    for server in os.listdir(BACKUP_ROOT_PROD):
-        for name in os.listdir(os.path.join(BACKUP_ROOT_PROD, server)):
-            database = Database(server, name)
-            database.rotate()
-            database.purge()
+    parser = argparse.ArgumentParser(description="Rotate and purge the backups of every database")
+    parser.add_argument('--dry-run', action='store_true', help="print the rotation plan without touching the disk")
+    parser.add_argument('--jobs', type=int, default=ROTATION_JOBS, help="number of databases rotated at the same time")
+    parser.add_argument('--rebuild-catalog', action='store_true', help="rescan every database into its catalog and exit")
+    parser.add_argument('--daemon', action='store_true', help="keep running and rotate each database when a daily dump arrives")
+    args = parser.parse_args()
+    if args.daemon:
+        RotationDaemon().run()
+    if args.rebuild_catalog:
+        for server, name in iter_databases():
+            Database(server, name).catalog.rebuild()
+        sys.exit(0)
+    if args.dry_run:
+        plans, failures = rotate_fleet(args.jobs, dry_run=True)
+    else:
+        plans, failures, deleted, freed = run_fleet(args.jobs)
+    for plan in plans:
+        if args.dry_run:
+            print(plan)
+        elif plan.promotions or plan.deletions:
+            print(plan.summary())
+        if plan.malformed and not args.dry_run:
+            print("[{}/{}] skipped files that are not dumps: {}".format(
+                plan.database.server, plan.database.name, ", ".join(plan.malformed)
+            ), file=sys.stderr)
+    if not args.dry_run:
+        if deleted:
+            print("Disk pressure: {} daily dump(s) deleted".format(len(deleted)))
+        print("Total: {} bytes written, {} bytes freed".format(
+            sum(plan.bytes_written for plan in plans),
+            sum(plan.bytes_freed for plan in plans) + freed,
+        ))
+    for database, error in failures:
+        print("[{}] rotation failed\n{}".format(database, error), file=sys.stderr)
+    if failures:
+        print("{} database(s) failed: {}".format(len(failures), ", ".join(database for database, error in failures)), file=sys.stderr)
+        sys.exit(1)
 
 
 class FileRotationTest(unittest.TestCase):
@@ -192,6 +812,7 @@ class FileRotationTest(unittest.TestCase):
                 get_filename_from_datetime(self.now - datetime.timedelta(days=days))
             ), 'wb').close()
         self.assertEqual(self.database.last_weekly_datetime, self.now)
+        self.assertEqual(self.database.first_daily_datetime(self.now - datetime.timedelta(days=2)).date(), (self.now - datetime.timedelta(days=2)).date())
         shutil.rmtree(BACKUP_ROOT_TEST)
 
     def test_rotate_backups(self):
@@ -218,3 +839,162 @@ class FileRotationTest(unittest.TestCase):
         self.database.purge()
 
         self.assertEqual(len(os.listdir(self.database.weekly_path)), self.database.retention_policy.weeks)
+
+    def test_plan(self):
+        plan = self.database.plan()
+        self.assertEqual(len([tier for tier, dt in plan.promotions if tier == 'monthly']), 13)
+        self.assertEqual(len([tier for tier, dt in plan.promotions if tier == 'weekly']), 4)
+        self.assertEqual(len([tier for tier, dt in plan.deletions if tier == 'monthly']), 1)
+        # Planning never touches the disk
+        self.assertEqual(len(os.listdir(self.database.monthly_path)), 0)
+
+        self.database.execute(plan)
+        self.assertEqual(len(os.listdir(self.database.monthly_path)), 12)
+        self.assertEqual(len(os.listdir(self.database.weekly_path)), 4)
+        self.assertEqual(str(self.database.plan()), "localhost/Database1: 0 promotion(s), 0 deletion(s)")
+
+    def test_dry_run(self):
+        path = os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database15')
+        shutil.copytree(self.database.daily_path, os.path.join(path, 'daily'))
+        open(os.path.join(path, 'daily', 'corrupted'), 'wb').close()
+        plan = rotate_database('localhost', 'Database15', dry_run=True, backup_root=BACKUP_ROOT_TEST)
+        self.assertEqual(len([tier for tier, dt in plan.promotions if tier == 'weekly']), 4)
+        self.assertEqual(plan.malformed, ['daily/corrupted'])
+        # Neither the missing tiers nor the catalog are created
+        self.assertEqual(os.listdir(path), ['daily'])
+
+    def test_promotion_strategies(self):
+        source = os.path.join(self.database.daily_path, get_filename_from_datetime(self.now - datetime.timedelta(days=364)))
+        with open(source, 'wb') as file:
+            file.write(b'dump' * 1000)
+        for promotion in PROMOTION_STRATEGIES:
+            destination = os.path.join(self.database.path, promotion)
+            try:
+                written = PROMOTION_STRATEGIES[promotion](source, destination)
+            except OSError:
+                # reflink is unavailable on most test filesystems
+                self.assertEqual(promotion, 'reflink')
+                self.assertFalse(os.path.exists(destination))
+                continue
+            with open(destination, 'rb') as file:
+                self.assertEqual(file.read(), b'dump' * 1000)
+            self.assertEqual(written, 4000 if promotion == 'copy' else 0)
+
+        RETENTION_POLICIES['localhost/Database1'] = RetentionPolicy(weeks=4, months=12, promotion='copy')
+        try:
+            self.assertEqual(self.database.rotate(), 4000)
+        finally:
+            del RETENTION_POLICIES['localhost/Database1']
+
+    def test_rotate_fleet(self):
+        Database('localhost', 'Database3', BACKUP_ROOT_TEST)
+        open(os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database3', 'daily', 'corrupted'), 'wb').close()
+        broken = Database('localhost', 'Database8', BACKUP_ROOT_TEST)
+        os.rmdir(broken.weekly_path)
+        open(broken.weekly_path, 'wb').close()
+
+        with self.database.lock():
+            with self.assertRaises(DatabaseLocked):
+                with Database('localhost', 'Database1', BACKUP_ROOT_TEST).lock():
+                    pass
+            plans, failures = rotate_fleet(jobs=2, backup_root=BACKUP_ROOT_TEST)
+        self.assertEqual([database for database, error in failures], ['localhost/Database1', 'localhost/Database8'])
+
+        plans, failures = rotate_fleet(jobs=2, backup_root=BACKUP_ROOT_TEST)
+        self.assertEqual([plan.database.name for plan in plans], ['Database1', 'Database3'])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(len(os.listdir(self.database.weekly_path)), 4)
+        # Files that are not dumps are skipped and reported
+        self.assertEqual(plans[1].malformed, ['daily/corrupted'])
+
+    def test_parse_timestamp(self):
+        for dt in [self.now, datetime.datetime(2020, 2, 29, 23, 59, 59), datetime.datetime(2000, 1, 1), datetime.datetime(1969, 12, 31, 1, 2, 3)]:
+            self.assertEqual(parse_timestamp(get_filename_from_datetime(dt)), to_timestamp(dt))
+        self.assertEqual(parse_timestamp('2020_03_01_03_00_01.dump.manifest'), to_timestamp(datetime.datetime(2020, 3, 1, 3, 0, 1)))
+        for filename in ['2020_03_01_03_00_01.dump.zip.part', '2019_02_29_03_00_01.dump.zip', '2020_3_01_03_00_01.dump.zip',
+                         '2020_03_01_03_00_1_.dump.zip', '2020_03_01_24_00_01.dump.zip', 'corrupted']:
+            with self.assertRaises(ValueError):
+                parse_timestamp(filename)
+
+        self.assertEqual(self.database.count_older_than('daily', self.now - datetime.timedelta(days=10)), 354)
+        self.assertEqual(self.database.first_daily_datetime(self.now.date()), self.now)
+
+    def test_dedup_promotion(self):
+        for days in range(365):
+            with zipfile.ZipFile(self.database.dump_path('daily', self.now - datetime.timedelta(days=days)), 'w') as archive:
+                archive.writestr('dump.sql', 'day {}'.format(days))
+                archive.writestr('filestore/ab/abcdef', 'attachment')
+        RETENTION_POLICIES['localhost/Database1'] = RetentionPolicy(weeks=4, months=12, promotion='dedup')
+        try:
+            self.database.execute(self.database.plan())
+        finally:
+            del RETENTION_POLICIES['localhost/Database1']
+        self.assertEqual(len(os.listdir(self.database.weekly_path)), 4)
+        self.assertTrue(all(filename.endswith(MANIFEST_SUFFIX) for filename in os.listdir(self.database.monthly_path)))
+        self.assertEqual(self.database.last_weekly_datetime, self.now)
+        # 16 distinct dump.sql, the attachment is stored once for 16 manifests
+        logical, stored = ChunkStore(BACKUP_ROOT_TEST).stats()
+        self.assertEqual(logical, sum(len('day {}'.format(days)) for days in (
+            [0, 7, 14, 21] + [364 - 30 * months for months in range(1, 13)]
+        )) + 16 * len('attachment'))
+        self.assertEqual(sorted(iter_databases(BACKUP_ROOT_TEST)), [('localhost', 'Database1')])
+
+    def test_daily_retention(self):
+        RETENTION_POLICIES['localhost/Database1'] = RetentionPolicy(weeks=4, months=12, days=30)
+        try:
+            self.database.execute(self.database.plan())
+        finally:
+            del RETENTION_POLICIES['localhost/Database1']
+        self.assertEqual(len(os.listdir(self.database.daily_path)), 30)
+        self.assertEqual(len(os.listdir(self.database.monthly_path)), 12)
+
+    def test_purge_for_space(self):
+        other = Database('localhost', 'Database6', BACKUP_ROOT_TEST)
+        for days in range(10):
+            with open(other.dump_path('daily', self.now - datetime.timedelta(days=days)), 'wb') as file:
+                file.write(b'0' * 4096)
+        for days in range(365):
+            with open(self.database.dump_path('daily', self.now - datetime.timedelta(days=days)), 'wb') as file:
+                file.write(b'0' * 4096)
+        # Pretend each dump uses 1% of the partition
+        DiskUsage = collections.namedtuple('DiskUsage', ['total', 'used', 'free'])
+        def disk_usage(path):
+            used = sum(len(os.listdir(database.daily_path)) for database in (self.database, other))
+            return DiskUsage(100, used, 100 - used)
+
+        self.assertEqual(purge_for_space(high=None, disk_usage=disk_usage), ([], 0))
+        deleted, freed = purge_for_space(high=0.9, low=0.5, minimum=7, backup_root=BACKUP_ROOT_TEST, batch_size=5, disk_usage=disk_usage)
+        self.assertEqual(len(os.listdir(self.database.daily_path)) + len(os.listdir(other.daily_path)), 50)
+        # The database with the longest history is trimmed first, the oldest dumps go first
+        self.assertEqual(len(os.listdir(other.daily_path)), 10)
+        self.assertEqual(self.database.first_daily_datetime(), self.now - datetime.timedelta(days=39))
+        self.assertEqual(freed, len(deleted) * 4096)
+
+    def test_daemon(self):
+        daemon = RotationDaemon(BACKUP_ROOT_TEST)
+        try:
+            daemon.watch_tree()
+            self.assertEqual(daemon.run_once(0), [])
+            # A new database appears, then its first complete upload
+            other = Database('localhost', 'Database7', BACKUP_ROOT_TEST)
+            self.assertEqual(daemon.run_once(1), [])
+            daemon.watch_tree()
+            upload = os.path.join(self.database.daily_path, 'upload.tmp')
+            with open(upload, 'wb') as file:
+                file.write(b'dump')
+            os.rename(upload, self.database.dump_path('daily', self.now + datetime.timedelta(hours=1)))
+            with open(other.dump_path('daily', self.now), 'wb') as file:
+                file.write(b'dump')
+            plans = daemon.run_once(1)
+            self.assertEqual([plan.database.name for plan in plans], ['Database1', 'Database7'])
+            self.assertEqual(len(os.listdir(self.database.monthly_path)), 12)
+            self.assertEqual(len(os.listdir(other.monthly_path)), 1)
+        finally:
+            daemon.inotify.close()
+
+    def test_rotation_metrics(self):
+        plans, failures, deleted, freed = run_fleet(backup_root=BACKUP_ROOT_TEST)
+        metrics = {metric.name: metric for metric in get_rotation_metrics(plans, failures, 1.5, 0.5, freed)}
+        self.assertEqual(metrics['odoo_backup_rotation_duration_seconds'].samples, [({}, 1.5)])
+        self.assertEqual(metrics['odoo_backup_database_written_bytes'].samples, [({'server': 'localhost', 'database': 'Database1'}, 0)])
+        self.assertGreater(metrics['odoo_backup_database_rotation_duration_seconds'].samples[0][1], 0)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import select
+import shutil
+import ctypes
+import ctypes.util
+import unittest
+
+from conf import BACKUP_ROOT_TEST
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API"""
+    fd = None
+    watches = None
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = dict()
+
+    def add_watch(self, path, mask):
+        """Watching the same path again returns the same descriptor
+        Returns:
+            wd (int)
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """
+        Args:
+            timeout (float) seconds to wait for the first event, None waits forever
+        Returns:
+            events (list((str, int, str))) watched path, mask and name of the file
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class InotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(BACKUP_ROOT_TEST, 'inotify')
+        os.makedirs(self.path, exist_ok=True)
+        self.inotify = Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_events(self):
+        self.inotify.add_watch(self.path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        self.assertEqual(self.inotify.read(0), [])
+        with open(os.path.join(self.path, 'partial'), 'wb') as file:
+            file.write(b'dump')
+        os.rename(os.path.join(self.path, 'partial'), os.path.join(self.path, 'dump.zip'))
+        os.mkdir(os.path.join(self.path, 'daily'))
+        events = [(path, mask & ~IN_ISDIR, name) for path, mask, name in self.inotify.read(1)]
+        self.assertEqual(events, [
+            (self.path, IN_CREATE, 'partial'),
+            (self.path, IN_CLOSE_WRITE, 'partial'),
+            (self.path, IN_MOVED_TO, 'dump.zip'),
+            (self.path, IN_CREATE, 'daily'),
+        ])
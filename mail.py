@@ -1,11 +1,180 @@
 # -*- coding: utf-8 -*-
 import datetime
 import os
+import ssl
+import json
+import time
+import shutil
 import smtplib
+import tempfile
+import unittest
+import threading
+import socketserver
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
 
-from conf import BACKUP_ROOT_PROD, SERVER_NAME, SENDER_EMAIL, SMTP_SERVER, EMAILS
+from conf import BACKUP_ROOT_PROD, SERVER_NAME, SENDER_EMAIL, SMTP_SERVER, SMTP_REQUIRE_TLS, EMAILS, STATE_PATH
+from render import get_css
+
+
+SMTP_TIMEOUT = 30
+OUTBOX_BACKOFF = 600
+## Seconds before the first retry of a message of the outbox, doubled after each failure...
+OUTBOX_MAX_BACKOFF = 6 * 3600
+## ...up to this delay
+OUTBOX_MAX_AGE = 7 * 24 * 3600
+## Messages still not delivered after this are dropped
+
+
+class Mailer:
+    """Delivery through SMTP_SERVER, messages which can't be sent are kept in STATE_PATH/outbox"""
+    server = None
+    port = None
+    outbox_path = None
+    require_tls = False
+
+    def __init__(self, server=SMTP_SERVER, port=None, outbox_path=os.path.join(STATE_PATH, 'outbox'), require_tls=SMTP_REQUIRE_TLS):
+        """
+        Args:
+            server (str) host or host:port
+            port (int) None to read it from server, 25 by default
+            require_tls (bool) never fall back to plaintext when STARTTLS fails
+        """
+        if port is None:
+            host, _, number = server.rpartition(':')
+            if host and ':' not in host and number.isdigit():
+                # Passed whole, smtplib would also check the certificate against "host:port"
+                server, port = host, int(number)
+            else:
+                port = smtplib.SMTP_PORT
+        self.server = server
+        self.port = port
+        self.outbox_path = outbox_path
+        self.require_tls = require_tls
+
+    def connect(self, starttls=True):
+        client = smtplib.SMTP(self.server, self.port, timeout=SMTP_TIMEOUT)
+        client.ehlo()
+        if starttls and client.has_extn('starttls'):
+            try:
+                client.starttls(context=ssl.create_default_context())
+            except (OSError, smtplib.SMTPException) as e:
+                client.close()
+                if self.require_tls:
+                    raise
+                # Relays with a self-signed or mismatched certificate were reached in plaintext before STARTTLS
+                print("[mail] STARTTLS with {} failed ({}), sent without TLS".format(self.server, e))
+                return self.connect(starttls=False)
+            client.ehlo()
+        return client
+
+    def send(self, data, recipients, sender=SENDER_EMAIL):
+        """The messages of the outbox due for a retry are sent first, on the same connection
+        Args:
+            data (bytes) message rendered once for all recipients
+            recipients (list(str))
+        Returns:
+            sent (bool) False if the message was put in the outbox
+        """
+        now = time.time()
+        try:
+            with self.connect() as client:
+                self.flush(client, now)
+                client.sendmail(sender, recipients, data)
+        except (OSError, smtplib.SMTPException) as e:
+            print("[mail] {}, message kept in {}".format(e, self.outbox_path))
+            # The messages of the outbox which were due failed too
+            self.postpone(self.get_due(now), now)
+            self.spool(data, recipients, sender, now=now)
+            return False
+        return True
+
+    def spool(self, data, recipients, sender, now, attempts=1, created=None, name=None):
+        os.makedirs(self.outbox_path, exist_ok=True)
+        name = name or "{:.6f}".format(now)
+        delay = min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+        if not os.path.exists(os.path.join(self.outbox_path, name + '.eml')):
+            with open(os.path.join(self.outbox_path, name + '.eml'), 'wb') as file:
+                file.write(data)
+        with tempfile.NamedTemporaryFile('w', dir=self.outbox_path, prefix='.', suffix='.tmp', delete=False) as tmp:
+            json.dump(dict(sender=sender, recipients=recipients, attempts=attempts,
+                           created=created or now, retry=now + delay), tmp)
+        os.replace(tmp.name, os.path.join(self.outbox_path, name + '.json'))
+
+    def get_outbox(self):
+        """
+        Returns:
+            messages (list((str, dict))) name and metadata, oldest first
+        """
+        try:
+            names = sorted(filename[:-len('.json')] for filename in os.listdir(self.outbox_path) if filename.endswith('.json'))
+        except FileNotFoundError:
+            return []
+        messages = []
+        for name in names:
+            with open(os.path.join(self.outbox_path, name + '.json')) as file:
+                messages.append((name, json.load(file)))
+        return messages
+
+    def remove(self, name):
+        os.remove(os.path.join(self.outbox_path, name + '.json'))
+        os.remove(os.path.join(self.outbox_path, name + '.eml'))
+
+    def get_due(self, now):
+        """Messages of the outbox whose backoff is over, the ones older than OUTBOX_MAX_AGE are dropped
+        Returns:
+            messages (list((str, dict))) name and metadata, oldest first
+        """
+        due = []
+        for name, meta in self.get_outbox():
+            if now - meta['created'] > OUTBOX_MAX_AGE:
+                print("[mail] {} dropped after {} attempts".format(name, meta['attempts']))
+                self.remove(name)
+            elif meta['retry'] <= now:
+                due.append((name, meta))
+        return due
+
+    def postpone(self, messages, now):
+        """Count a failed attempt for each message, which doubles its backoff"""
+        for name, meta in messages:
+            with open(os.path.join(self.outbox_path, name + '.eml'), 'rb') as file:
+                data = file.read()
+            self.spool(data, meta['recipients'], meta['sender'], now, meta['attempts'] + 1, meta['created'], name)
+
+    def flush(self, client=None, now=None):
+        """Retry the messages of the outbox whose backoff is over
+        Args:
+            client (smtplib.SMTP) connection to reuse, a new one is opened if needed
+        Returns:
+            sent (int)
+        """
+        now = now or time.time()
+        due = self.get_due(now)
+        if not due:
+            return 0
+        if client is None:
+            try:
+                client = self.connect()
+            except (OSError, smtplib.SMTPException) as e:
+                print("[mail] {}, {} message(s) kept in {}".format(e, len(due), self.outbox_path))
+                self.postpone(due, now)
+                return 0
+            with client:
+                return self.flush(client, now)
+        sent = 0
+        for name, meta in due:
+            with open(os.path.join(self.outbox_path, name + '.eml'), 'rb') as file:
+                data = file.read()
+            try:
+                client.sendmail(meta['sender'], meta['recipients'], data)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                print("[mail] {} refused: {}".format(name, e))
+                self.spool(data, meta['recipients'], meta['sender'], now, meta['attempts'] + 1, meta['created'], name)
+                continue
+            self.remove(name)
+            sent += 1
+        return sent
 
 
 class Email(MIMEMultipart):
@@ -13,7 +182,7 @@ class Email(MIMEMultipart):
     title = None
 
     def __init__(self, backup_root=BACKUP_ROOT_PROD):
-        super().__init__("alternative")
+        super().__init__("mixed")
         self.backup_root = backup_root
         self.timestamp = datetime.datetime.now().replace(microsecond=0)
         self['Subject'] = "{server} : {title} - {date}".format(
@@ -23,12 +192,13 @@ class Email(MIMEMultipart):
         )
         self['From'] = SENDER_EMAIL
 
-    def send(self):
-        client = smtplib.SMTP(SMTP_SERVER)
-        for email in EMAILS:
-            self['To'] = email
-            client.sendmail(SENDER_EMAIL, email, self.as_string())
-        client.close()
+    def send(self, mailer=None):
+        """One message for all EMAILS, kept in the outbox if the SMTP server is unreachable
+        Returns:
+            sent (bool)
+        """
+        self['To'] = ", ".join(EMAILS)
+        return (mailer or Mailer()).send(self.as_bytes(), EMAILS)
 
     def create_html(self, body):
         """Encapsulate body in valid html with style
@@ -37,12 +207,7 @@ class Email(MIMEMultipart):
         Returns:
             html (str)
         """
-        css_file = open(os.path.join(
-            os.path.abspath(os.path.dirname(__file__)),
-            "mail.css"
-        ), "r")
-        html = "<html><body><style>" + css_file.read() + "</style>" + body + "</body></html>"
-        return html
+        return "".join(["<html><body><style>", get_css(), "</style>", body, "</body></html>"])
 
     def attach_all(self, body, plain):
         """
@@ -50,9 +215,119 @@ class Email(MIMEMultipart):
             body (str)
             plain (str)
         """
-        html = self.create_html(body)
-        html = MIMEText(html, 'html')
-        plain = MIMEText(plain, 'plain')
+        alternative = MIMEMultipart("alternative")
+        alternative.attach(MIMEText(plain, 'plain'))
+        alternative.attach(MIMEText(self.create_html(body), 'html'))
+        self.attach(alternative)
+
+    def attach_section(self, section):
+        """
+        Args:
+            section (render.Section)
+        """
+        self.attach_all(section.body, section.plain)
+        for filename, data in section.attachments:
+            attachment = MIMEApplication(data, 'csv')
+            attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+            self.attach(attachment)
+
+
+if __name__ == "__main__":
+    print("{} message(s) sent from the outbox".format(Mailer().flush()))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of SMTP to test the delivery, messages are appended to server.messages"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').rstrip("\r\n")
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO') and getattr(self.server, 'starttls', False):
+                # Advertised, but the TLS handshake then fails like with an invalid certificate
+                self.reply("250-localhost")
+                self.reply("250 STARTTLS")
+            elif command in ('EHLO', 'HELO'):
+                self.reply("250 localhost")
+            elif command == 'STAR':
+                self.reply("220 Ready to start TLS")
+                return
+            elif command == 'MAIL':
+                sender, recipients = line[10:].strip('<>'), []
+                self.reply("250 OK")
+            elif command == 'RCPT':
+                recipients.append(line[8:].strip('<>'))
+                self.reply("250 OK")
+            elif command == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data in iter(self.rfile.readline, b".\r\n"):
+                    lines.append(data)
+                self.server.messages.append((sender, recipients, b"".join(lines)))
+                self.reply("250 OK")
+            elif command == 'QUIT' or not line:
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class MailerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.outbox_path = tempfile.mkdtemp()
+        self.mailer = Mailer('127.0.0.1', self.server.server_address[1], self.outbox_path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.outbox_path)
+
+    def test_send(self):
+        email = Email()
+        email.attach_all("<p>body</p>", "body")
+        self.assertTrue(email.send(self.mailer))
+        (sender, recipients, data), = self.server.messages
+        self.assertEqual((sender, recipients), (SENDER_EMAIL, EMAILS))
+        self.assertIn("To: {}".format(", ".join(EMAILS)).encode(), data)
+
+    def test_outbox(self):
+        down = Mailer('127.0.0.1', 1, self.outbox_path)
+        self.assertFalse(down.send(b"Subject: first\r\n\r\nbody\r\n", ['a@example.com']))
+        (name, meta), = self.mailer.get_outbox()
+        self.assertEqual((meta['attempts'], meta['retry'] - meta['created']), (1, OUTBOX_BACKOFF))
+
+        # Not due yet: only the new message is sent
+        self.assertTrue(self.mailer.send(b"Subject: second\r\n\r\nbody\r\n", ['b@example.com']))
+        self.assertEqual([recipients for sender, recipients, data in self.server.messages], [['b@example.com']])
+
+        # Relay down when the cron retries: the backoff doubles
+        self.assertEqual(down.flush(now=meta['retry']), 0)
+        (name, retried), = self.mailer.get_outbox()
+        self.assertEqual((retried['attempts'], retried['retry'] - meta['retry']), (2, 2 * OUTBOX_BACKOFF))
+
+        self.assertEqual(self.mailer.flush(now=retried['retry']), 1)
+        self.assertEqual(self.server.messages[-1][1], ['a@example.com'])
+        self.assertEqual(self.mailer.get_outbox(), [])
+
+    def test_server_port(self):
+        # SMTP_SERVER may be host:port
+        mailer = Mailer('127.0.0.1:{}'.format(self.server.server_address[1]), outbox_path=self.outbox_path)
+        self.assertEqual((mailer.server, mailer.port), ('127.0.0.1', self.server.server_address[1]))
+        self.assertTrue(mailer.send(b"Subject: port\r\n\r\nbody\r\n", ['a@example.com']))
+        self.assertEqual(Mailer('mail.example.com').port, 25)
 
-        self.attach(plain)
-        self.attach(html)
+    def test_starttls_failure(self):
+        self.server.starttls = True
+        self.assertTrue(self.mailer.send(b"Subject: plain\r\n\r\nbody\r\n", ['a@example.com']))
+        self.assertEqual(len(self.server.messages), 1)
+        strict = Mailer('127.0.0.1', self.server.server_address[1], self.outbox_path, require_tls=True)
+        self.assertFalse(strict.send(b"Subject: strict\r\n\r\nbody\r\n", ['a@example.com']))
+        self.assertEqual(len(self.server.messages), 1)
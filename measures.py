@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f %s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+def linear_fit(points):
+    """Least squares slope
+    Args:
+        points (list((float, float)))
+    Returns:
+        slope (float) 0 if every x is the same
+    """
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    if not variance:
+        return 0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+class MeasuresTest(unittest.TestCase):
+    def test_sizeof_fmt(self):
+        self.assertEqual(sizeof_fmt(512), "512.0 B")
+        self.assertEqual(sizeof_fmt(3 * 1024 ** 3), "3.0 GiB")
+
+    def test_linear_fit(self):
+        self.assertEqual(linear_fit([(0, 1), (1, 3), (2, 5)]), 2)
+        self.assertEqual(linear_fit([(1, 1), (1, 3)]), 0)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import datetime
+import argparse
+import unittest
+
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST, METRICS_PATH
+from prometheus import Metric, write_textfile
+from file_rotation import Database, iter_databases
+from monitoring import MODULES
+
+
+TIERS = ('daily', 'weekly', 'monthly')
+
+
+def get_backup_metrics(backup_root=BACKUP_ROOT_PROD, now=None):
+    """Freshness, count and size of the dumps of every database, read from the catalogs
+    Returns:
+        metrics (list(Metric))
+    """
+    now = now or datetime.datetime.now()
+    age, count, size, last_size, malformed = [], [], [], [], []
+    for server, name in iter_databases(backup_root):
+        database = Database(server, name, backup_root, create=False)
+        for tier in TIERS:
+            labels = dict(server=server, database=name, tier=tier)
+            entries = database.entries(tier)
+            count.append((labels, len(entries)))
+            size.append((labels, sum(entry_size for dt, entry_size, mtime_ns in entries)))
+            if entries:
+                dt, entry_size, mtime_ns = entries[-1]
+                age.append((labels, (now - dt).total_seconds()))
+                last_size.append((labels, entry_size))
+        malformed.append((dict(server=server, database=name), len(database.malformed_filenames())))
+    return [
+        Metric('odoo_backup_age_seconds', "Age of the last dump of the tier", 'gauge', age),
+        Metric('odoo_backup_count', "Number of dumps in the tier", 'gauge', count),
+        Metric('odoo_backup_size_bytes', "Total size of the dumps of the tier", 'gauge', size),
+        Metric('odoo_backup_last_size_bytes', "Size of the last dump of the tier", 'gauge', last_size),
+        Metric('odoo_backup_malformed_files', "Files of the tiers that are not dumps", 'gauge', malformed),
+    ]
+
+def get_module_metrics():
+    metrics = []
+    for module in MODULES:
+        if sys.platform in module.platforms:
+            metrics += module.get_metrics()
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the metrics of the backups and monitoring modules for node_exporter")
+    parser.add_argument('--output', default=METRICS_PATH and os.path.join(METRICS_PATH, 'odoo_scripts.prom'),
+                        help="textfile written atomically, in the directory of the node_exporter textfile collector")
+    args = parser.parse_args()
+    if not args.output:
+        parser.error("METRICS_PATH is not configured in conf.py, use --output")
+    metrics = get_module_metrics()
+    if os.path.isdir(BACKUP_ROOT_PROD):
+        metrics += get_backup_metrics()
+    write_textfile(args.output, metrics)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.database = Database('localhost', 'Database10', BACKUP_ROOT_TEST)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_get_backup_metrics(self):
+        for days in range(3):
+            with open(self.database.dump_path('daily', self.now - datetime.timedelta(days=days)), 'wb') as file:
+                file.write(b'0' * (days + 1))
+        metrics = {metric.name: metric for metric in get_backup_metrics(BACKUP_ROOT_TEST, now=self.now + datetime.timedelta(hours=1))}
+        daily = dict(server='localhost', database='Database10', tier='daily')
+        self.assertEqual(metrics['odoo_backup_age_seconds'].samples, [(daily, 3600)])
+        self.assertEqual(metrics['odoo_backup_count'].samples[0], (daily, 3))
+        self.assertEqual(metrics['odoo_backup_count'].samples[1][1], 0)
+        self.assertEqual(metrics['odoo_backup_size_bytes'].samples[0], (daily, 6))
+        self.assertEqual(metrics['odoo_backup_last_size_bytes'].samples, [(daily, 1)])
@@ -4,83 +4,226 @@ import unittest
 import os
 import sys
 import re
-from operator import itemgetter
+import gzip
+import math
+import json
+import time
+import tempfile
+import threading
+import html
+import heapq
+import struct
+import argparse
+import collections
 try:
     import apt
+    import apt_pkg
 except ImportError:
-    apt = None
+    apt = apt_pkg = None
 
 from mail import Email
-from conf import BACKUP_ROOT_PROD, DISK_PARTITIONS, LOG_PATH
+from prometheus import Metric
+from render import Section, render_table, join_sections
+from measures import sizeof_fmt, linear_fit
+from conf import BACKUP_ROOT_PROD, DISK_PARTITIONS, LOG_PATH, STATE_PATH, SERVER_NAME, REPORT_COLLECTOR
+import spool
 
 
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f %s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+MODULE_TIMEOUT = 300
+## Seconds after which a module still running is reported as unavailable
+
+ModuleResult = collections.namedtuple('ModuleResult', ['module', 'data', 'error', 'duration'])
+
+DISK_SAMPLE = struct.Struct('<qqq')
+## timestamp, free bytes, free inodes
+
+
+def load_state(name, state_path=STATE_PATH):
+    """
+    Args:
+        name (str) file name in state_path
+    Returns:
+        state (object or None) None if the state was never saved or is unreadable
+    """
+    try:
+        with open(os.path.join(state_path, name)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_state(name, state, state_path=STATE_PATH):
+    """Atomic write, the state survives an interrupted run"""
+    os.makedirs(state_path, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=state_path, prefix='.', suffix='.tmp', delete=False) as tmp:
+        json.dump(state, tmp)
+    os.replace(tmp.name, os.path.join(state_path, name))
 
 class Module:
     title = None
     headers = None
     platforms = ['linux', 'darwin']
+    timeout = None
+    ## Overrides MODULE_TIMEOUT
 
     @classmethod
     def make_table(cls, data):
         """
         Args:
-            data (list(list(str))) Each line must be the same len as headers
+            data (iterable(list(str))) Each line must be the same len as headers
         Returns:
-            body (str)
-            plain (str)
-        """
-        body = "<h1>{}</h1>".format(cls.title)
-        plain = cls.title + '\n' + '='*len(cls.title) + '\n'
-        body += "<table><thead><tr>"
-        for header in cls.headers:
-            body += "<th>{}</th>".format(header)
-            plain += header + ", "
-        body += "</tr></thead><tbody>"
-        plain += "\n"
-        for line in data:
-            assert len(line) == len(cls.headers)
-            body += "<tr>"
-            for item in line:
-                body += "<td>{}</td>".format(item)
-                plain += str(item) + ", "
-            body += "</tr>"
-            plain += "\n"
-        body += "</tbody></table>"
-        plain += "\n"
-        return body, plain
+            section (render.Section)
+        """
+        return render_table(cls.title, cls.headers, data)
+
+    @classmethod
+    def make_degraded(cls, error):
+        """Section shown instead of the table when the module failed or timed out"""
+        body = "<h1>{}</h1><p>Module indisponible : {}</p>".format(html.escape(cls.title), html.escape(error))
+        plain = cls.title + '\n' + '='*len(cls.title) + '\n' + "Module indisponible : {}\n\n".format(error)
+        return Section(body, plain, [])
 
     @staticmethod
     def get_data():
         raise NotImplementedError
 
+    @staticmethod
+    def get_metrics():
+        """Raw values for the Prometheus exporter, only for modules cheap enough to run every few minutes
+        Returns:
+            metrics (list(prometheus.Metric))
+        """
+        return []
+
+class DiskHistory:
+    """Append-only file of DISK_SAMPLE records of a partition, in STATE_PATH/disk-<partition>.bin"""
+    capacity = 4 * 24 * 30
+    ## 30 days of samples every 15 minutes, the file is compacted when it holds twice as many
+    path = None
+
+    def __init__(self, partition, state_path=STATE_PATH):
+        name = partition.strip('/').replace('/', '_') or 'root'
+        self.path = os.path.join(state_path, 'disk-{}.bin'.format(name))
+
+    def read(self):
+        """Only the last capacity records are read
+        Returns:
+            samples (list((int, int, int))) timestamp, free bytes and free inodes, oldest first
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                count = os.fstat(file.fileno()).st_size // DISK_SAMPLE.size
+                file.seek(max(0, count - self.capacity) * DISK_SAMPLE.size)
+                data = file.read()
+        except FileNotFoundError:
+            return []
+        return list(DISK_SAMPLE.iter_unpack(data[:len(data) - len(data) % DISK_SAMPLE.size]))
+
+    def append(self, sample):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab') as file:
+            file.write(DISK_SAMPLE.pack(*sample))
+            size = file.tell()
+        if size > 2 * self.capacity * DISK_SAMPLE.size:
+            samples = self.read()
+            with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(self.path), prefix='.', suffix='.tmp', delete=False) as tmp:
+                tmp.write(b''.join(DISK_SAMPLE.pack(*sample) for sample in samples))
+            os.replace(tmp.name, self.path)
+
+
 class DiskModule(Module):
     title = 'Espace disque'
-    headers = ['Partition', 'Used', 'Total', 'Percent']
+    headers = ['Partition', 'Used', 'Total', 'Percent', 'Plein dans']
+    state_path = STATE_PATH
+    FORECAST_DAYS = 14
+    ## Samples of the last FORECAST_DAYS are used for the trend
+
+    @staticmethod
+    def get_partitions():
+        """DISK_PARTITIONS and the backup root, one path per filesystem
+        Returns:
+            partitions (list(str))
+        """
+        partitions, devices = [], set()
+        for part in DISK_PARTITIONS + [BACKUP_ROOT_PROD]:
+            try:
+                device = os.stat(part).st_dev
+            except FileNotFoundError:
+                continue
+            if device not in devices:
+                devices.add(device)
+                partitions.append(part)
+        return partitions
+
+    @staticmethod
+    def sample(partitions=None, now=None):
+        """Cheap enough to run every few minutes, see monitoring.py --sample"""
+        now = int(now or time.time())
+        for part in partitions or DiskModule.get_partitions():
+            stat = os.statvfs(part)
+            DiskHistory(part, DiskModule.state_path).append((now, stat.f_bavail * stat.f_frsize, stat.f_favail))
+
+    @staticmethod
+    def get_days_to_full(samples, now=None):
+        """
+        Args:
+            samples (list((int, int, int))) timestamp, free bytes and free inodes, oldest first
+        Returns:
+            days (float or None) until the free bytes or inodes run out at the current trend, None if they don't decrease
+            resource (str) 'octets' or 'inodes'
+        """
+        now = now or time.time()
+        samples = [sample for sample in samples if sample[0] >= now - DiskModule.FORECAST_DAYS * 86400]
+        if len(samples) < 2 or samples[-1][0] - samples[0][0] < 3600:
+            return None, None
+        forecasts = []
+        for index, resource in [(1, 'octets'), (2, 'inodes')]:
+            slope = linear_fit([(sample[0] / 86400, sample[index]) for sample in samples])
+            if slope < 0:
+                forecasts.append((samples[-1][index] / -slope, resource))
+        return min(forecasts) if forecasts else (None, None)
+
+    @staticmethod
+    def format_days_to_full(days, resource):
+        if days is None:
+            return "stable"
+        label = "> 1 an" if days > 365 else "{:.0f} jours".format(days)
+        return label if resource == 'octets' else "{} ({})".format(label, resource)
+
+    @staticmethod
+    def get_metrics():
+        used, total = [], []
+        for part in DISK_PARTITIONS:
+            disk_usage = shutil.disk_usage(part)
+            used.append(({'partition': part}, disk_usage.used))
+            total.append(({'partition': part}, disk_usage.total))
+        return [
+            Metric('odoo_disk_used_bytes', "Used space of the partition", 'gauge', used),
+            Metric('odoo_disk_total_bytes', "Size of the partition", 'gauge', total),
+        ]
 
     @staticmethod
     def get_data():
         data = []
         used = 0
-        for part in DISK_PARTITIONS:
+        total = 0
+        for part in DiskModule.get_partitions():
             disk_usage = shutil.disk_usage(part)
             used += disk_usage.used
+            total += disk_usage.total
+            samples = DiskHistory(part, DiskModule.state_path).read()
             data.append([
                 part,
                 sizeof_fmt(disk_usage.used),
-                '',
-                "{:.2%}".format(disk_usage.used / disk_usage.total)
+                sizeof_fmt(disk_usage.total),
+                "{:.2%}".format(disk_usage.used / disk_usage.total),
+                DiskModule.format_days_to_full(*DiskModule.get_days_to_full(samples)) if samples else "",
             ])
         data.append([
             'TOTAL',
             sizeof_fmt(used),
-            sizeof_fmt(disk_usage.total),
-            "{:.2%}".format(used / disk_usage.total)
+            sizeof_fmt(total),
+            "{:.2%}".format(used / total),
+            '',
         ])
         return data
 
@@ -88,88 +231,477 @@ class AptModule(Module):
     title = 'Mises à jour'
     headers = ['Nom', 'Installé', 'Disponible']
     platforms = ['linux']
+    lists_path = '/var/lib/apt/lists'
+    update_stamp = '/var/lib/apt/periodic/update-success-stamp'
+    dpkg_status = '/var/lib/dpkg/status'
+    state_path = STATE_PATH
+    LISTS_MAX_AGE = 24 * 3600
+    ## Package lists refreshed by unattended-upgrades more recently than this are not updated again
+    SECURITY_SUFFIX = '-security'
+    lock = threading.Lock()
+
+    @classmethod
+    def get_lists_mtime(cls):
+        """Changes only when a list is downloaded again, this is the Last-Modified date of the mirror
+        Returns:
+            mtime (float) of the most recently downloaded package list, 0 if there is none
+        """
+        try:
+            return max((entry.stat().st_mtime for entry in os.scandir(cls.lists_path)
+                        if entry.name.endswith('_Packages') and entry.is_file()), default=0)
+        except FileNotFoundError:
+            return 0
+
+    @classmethod
+    def get_update_time(cls):
+        """
+        Returns:
+            mtime (float) of the last successful apt update, touched by apt even when the lists did not change
+        """
+        try:
+            return os.stat(cls.update_stamp).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    @classmethod
+    def update_lists(cls):
+        apt.Cache().update()
+        # Like APT::Update::Post-Invoke-Success in /etc/apt/apt.conf.d/15update-stamp
+        os.makedirs(os.path.dirname(cls.update_stamp), exist_ok=True)
+        with open(cls.update_stamp, 'a'):
+            os.utime(cls.update_stamp)
+
+    @staticmethod
+    def read_inventory():
+        """Walk the depcache in C, only installed packages are looked up further
+        Returns:
+            upgrades (list((str, str, str, bool))) name, installed version, candidate version, security
+        """
+        apt_pkg.init()
+        cache = apt_pkg.Cache(None)
+        depcache = apt_pkg.DepCache(cache)
+        upgrades = []
+        for pkg in cache.packages:
+            if pkg.current_ver is None or not depcache.is_upgradable(pkg):
+                continue
+            candidate = depcache.get_candidate_ver(pkg)
+            security = any(package_file.archive.endswith(AptModule.SECURITY_SUFFIX)
+                           for package_file, index in candidate.file_list)
+            upgrades.append((pkg.name, pkg.current_ver.ver_str, candidate.ver_str, security))
+        return sorted(upgrades)
+
+    @classmethod
+    def get_upgrades(cls):
+        """The inventory is saved with the mtimes of the dpkg status and package lists, it is only read
+        again after an install or a lists update. Shared by AptModule and AptSecurityModule.
+        Returns:
+            upgrades (list((str, str, str, bool))) name, installed version, candidate version, security
+        """
+        with cls.lock:
+            if time.time() - cls.get_update_time() > cls.LISTS_MAX_AGE:
+                cls.update_lists()
+            key = [os.stat(cls.dpkg_status).st_mtime_ns, cls.get_lists_mtime()]
+            state = load_state('apt.json', cls.state_path)
+            if state and state['key'] == key:
+                return [tuple(upgrade) for upgrade in state['upgrades']]
+            upgrades = cls.read_inventory()
+            save_state('apt.json', dict(key=key, upgrades=upgrades), cls.state_path)
+            return upgrades
+
+    @classmethod
+    def get_data(cls):
+        return [[name, installed, candidate] for name, installed, candidate, security in cls.get_upgrades() if not security]
+
+
+class AptSecurityModule(Module):
+    title = 'Mises à jour de sécurité'
+    headers = AptModule.headers
+    platforms = AptModule.platforms
 
     @staticmethod
     def get_data():
-        data = []
-        cache = apt.Cache()
-        cache.update()
-        for pkg in cache:
-            if pkg.is_upgradable:
-                data.append([pkg.name, pkg.installed, pkg.candidate])
-        return data
+        return [[name, installed, candidate] for name, installed, candidate, security in AptModule.get_upgrades() if security]
+
+
+LOG_FAMILY = re.compile(r"(.*).log(\.[0-9])?(\.gz)?(\.bz2)?")
 
 
 class LogModule(Module):
     title = 'Fichiers logs'
-    headers = ['Nom', 'Nombre de fichiers', 'Taille']
+    headers = ['Nom', 'Nombre de fichiers', 'Taille', 'Croissance']
     log_path = LOG_PATH
+    state_path = STATE_PATH
     MAX_ENTRIES = 10
     MIN_SIZE = 1000
+    SCAN_TIME_LIMIT = 10
+    ## Seconds, a runaway directory (journal, crash dumps) leaves the scan incomplete instead of blocking the report
 
     @staticmethod
     def get_base_name(filename):
-        reg = r"(.*).log(\.[0-9])?(\.gz)?(\.bz2)?"
-        result = re.match(reg, filename)
+        result = LOG_FAMILY.match(filename)
         return result and result.groups()[0]
 
+    @staticmethod
+    def scan_logs(log_path, time_limit=None):
+        """Walk log_path recursively, each file is stat'ed once through its DirEntry. Files of a
+        subdirectory are named after it (odoo/odoo-server), files which are not logs are grouped by directory.
+        Args:
+            time_limit (float) seconds
+        Returns:
+            logs (dict(str -> dict)) total_size and file_number by log family
+            complete (bool) False if the time limit was reached
+        """
+        deadline = time_limit and time.monotonic() + time_limit
+        logs = collections.defaultdict(lambda: dict(total_size=0, file_number=0))
+        directories = ['']
+        while directories:
+            relative = directories.pop()
+            try:
+                entries = os.scandir(os.path.join(log_path, relative))
+            except (PermissionError, FileNotFoundError):
+                continue
+            with entries:
+                for count, entry in enumerate(entries):
+                    if deadline and not count % 256 and time.monotonic() > deadline:
+                        return dict(logs), False
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(os.path.join(relative, entry.name))
+                    elif entry.is_file(follow_symlinks=False):
+                        basename = LogModule.get_base_name(entry.name)
+                        if basename is None:
+                            family = relative or entry.name
+                        else:
+                            family = os.path.join(relative, basename)
+                        logs[family]['total_size'] += entry.stat(follow_symlinks=False).st_size
+                        logs[family]['file_number'] += 1
+        return dict(logs), True
+
+    @staticmethod
+    def get_logs():
+        """
+        Returns:
+            logs (dict(str -> dict)) total_size and file_number by log family
+        """
+        return LogModule.scan_logs(LogModule.log_path, LogModule.SCAN_TIME_LIMIT)[0]
+
+    @staticmethod
+    def get_metrics():
+        logs = LogModule.get_logs()
+        return [
+            Metric('odoo_log_size_bytes', "Size of the log files, rotated ones included", 'gauge',
+                   [({'log': str(name)}, info['total_size']) for name, info in logs.items()]),
+        ]
+
+    @staticmethod
+    def format_growth(size, previous, days):
+        if previous is None or days <= 0:
+            return ''
+        growth = (size - previous) / days
+        return "{}{}/jour".format('-' if growth < 0 else '+', sizeof_fmt(abs(growth)))
+
     @staticmethod
     def get_data():
-        data = []
-        log_files = os.scandir(LogModule.log_path)
-        logs = dict()
-        for file in log_files:
-            if file.is_file():
-                basename = LogModule.get_base_name(file.name)
-                if not logs.get(basename):
-                    logs[basename] = dict(total_size=0, file_number=0)
-                logs[basename]['total_size'] += file.stat().st_size
-                logs[basename]['file_number'] += 1
-        for logname, info in logs.items():
+        """The sizes are saved in STATE_PATH/logs.json, the growth is computed since the previous report"""
+        now = time.time()
+        logs, complete = LogModule.scan_logs(LogModule.log_path, LogModule.SCAN_TIME_LIMIT)
+        snapshot = load_state('logs.json', LogModule.state_path) or dict(time=now, sizes=dict())
+        days = (now - snapshot['time']) / 86400
+        # The families the scan did not reach would look like they shrank
+        previous = snapshot['sizes'] if complete else dict()
+        largest = heapq.nlargest(
+            LogModule.MAX_ENTRIES,
+            ((name, info) for name, info in logs.items() if info['total_size'] >= LogModule.MIN_SIZE),
+            key=lambda item: item[1]['total_size'],
+        )
+        data = [[
+            name,
+            info['file_number'],
+            sizeof_fmt(info['total_size']),
+            LogModule.format_growth(info['total_size'], previous.get(name), days),
+        ] for name, info in largest]
+        total_size = sum(info['total_size'] for info in logs.values())
+        data.append([
+            "Total" if complete else "Total (parcours incomplet)",
+            sum(info['file_number'] for info in logs.values()),
+            sizeof_fmt(total_size),
+            LogModule.format_growth(total_size, sum(previous.values()) if previous else None, days),
+        ])
+        if complete:
+            save_state('logs.json', dict(time=now, sizes={name: info['total_size'] for name, info in logs.items()}),
+                       LogModule.state_path)
+        return data
+
+ODOO_LOG_LINE = re.compile(rb"^\S+ \S+ \d+ (?P<level>[A-Z]+) \S+ (?P<logger>[^\s:]+): (?P<message>.*)")
+## 2024-01-01 10:00:00,123 1234 INFO dbname logger: message, continuation lines of tracebacks don't match
+ODOO_LOGIN_FAILED = re.compile(rb"^Login failed for db:\S+ login:\S+ from (?P<ip>\S+)")
+## Same pattern as filter.d/odoo-login.local
+WERKZEUG_REQUEST = re.compile(rb'" \d{3} \S+ \d+ (?P<sql>[\d.]+) (?P<other>[\d.]+)\s*$')
+## ... "POST /web/dataset/call_kw HTTP/1.1" 200 - 12 0.005 0.030: query count, SQL time and remaining time
+
+
+class OdooLogModule(Module):
+    title = 'Log Odoo'
+    headers = ['Type', 'Détail', 'Nombre']
+    platforms = ['linux']
+    log_path = os.path.join(LOG_PATH, 'odoo', 'odoo.log')
+    state_path = STATE_PATH
+    MAX_ENTRIES = 10
+    LATENCY_BUCKETS_PER_OCTAVE = 4
+    ## Request times are counted in buckets ~19% wide, percentiles are read from the bucket upper bounds
+
+    @classmethod
+    def get_files(cls, state):
+        """Files holding the lines written since the previous run, oldest first. With logrotate compress,
+        the file read last time is now odoo.log.1.gz: its inode changed but its content did not.
+        Args:
+            state (dict or None) inode, offset and time of the previous run
+        Returns:
+            files (list((str, int))) path and offset of the first unread byte
+        """
+        directory, name = os.path.split(cls.log_path)
+        rotated = []
+        try:
+            for entry in os.scandir(directory):
+                suffix = entry.name[len(name) + 1:].split('.')[0]
+                if entry.name.startswith(name + '.') and suffix.isdigit() and entry.is_file():
+                    rotated.append((int(suffix), entry.path, entry.stat()))
+        except FileNotFoundError:
+            return []
+        files = [(path, stat) for number, path, stat in sorted(rotated, reverse=True)]
+        if os.path.isfile(cls.log_path):
+            files.append((cls.log_path, os.stat(cls.log_path)))
+        if state is None:
+            return [(path, 0) for path, stat in files]
+        for index, (path, stat) in enumerate(files):
+            if stat.st_ino == state['inode'] and stat.st_size >= state['offset']:
+                return [(path, state['offset'])] + [(path, 0) for path, stat in files[index + 1:]]
+        newer = [path for path, stat in files if stat.st_mtime > state['time'] or path == cls.log_path]
+        if len(newer) > 1 and newer[0].endswith('.gz'):
+            return [(newer[0], state['offset'])] + [(path, 0) for path in newer[1:]]
+        return [(path, 0) for path in newer]
+
+    @staticmethod
+    def get_percentile(histogram, percentile):
+        count = sum(histogram.values())
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= percentile * count:
+                return 2 ** (bucket / OdooLogModule.LATENCY_BUCKETS_PER_OCTAVE)
+
+    @staticmethod
+    def format_duration(milliseconds):
+        if milliseconds < 1000:
+            return "{:.0f} ms".format(milliseconds)
+        return "{:.1f} s".format(milliseconds / 1000)
+
+    @classmethod
+    def analyze(cls):
+        """Stream the new lines once, in bounded memory, and save where the reading stopped
+        Returns:
+            login_failures (collections.Counter) by IP
+            levels (collections.Counter) by (level, logger), ERROR and above or WARNING
+            histogram (collections.Counter) request count by latency bucket
+        """
+        state = load_state('odoo_log.json', cls.state_path)
+        login_failures, levels, histogram = collections.Counter(), collections.Counter(), collections.Counter()
+        current = None
+        for path, offset in cls.get_files(state):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rb') as file:
+                file.seek(offset)
+                for line in file:
+                    match = ODOO_LOG_LINE.match(line)
+                    if not match:
+                        continue
+                    level, logger, message = match.group('level', 'logger', 'message')
+                    if level in (b'WARNING', b'ERROR', b'CRITICAL'):
+                        levels[(level.decode(), logger.decode('utf-8', 'replace'))] += 1
+                    elif logger == b'werkzeug':
+                        request = WERKZEUG_REQUEST.search(message)
+                        if request:
+                            milliseconds = (float(request.group('sql')) + float(request.group('other'))) * 1000
+                            histogram[math.ceil(math.log2(max(milliseconds, 1)) * cls.LATENCY_BUCKETS_PER_OCTAVE)] += 1
+                    elif level == b'INFO':
+                        # Any logger, like filter.d/odoo-login.local: res_users moved between Odoo versions
+                        failure = ODOO_LOGIN_FAILED.match(message)
+                        if failure:
+                            login_failures[failure.group('ip').decode()] += 1
+                if path == cls.log_path:
+                    current = dict(inode=os.fstat(file.fileno()).st_ino, offset=file.tell(), time=time.time())
+        if current:
+            save_state('odoo_log.json', current, cls.state_path)
+        return login_failures, levels, histogram
+
+    @classmethod
+    def get_data(cls):
+        login_failures, levels, histogram = cls.analyze()
+        data = [["Connexion échouée", ip, count] for ip, count in login_failures.most_common(cls.MAX_ENTRIES)]
+        data += [[level, logger, count] for (level, logger), count in levels.most_common(cls.MAX_ENTRIES)]
+        if histogram:
             data.append([
-                logname,
-                info['file_number'],
-                info['total_size'],
+                "Temps de réponse",
+                "p50 / p90 / p99",
+                " / ".join(cls.format_duration(cls.get_percentile(histogram, percentile)) for percentile in (0.5, 0.9, 0.99)),
             ])
-        data = list(reversed(sorted(data, key=itemgetter(2))))
-        final_data = []
-        for item in data:
-            new_item = item.copy()
-            if item[2] < LogModule.MIN_SIZE:
-                continue
-            if len(final_data) >= LogModule.MAX_ENTRIES:
-                break
-            new_item[2] = sizeof_fmt(item[2])
-            final_data.append(new_item)
-        final_data.append(["Total", sum([it[1] for it in data]), sizeof_fmt(sum([it[2] for it in data]))])
-        return final_data
+            data.append(["Requêtes", "", sum(histogram.values())])
+        return data
+
 
 MODULES = Module.__subclasses__()
 
 
+def run_modules(modules, timeout=MODULE_TIMEOUT):
+    """Run the modules concurrently. Threads are daemonic so a hung module (apt mirror, NFS mount)
+    never prevents the report from being sent, it is abandoned when the script exits.
+    Args:
+        modules (list(type)) Module subclasses
+        timeout (float) seconds, for modules without their own timeout
+    Returns:
+        results (list(ModuleResult)) in the order of modules
+    """
+    results = dict()
+
+    def run(module):
+        start = time.monotonic()
+        try:
+            data, error = module.get_data(), None
+        except Exception as e:
+            data, error = None, "{}: {}".format(e.__class__.__name__, e)
+        results[module] = ModuleResult(module, data, error, time.monotonic() - start)
+
+    start = time.monotonic()
+    threads = []
+    for module in modules:
+        thread = threading.Thread(target=run, args=(module,), name=module.__name__, daemon=True)
+        thread.start()
+        threads.append((module, thread))
+    for module, thread in threads:
+        module_timeout = module.timeout or timeout
+        thread.join(max(0, start + module_timeout - time.monotonic()))
+        if module not in results:
+            results[module] = ModuleResult(module, None, "délai de {} s dépassé".format(module_timeout), module_timeout)
+    return [results[module] for module in modules]
+
+def make_report(results):
+    """
+    Args:
+        results (list(ModuleResult))
+    Returns:
+        section (render.Section)
+    """
+    sections = []
+    for result in results:
+        error = result.error
+        if error is None:
+            try:
+                sections.append(result.module.make_table(result.data))
+            except Exception as e:
+                error = "{}: {}".format(e.__class__.__name__, e)
+        if error is not None:
+            sections.append(result.module.make_degraded(error))
+    timings = ", ".join("{} : {:.1f} s".format(result.module.title, result.duration) for result in results)
+    sections.append(Section("<p>Durées : {}</p>".format(html.escape(timings)), "Durées : {}\n".format(timings), []))
+    return join_sections(sections)
+
+
+def serialize_results(results, server=SERVER_NAME, now=None):
+    """Structured report for the collector of the fleet, see collector.py
+    Args:
+        results (list(ModuleResult))
+    Returns:
+        payload (dict) JSON serializable
+    """
+    return dict(
+        server=server,
+        timestamp=now or time.time(),
+        results=[dict(
+            module=result.module.__name__,
+            title=result.module.title,
+            headers=result.module.headers,
+            data=[[item if isinstance(item, (int, float)) else str(item) for item in line] for line in result.data or []],
+            error=result.error,
+            duration=result.duration,
+        ) for result in results],
+    )
+
+
 class MEmail(Email):
     backup_root = BACKUP_ROOT_PROD
     title = "Rapport de monitoring"
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send the monitoring report")
+    parser.add_argument('--sample', action='store_true',
+                        help="only record the disk usage for the forecast of the report, for a frequent cron")
+    args = parser.parse_args()
+    if args.sample:
+        DiskModule.sample()
+        sys.exit(0)
     message = MEmail()
-    body, plain = "", ""
+    modules = []
     for module in MODULES:
         if sys.platform in module.platforms:
-            _body, _plain = module.make_table(module.get_data())
-            body += _body
-            plain += _plain
+            modules.append(module)
         else:
             print("[{}] module not supported on {}".format(module.title, sys.platform))
-    print(plain)
-    message.attach_all(body, plain)
+    results = run_modules(modules)
+    if REPORT_COLLECTOR:
+        try:
+            spool.push(REPORT_COLLECTOR, serialize_results(results))
+            sys.exit(0)
+        except OSError as e:
+            print("[collector] {}, the report is sent by mail".format(e))
+    report = make_report(results)
+    print(report.plain)
+    message.attach_section(report)
     message.send()
 
 
+class DiskModuleTest(unittest.TestCase):
+    def setUp(self):
+        DiskModule.state_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(DiskModule.state_path)
+
+    def test_history(self):
+        history = DiskHistory('/var/backups/odoo', DiskModule.state_path)
+        history.capacity = 3
+        self.assertEqual(os.path.basename(history.path), 'disk-var_backups_odoo.bin')
+        for index in range(7):
+            history.append((index, 100 - index, 10))
+        self.assertEqual([sample[0] for sample in history.read()], [4, 5, 6])
+        # Compacted once it holds more than twice the capacity
+        self.assertEqual(os.path.getsize(history.path), 3 * DISK_SAMPLE.size)
+
+        DiskModule.sample(['/'], now=1000)
+        self.assertEqual(DiskHistory('/', DiskModule.state_path).read()[0][0], 1000)
+
+    def test_get_days_to_full(self):
+        now = 100 * 86400
+        # 10 GiB free, 1 GiB used per day, inodes stable
+        samples = [(now - day * 86400, (10 + day) * 1024 ** 3, 5000) for day in reversed(range(20))]
+        days, resource = DiskModule.get_days_to_full(samples, now)
+        self.assertEqual((round(days), resource), (10, 'octets'))
+        self.assertEqual(DiskModule.format_days_to_full(days, resource), "10 jours")
+        # Inodes run out first
+        samples = [(timestamp, free, 1000 + (now - timestamp) // 86400 * 500) for timestamp, free, inodes in samples]
+        self.assertEqual(DiskModule.format_days_to_full(*DiskModule.get_days_to_full(samples, now)), "2 jours (inodes)")
+        self.assertEqual(DiskModule.get_days_to_full(samples[-1:], now), (None, None))
+        self.assertEqual(DiskModule.format_days_to_full(*DiskModule.get_days_to_full([(now - 86400, 10, 10), (now, 20, 10)], now)), "stable")
+
+    def test_get_data(self):
+        data = DiskModule.get_data()
+        self.assertEqual(data[-1][0], 'TOTAL')
+        self.assertEqual(data[-1][2], sizeof_fmt(sum(shutil.disk_usage(part).total for part in DiskModule.get_partitions())))
+
+
 class LogModuleTest(unittest.TestCase):
     def setUp(self):
         LogModule.log_path = os.path.join(os.path.dirname(__file__), "logs-test")
+        LogModule.state_path = tempfile.mkdtemp()
         os.makedirs(LogModule.log_path, exist_ok=True)
         for i in range(1, 10):
             with open(os.path.join(LogModule.log_path, "logfile.log.{}.gz".format(i)), "w") as file:
@@ -179,6 +711,7 @@ class LogModuleTest(unittest.TestCase):
 
     def tearDown(self):
         shutil.rmtree(LogModule.log_path)
+        shutil.rmtree(LogModule.state_path)
 
     def test_get_base_name(self):
         self.assertEqual(LogModule.get_base_name('fsck_apfs_error.log'), 'fsck_apfs_error')
@@ -188,5 +721,194 @@ class LogModuleTest(unittest.TestCase):
 
     def test_get_data(self):
         data = LogModule.get_data()
-        self.assertEqual(data[0], ['logfile', 10, '17.6 KiB'])
-        self.assertEqual(data[1], ['Total', 10, '17.6 KiB'])
+        self.assertEqual(data[0], ['logfile', 10, '17.6 KiB', ''])
+        self.assertEqual(data[1], ['Total', 10, '17.6 KiB', ''])
+
+        # Growth since the previous report, subdirectories included
+        state = load_state('logs.json', LogModule.state_path)
+        state['time'] -= 2 * 86400
+        save_state('logs.json', state, LogModule.state_path)
+        os.makedirs(os.path.join(LogModule.log_path, "odoo", "journal"))
+        with open(os.path.join(LogModule.log_path, "logfile.log"), "w") as file:
+            file.write("a" * 4099)
+        with open(os.path.join(LogModule.log_path, "odoo", "odoo-server.log"), "w") as file:
+            file.write("a" * 2000)
+        with open(os.path.join(LogModule.log_path, "odoo", "journal", "system.journal"), "w") as file:
+            file.write("a" * 3000)
+        data = LogModule.get_data()
+        self.assertEqual(data, [
+            ['logfile', 10, '21.6 KiB', '+2.0 KiB/jour'],
+            ['odoo/journal', 1, '2.9 KiB', ''],
+            ['odoo/odoo-server', 1, '2.0 KiB', ''],
+            ['Total', 12, '26.5 KiB', '+4.4 KiB/jour'],
+        ])
+
+    def test_scan_logs(self):
+        logs, complete = LogModule.scan_logs(LogModule.log_path, time_limit=-1)
+        self.assertEqual((logs, complete), (dict(), False))
+
+    def test_get_data_incomplete(self):
+        LogModule.get_data()
+        state = load_state('logs.json', LogModule.state_path)
+        state['time'] -= 86400
+        save_state('logs.json', state, LogModule.state_path)
+        time_limit, LogModule.SCAN_TIME_LIMIT = LogModule.SCAN_TIME_LIMIT, -1
+        try:
+            self.assertEqual(LogModule.get_data(), [['Total (parcours incomplet)', 0, '0.0 B', '']])
+        finally:
+            LogModule.SCAN_TIME_LIMIT = time_limit
+        # The snapshot of the last complete scan is kept for the next report
+        self.assertEqual(load_state('logs.json', LogModule.state_path), state)
+
+    def test_get_metrics(self):
+        metric, = LogModule.get_metrics()
+        self.assertEqual(metric.samples, [({'log': 'logfile'}, 18003)])
+
+
+class OdooLogModuleTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        OdooLogModule.log_path = os.path.join(self.path, 'odoo.log')
+        OdooLogModule.state_path = os.path.join(self.path, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, path, lines, mode='a'):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, mode + 't') as file:
+            file.write("".join(line + "\n" for line in lines))
+
+    def test_get_data(self):
+        prefix = "2024-01-01 10:00:00,123 1234 "
+        failed = prefix + "INFO prod odoo.addons.base.models.res_users: Login failed for db:prod login:admin from {}"
+        request = prefix + 'INFO prod werkzeug: 10.0.0.1 - - [01/Jan/2024 10:00:00] "POST /web/dataset/call_kw HTTP/1.1" 200 - 12 {} 0.000'
+        self._write(OdooLogModule.log_path, [
+            failed.format("1.2.3.4"),
+            prefix + "ERROR prod odoo.sql_db: bad query",
+            "Traceback (most recent call last):",
+            prefix + "WARNING prod odoo.models: unknown field",
+        ] + [request.format(0.001 * ms) for ms in range(1, 101)])
+        self.assertEqual(OdooLogModule.get_data(), [
+            ["Connexion échouée", "1.2.3.4", 1],
+            ["ERROR", "odoo.sql_db", 1],
+            ["WARNING", "odoo.models", 1],
+            ["Temps de réponse", "p50 / p90 / p99", "54 ms / 91 ms / 108 ms"],
+            ["Requêtes", "", 100],
+        ])
+        # Only new lines are read
+        self._write(OdooLogModule.log_path, [
+            failed.format("5.6.7.8"),
+            prefix + "INFO prod openerp.addons.base.res.res_users: Login failed for db:prod login:admin from 5.6.7.8",
+        ])
+        self.assertEqual(OdooLogModule.get_data(), [["Connexion échouée", "5.6.7.8", 2]])
+
+        # Rotated and compressed by logrotate, then new lines in a new file
+        self._write(OdooLogModule.log_path, [failed.format("9.9.9.9")])
+        with open(OdooLogModule.log_path) as file:
+            content = file.read()
+        os.remove(OdooLogModule.log_path)
+        self._write(OdooLogModule.log_path + '.1.gz', [content.rstrip("\n")], 'w')
+        os.utime(OdooLogModule.log_path + '.1.gz', (time.time() + 60, time.time() + 60))
+        self._write(OdooLogModule.log_path, [failed.format("1.2.3.4")])
+        self.assertEqual(OdooLogModule.get_data(), [
+            ["Connexion échouée", "9.9.9.9", 1],
+            ["Connexion échouée", "1.2.3.4", 1],
+        ])
+
+
+class AptModuleTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.inventories = 0
+        self.updates = 0
+        test = self
+
+        class TestAptModule(AptModule):
+            lists_path = os.path.join(self.path, 'lists')
+            update_stamp = os.path.join(self.path, 'update-success-stamp')
+            dpkg_status = os.path.join(self.path, 'status')
+            state_path = os.path.join(self.path, 'state')
+
+            @classmethod
+            def update_lists(cls):
+                test.updates += 1
+                open(cls.update_stamp, 'w').close()
+
+            @staticmethod
+            def read_inventory():
+                test.inventories += 1
+                return [('libssl3', '3.0.11', '3.0.13', True), ('nginx', '1.22.1', '1.22.2', False)]
+
+        self.module = TestAptModule
+        os.makedirs(self.module.lists_path)
+        open(self.module.dpkg_status, 'w').close()
+        # Lists downloaded long ago: the mirror did not change since
+        open(os.path.join(self.module.lists_path, 'deb.debian.org_dists_bookworm_main_binary-amd64_Packages'), 'w').close()
+        os.utime(os.path.join(self.module.lists_path, 'deb.debian.org_dists_bookworm_main_binary-amd64_Packages'), (0, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_upgrades(self):
+        self.assertEqual(self.module.get_data(), [['nginx', '1.22.1', '1.22.2']])
+        self.assertEqual((self.updates, self.inventories), (1, 1))
+        # Recent update, even if the mirror did not change the lists, and same dpkg status: nothing is read again
+        self.assertEqual(self.module.get_upgrades()[0], ('libssl3', '3.0.11', '3.0.13', True))
+        self.assertEqual((self.updates, self.inventories), (1, 1))
+        # An upgrade was installed
+        os.utime(self.module.dpkg_status, ns=(0, 0))
+        self.module.get_upgrades()
+        self.assertEqual((self.updates, self.inventories), (1, 2))
+        # The last successful apt update is too old
+        os.utime(self.module.update_stamp, (time.time() - 2 * AptModule.LISTS_MAX_AGE,) * 2)
+        self.module.get_upgrades()
+        self.assertEqual(self.updates, 2)
+
+
+class RunModulesTest(unittest.TestCase):
+    def test_run_modules(self):
+        class FastModule(Module):
+            title = 'Rapide'
+            headers = ['Valeur']
+
+            @staticmethod
+            def get_data():
+                return [['ok']]
+
+        class BrokenModule(Module):
+            title = 'Cassé'
+            headers = ['Valeur']
+
+            @staticmethod
+            def get_data():
+                raise OSError("mirror unreachable")
+
+        class SlowModule(Module):
+            title = 'Lent'
+            headers = ['Valeur']
+            timeout = 0.2
+
+            @staticmethod
+            def get_data():
+                time.sleep(5)
+
+        start = time.monotonic()
+        results = run_modules([SlowModule, FastModule, BrokenModule], timeout=2)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([(result.data, result.error) for result in results], [
+            (None, "délai de 0.2 s dépassé"),
+            ([['ok']], None),
+            (None, "OSError: mirror unreachable"),
+        ])
+
+        payload = serialize_results(results, 'odoo1', now=1)
+        self.assertEqual(payload['results'][1], dict(
+            module='FastModule', title='Rapide', headers=['Valeur'], data=[['ok']], error=None, duration=results[1].duration,
+        ))
+        self.assertEqual(spool.decode_payload(spool.encode_payload(payload)), payload)
+
+        body, plain, attachments = make_report(results)
+        self.assertIn("<h1>Lent</h1><p>Module indisponible : délai de 0.2 s dépassé</p>", body)
+        self.assertIn("<td>ok</td>", body)
+        self.assertTrue(plain.endswith("Durées : Lent : 0.2 s, Rapide : 0.0 s, Cassé : 0.0 s\n"))
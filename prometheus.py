@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+
+from conf import BACKUP_ROOT_TEST
+
+
+Metric = collections.namedtuple('Metric', ['name', 'help', 'type', 'samples'])
+## samples: list of (labels (dict), value (float))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metrics(metrics):
+    """Prometheus text exposition format
+    Args:
+        metrics (list(Metric))
+    Returns:
+        text (str)
+    """
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for labels, value in metric.samples:
+            if labels:
+                labels = "{" + ",".join('{}="{}"'.format(key, escape_label(labels[key])) for key in sorted(labels)) + "}"
+            lines.append("{}{} {}".format(metric.name, labels or "", repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+def write_textfile(path, metrics):
+    """Atomic write for the node_exporter textfile collector, which must never read a partial file
+    Args:
+        path (str) .prom file
+        metrics (list(Metric))
+    """
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.', suffix='.tmp', delete=False) as tmp:
+        tmp.write(format_metrics(metrics))
+    os.chmod(tmp.name, 0o644)
+    os.replace(tmp.name, path)
+
+
+class PrometheusTest(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(BACKUP_ROOT_TEST, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_write_textfile(self):
+        path = os.path.join(BACKUP_ROOT_TEST, 'odoo.prom')
+        write_textfile(path, [
+            Metric('odoo_backup_count', "Number of dumps", 'gauge', [
+                ({'server': 'localhost', 'database': 'a"b'}, 3),
+            ]),
+            Metric('odoo_backup_empty', "No samples", 'gauge', []),
+        ])
+        with open(path) as file:
+            self.assertEqual(file.read(), "\n".join([
+                '# HELP odoo_backup_count Number of dumps',
+                '# TYPE odoo_backup_count gauge',
+                'odoo_backup_count{database="a\\"b",server="localhost"} 3.0',
+                '# HELP odoo_backup_empty No samples',
+                '# TYPE odoo_backup_empty gauge',
+            ]) + "\n")
+        self.assertEqual(os.listdir(BACKUP_ROOT_TEST), ['odoo.prom'])
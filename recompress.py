@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import zipfile
+import argparse
+import datetime
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST
+from file_rotation import (Database, DatabaseLocked, RetentionPolicy, RETENTION_POLICIES, iter_databases,
+                           get_filename_from_datetime, LZMA_SUFFIX, RECOMPRESS_AFTER_DAYS, RECOMPRESS_JOBS)
+from verification import verify_zip, verify_database
+from restore import get_index, extract
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class RecompressError(Exception):
+    pass
+
+
+def get_recompressed_path(path):
+    """2020_03_01_03_00_01.dump.zip -> 2020_03_01_03_00_01.dump.lzma.zip"""
+    assert path.endswith('.dump.zip')
+    return path[:-len('.dump.zip')] + LZMA_SUFFIX
+
+
+def repack(source, destination):
+    """Copy the members of a zip into a new zip compressed with LZMA, one member at a time in bounded memory.
+    Each member stays separately compressed, so the central directory still gives random access to it.
+    """
+    with zipfile.ZipFile(source) as src, zipfile.ZipFile(destination, 'w', zipfile.ZIP_LZMA) as dst:
+        for info in src.infolist():
+            target = zipfile.ZipInfo(info.filename, info.date_time)
+            target.external_attr = info.external_attr
+            if info.is_dir():
+                dst.writestr(target, b'')
+                continue
+            target.compress_type = zipfile.ZIP_LZMA
+            # Incompressible members can grow a little, zip64 is decided before the size is known
+            with src.open(info) as member, dst.open(target, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT // 2) as output:
+                shutil.copyfileobj(member, output, READ_CHUNK_SIZE)
+
+def verify_round_trip(source, destination):
+    """The repacked zip must list the same members with the same CRC and size, and decompress to them
+    Returns:
+        error (str or None) None if the copy can replace the original
+    """
+    with zipfile.ZipFile(source) as src:
+        expected = [(info.filename, info.CRC, info.file_size) for info in src.infolist()]
+    with zipfile.ZipFile(destination) as dst:
+        found = [(info.filename, info.CRC, info.file_size) for info in dst.infolist()]
+    if found != expected:
+        return "members differ from the original"
+    return verify_zip(destination)
+
+def recompress_dump(path):
+    """Repack a dump into a temporary file of its database directory, the original is left untouched
+    Returns:
+        tmp (str) path of the verified copy
+    Raises:
+        RecompressError if the round trip failed
+    """
+    # Outside of the tier directory, so the catalog never sees a half-written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.dirname(path)), prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        repack(path, tmp)
+        error = verify_round_trip(path, tmp)
+        if error:
+            raise RecompressError("{} : {}".format(path, error))
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp
+
+def replace_dump(database, dt, stat, tmp):
+    """Swap a monthly dump for its verified copy, under the lock of the database
+    Args:
+        stat (os.stat_result) of the original when it was repacked
+    Returns:
+        saved (int) bytes given back to the filesystem, the original minus its copy
+    Raises:
+        RecompressError if the original changed or got another hardlink in the meantime
+    """
+    try:
+        with database.lock():
+            path = database.dump_path('monthly', dt)
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                raise RecompressError("{} was purged while it was repacked".format(path))
+            if (current.st_ino, current.st_size, current.st_mtime_ns) != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                raise RecompressError("{} changed while it was repacked".format(path))
+            if current.st_nlink > 1:
+                raise RecompressError("{} is hardlinked, replacing it would not free anything".format(path))
+            shutil.copymode(path, tmp)
+            os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp, get_recompressed_path(path))
+            # dump_path still resolves to the original as long as it exists
+            return database.remove('monthly', dt) - os.stat(get_recompressed_path(path)).st_blocks * 512
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def get_candidates(database, now, after):
+    """
+    Returns:
+        datetimes (list(datetime.datetime)) monthly dumps older than `after` days still stored as deflate zips
+    """
+    limit = now - datetime.timedelta(days=after)
+    candidates = []
+    for dt in database.list_datetimes('monthly'):
+        path = database.dump_path('monthly', dt)
+        if dt >= limit or not path.endswith('.dump.zip'):
+            continue
+        # A monthly still hardlinked to its daily or weekly dump would be stored twice until they are purged
+        if os.stat(path).st_nlink > 1:
+            continue
+        candidates.append(dt)
+    return candidates
+
+def lower_priority():
+    os.nice(19)
+
+def recompress_fleet(backup_root=BACKUP_ROOT_PROD, after=RECOMPRESS_AFTER_DAYS, jobs=RECOMPRESS_JOBS, now=None):
+    """Dumps are repacked without lock in low-priority processes, only the final swap locks the database
+    Returns:
+        saved (int) bytes given back to the filesystem
+    """
+    now = now or datetime.datetime.now()
+    saved = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=lower_priority) as executor:
+        futures = []
+        for server, name in iter_databases(backup_root):
+            database = Database(server, name, backup_root, create=False)
+            for dt in get_candidates(database, now, after):
+                path = database.dump_path('monthly', dt)
+                futures.append((database, dt, os.stat(path), executor.submit(recompress_dump, path)))
+        for database, dt, stat, future in futures:
+            filename = get_filename_from_datetime(dt)
+            try:
+                saved += replace_dump(database, dt, stat, future.result())
+            except (RecompressError, DatabaseLocked, zipfile.BadZipFile, OSError) as e:
+                print("[{}/{}] monthly/{} not recompressed: {}".format(database.server, database.name, filename, e))
+                continue
+            size = os.path.getsize(get_recompressed_path(os.path.join(database.monthly_path, filename)))
+            print("[{}/{}] monthly/{}: {} -> {} bytes".format(database.server, database.name, filename, stat.st_size, size))
+    return saved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repack with LZMA the monthly dumps older than RECOMPRESS_AFTER_DAYS, to run after file_rotation.py")
+    parser.add_argument('--after', type=int, default=RECOMPRESS_AFTER_DAYS, help="age in days")
+    parser.add_argument('--jobs', type=int, default=RECOMPRESS_JOBS)
+    args = parser.parse_args()
+    if not args.after:
+        parser.error("RECOMPRESS_AFTER_DAYS is not configured in file_rotation.py, use --after")
+    print("{} bytes saved".format(recompress_fleet(after=args.after, jobs=args.jobs)))
+
+
+class RecompressTest(unittest.TestCase):
+    def setUp(self):
+        self.database = Database('localhost', 'Database14', BACKUP_ROOT_TEST)
+        self.now = datetime.datetime(2020, 6, 1, 3)
+        self.sql = b"INSERT INTO res_partner VALUES (1, 'Partner');\n" * 20000
+
+    def tearDown(self):
+        RETENTION_POLICIES.pop('localhost/Database14', None)
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _generate_zip(self, tier, dt):
+        path = self.database.dump_path(tier, dt)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            archive.writestr('dump.sql', self.sql)
+            archive.writestr('filestore/', b'')
+            archive.writestr('filestore/ab/ab12', os.urandom(4096))
+        return path
+
+    def test_recompress_fleet(self):
+        old, recent = datetime.datetime(2020, 1, 1, 3), datetime.datetime(2020, 5, 1, 3)
+        original = self._generate_zip('monthly', old)
+        os.link(original, self.database.dump_path('daily', old))
+        self._generate_zip('monthly', recent)
+        before = os.path.getsize(original)
+
+        # Still hardlinked to the daily dump, recompressing it would take more space
+        self.assertEqual(recompress_fleet(BACKUP_ROOT_TEST, after=90, jobs=1, now=self.now), 0)
+        self.assertEqual(self.database.dump_path('monthly', old), original)
+
+        os.remove(self.database.dump_path('daily', old))
+        blocks = os.stat(original).st_blocks
+        saved = recompress_fleet(BACKUP_ROOT_TEST, after=90, jobs=1, now=self.now)
+        path = self.database.dump_path('monthly', old)
+        self.assertEqual(saved, (blocks - os.stat(path).st_blocks) * 512)
+        self.assertTrue(path.endswith(LZMA_SUFFIX))
+        self.assertLess(os.path.getsize(path), before)
+        self.assertFalse(os.path.exists(original))
+        self.assertTrue(self.database.dump_path('monthly', recent).endswith('.dump.zip'))
+        self.assertEqual(sorted(os.listdir(self.database.path)), ['.catalog.sqlite', '.lock', 'daily', 'monthly', 'weekly'])
+
+        # The same backup for the rotation, the verification and the restore
+        self.assertEqual(self.database.list_datetimes('monthly'), [old, recent])
+        self.assertEqual(verify_database(self.database), {})
+        self.assertEqual({member.compress_type for member in get_index(self.database, 'monthly', old) if not member.name.endswith('/')}, {zipfile.ZIP_LZMA})
+        output = os.path.join(BACKUP_ROOT_TEST, '.restore')
+        [restored] = extract(self.database, 'monthly', old, ['dump.sql'], output)
+        with open(restored, 'rb') as file:
+            self.assertEqual(file.read(), self.sql)
+        self.assertEqual(get_candidates(self.database, self.now, 90), [])
+
+        RETENTION_POLICIES['localhost/Database14'] = RetentionPolicy(weeks=4, months=1)
+        plan = self.database.plan(rotate=False, now=self.now)
+        self.assertEqual(plan.deletions, [('monthly', old)])
+        self.database.execute(plan)
+        self.assertEqual(os.listdir(self.database.monthly_path), [get_filename_from_datetime(recent)])
+
+    def test_round_trip(self):
+        dt = datetime.datetime(2020, 1, 1, 3)
+        path = self._generate_zip('monthly', dt)
+        tmp = recompress_dump(path)
+        self.assertIsNone(verify_round_trip(path, tmp))
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_LZMA) as archive:
+            archive.writestr('dump.sql', self.sql[:-1])
+        self.assertEqual(verify_round_trip(path, tmp), "members differ from the original")
+
+        # A dump modified during the repacking is left alone, the copy is discarded
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        with self.assertRaises(RecompressError):
+            replace_dump(self.database, dt, stat, tmp)
+        self.assertFalse(os.path.exists(tmp))
+        self.assertEqual(os.listdir(self.database.monthly_path), [os.path.basename(path)])
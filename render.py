@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import csv
+import html
+import unittest
+import functools
+import collections
+import unicodedata
+
+
+MAX_INLINE_ROWS = 200
+## Larger tables are attached to the mail as CSV instead of being rendered in its body
+PLAIN_WIDTH = 30
+
+Section = collections.namedtuple('Section', ['body', 'plain', 'attachments'])
+## body (str) html, plain (str), attachments (list((str, bytes))) filename and content
+
+
+@functools.lru_cache(maxsize=None)
+def get_css():
+    with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), "mail.css")) as file:
+        return file.read()
+
+def get_filename(title, extension):
+    """ASCII file name for an attachment: "Mises à jour" -> mises-a-jour.csv"""
+    name = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode()
+    return "-".join("".join(char if char.isalnum() else " " for char in name.lower()).split()) + extension
+
+def format_plain(items):
+    return "| ".join(["{:<{}}".format(str(item), PLAIN_WIDTH) for item in items]) + "\n"
+
+def render_table(title, headers, rows, max_rows=MAX_INLINE_ROWS):
+    """Single pass over rows, which may be a generator. Rows are kept until max_rows is reached, then
+    the table goes to a CSV attachment and the remaining rows are written straight to it.
+    Args:
+        title (str)
+        headers (list(str))
+        rows (iterable(list)) each row must be the same len as headers
+    Returns:
+        section (Section)
+    """
+    body = ["<h1>", html.escape(title), "</h1><table><thead><tr>"]
+    body += ["<th>{}</th>".format(html.escape(str(header))) for header in headers]
+    body.append("</tr></thead><tbody>")
+    plain = [title, "\n", "=" * len(title), "\n", format_plain(headers), "-" * (len(headers) * (PLAIN_WIDTH + 2) - 2), "\n"]
+    kept = []
+    attachment = writer = None
+    count = 0
+    for row in rows:
+        assert len(row) == len(headers)
+        count += 1
+        if writer is not None:
+            writer.writerow(row)
+            continue
+        if count > max_rows:
+            attachment = io.StringIO()
+            writer = csv.writer(attachment)
+            writer.writerow(headers)
+            writer.writerows(kept)
+            writer.writerow(row)
+            continue
+        kept.append(row)
+    if writer is None:
+        for row in kept:
+            body.append("<tr>")
+            body += ["<td>{}</td>".format(html.escape(str(item))) for item in row]
+            body.append("</tr>")
+            plain.append(format_plain(row))
+        body.append("</tbody></table>")
+        plain.append("\n")
+        return Section("".join(body), "".join(plain), [])
+    filename = get_filename(title, '.csv')
+    note = "{} lignes, voir la pièce jointe {}".format(count, filename)
+    body = ["<h1>", html.escape(title), "</h1><p>", html.escape(note), "</p>"]
+    plain = [title, "\n", "=" * len(title), "\n", note, "\n\n"]
+    return Section("".join(body), "".join(plain), [(filename, attachment.getvalue().encode())])
+
+def join_sections(sections):
+    """
+    Args:
+        sections (iterable(Section))
+    Returns:
+        section (Section)
+    """
+    bodies, plains, attachments = [], [], []
+    for section in sections:
+        bodies.append(section.body)
+        plains.append(section.plain)
+        attachments += section.attachments
+    return Section("".join(bodies), "".join(plains), attachments)
+
+
+class RenderTest(unittest.TestCase):
+    def test_render_table(self):
+        section = render_table("Mises à jour", ['Nom', 'Version'], iter([['<script>', 1], ['nginx', '1.22']]))
+        self.assertEqual(section.body, "".join([
+            "<h1>Mises à jour</h1><table><thead><tr><th>Nom</th><th>Version</th></tr></thead><tbody>",
+            "<tr><td>&lt;script&gt;</td><td>1</td></tr><tr><td>nginx</td><td>1.22</td></tr></tbody></table>",
+        ]))
+        self.assertEqual(section.plain.splitlines()[5], format_plain(['nginx', '1.22']).rstrip("\n"))
+        self.assertEqual(section.attachments, [])
+
+    def test_csv_attachment(self):
+        rows = ([str(index), "a,b"] for index in range(5))
+        section = render_table("Mises à jour", ['Nom', 'Valeur'], rows, max_rows=3)
+        self.assertEqual(section.body, "<h1>Mises à jour</h1><p>5 lignes, voir la pièce jointe mises-a-jour.csv</p>")
+        (filename, data), = section.attachments
+        self.assertEqual(data.decode().splitlines(), ['Nom,Valeur'] + ['{},"a,b"'.format(index) for index in range(5)])
+        self.assertIs(get_css(), get_css())
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import fcntl
+import time
+import zlib
+import shutil
+import hashlib
+import zipfile
+import argparse
+import datetime
+import tempfile
+import unittest
+
+from conf import BACKUP_ROOT_PROD, BACKUP_ROOT_TEST, REPLICATION_TARGET, REPLICATION_MAX_BYTES_PER_SECOND
+from file_rotation import Database, iter_databases, get_filename_from_datetime, LZMA_SUFFIX
+from verification import Throttle
+from dedup import MANIFEST_SUFFIX
+
+
+REPLICATED_TIERS = ('weekly', 'monthly')
+BLOCK_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class LocalBackend:
+    """Replication target in a directory, e.g. a mounted disk or network share. A backend for another
+    transport implements the same methods on names relative to its root (server/database/tier/filename).
+    """
+    root = None
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def part_size(self, name):
+        """
+        Returns:
+            size (int) bytes already received of an interrupted transfer
+        """
+        try:
+            return os.path.getsize(self.path(name) + '.part')
+        except FileNotFoundError:
+            return 0
+
+    def write(self, name, offset, data):
+        path = self.path(name) + '.part'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+            file.seek(offset)
+            file.write(data)
+
+    def copy(self, name, offset, base, base_offset, length):
+        """Copy a range of a dump already on the target, nothing goes through the network"""
+        with open(self.path(base), 'rb') as source:
+            source.seek(base_offset)
+            while length:
+                data = source.read(min(READ_CHUNK_SIZE, length))
+                if not data:
+                    raise OSError("{} is shorter than expected".format(base))
+                self.write(name, offset, data)
+                offset += len(data)
+                length -= len(data)
+
+    def commit(self, name, size):
+        path = self.path(name)
+        with open(path + '.part', 'rb') as file:
+            os.fsync(file.fileno())
+            if os.fstat(file.fileno()).st_size != size:
+                raise OSError("{} : {} bytes received instead of {}".format(name, os.fstat(file.fileno()).st_size, size))
+        os.replace(path + '.part', path)
+
+    def remove(self, name):
+        for path in (self.path(name), self.path(name) + '.part'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def get_backend(target=REPLICATION_TARGET):
+    if target and os.path.isabs(target):
+        return LocalBackend(target)
+    raise ValueError("unsupported replication target {!r}".format(target))
+
+
+def get_anchors(path):
+    """Offsets where the content of a dump realigns: every member of a zip starts a new sequence of blocks,
+    so an unchanged attachment matches even when the members before it changed size
+    Returns:
+        anchors (list(int)) sorted, the last one is the size of the file
+    """
+    size = os.path.getsize(path)
+    anchors = {0, size}
+    try:
+        with zipfile.ZipFile(path) as archive:
+            anchors.update(info.header_offset for info in archive.infolist())
+            anchors.add(archive.start_dir)
+    except zipfile.BadZipFile:
+        pass
+    return sorted(anchor for anchor in anchors if anchor <= size)
+
+def iter_blocks(path):
+    """
+    Yields:
+        offset (int)
+        data (bytes) at most BLOCK_SIZE, blocks never cross an anchor
+    """
+    anchors = get_anchors(path)
+    with open(path, 'rb') as file:
+        for start, end in zip(anchors, anchors[1:]):
+            file.seek(start)
+            for offset in range(start, end, BLOCK_SIZE):
+                yield offset, file.read(min(BLOCK_SIZE, end - offset))
+
+def get_signatures(path):
+    """rsync-like signatures of a dump: a cheap weak checksum, confirmed by a strong hash
+    Returns:
+        signatures (dict((int, int) -> dict(bytes -> int))) (length, adler32) -> sha256 -> offset
+    """
+    signatures = dict()
+    for offset, data in iter_blocks(path):
+        signatures.setdefault((len(data), zlib.adler32(data)), dict()).setdefault(hashlib.sha256(data).digest(), offset)
+    return signatures
+
+def get_delta(path, base_path=None):
+    """
+    Returns:
+        instructions (list((str, int, int))) ('copy', offset in base, length) or ('literal', offset in path, length),
+            in the order of path
+    """
+    if base_path is None:
+        return [('literal', 0, os.path.getsize(path))]
+    signatures = get_signatures(base_path)
+    instructions = []
+    for offset, data in iter_blocks(path):
+        strong = signatures.get((len(data), zlib.adler32(data)))
+        base_offset = strong and strong.get(hashlib.sha256(data).digest())
+        instruction = ('copy', base_offset, len(data)) if base_offset is not None else ('literal', offset, len(data))
+        if instructions:
+            kind, start, length = instructions[-1]
+            if kind == instruction[0] and start + length == instruction[1]:
+                instructions[-1] = (kind, start, length + len(data))
+                continue
+        instructions.append(instruction)
+    return instructions
+
+
+def transfer(backend, path, name, base_path=None, base_name=None, throttle=None):
+    """Send a dump as a delta against a dump already replicated, resuming an interrupted transfer
+    Args:
+        path (str) local dump
+        name (str) name on the target
+        base_path, base_name (str) local path and target name of the same previous dump
+        throttle (verification.Throttle) applied to the bytes sent
+    Returns:
+        sent (int) bytes sent, the rest was copied on the target
+    """
+    done = backend.part_size(name)
+    sent = 0
+    offset = 0
+    with open(path, 'rb') as file:
+        for kind, start, length in get_delta(path, base_path):
+            end = offset + length
+            skip = max(0, done - offset)
+            if skip < length:
+                if kind == 'copy':
+                    backend.copy(name, offset + skip, base_name, start + skip, length - skip)
+                else:
+                    file.seek(start + skip)
+                    position, remaining = offset + skip, length - skip
+                    while remaining:
+                        data = file.read(min(READ_CHUNK_SIZE, remaining))
+                        if throttle:
+                            throttle.consume(len(data))
+                        backend.write(name, position, data)
+                        position += len(data)
+                        remaining -= len(data)
+                        sent += len(data)
+            offset = end
+    backend.commit(name, offset)
+    return sent
+
+
+class ReplicationManifest:
+    """Dumps of a database present on the target, in <server>/<database>/.replication.json"""
+    filename = '.replication.json'
+    path = None
+
+    def __init__(self, database):
+        self.path = os.path.join(database.path, self.filename)
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = dict(dumps=dict(), pending=dict())
+        self.dumps = data['dumps']
+        ## tier/filename of the dump before recompression -> size, mtime_ns, replicated (timestamp) and
+        ## tier/filename on the target (name)
+        self.pending = data['pending']
+        ## tier/filename -> size, mtime_ns, base and name of an interrupted transfer
+
+    def save(self):
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), prefix='.', suffix='.tmp', delete=False) as tmp:
+            json.dump(dict(dumps=self.dumps, pending=self.pending), tmp)
+        os.replace(tmp.name, self.path)
+
+
+def get_remote_name(database, key):
+    return "/".join([database.server, database.name, key])
+
+def is_unchanged(path, stat):
+    try:
+        current = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (current.st_ino, current.st_size, current.st_mtime_ns) == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+def get_key(tier, dt):
+    """Key of a dump in the manifest, the same once the dump is recompressed under another filename"""
+    return "{}/{}".format(tier, get_filename_from_datetime(dt))
+
+def replicate_database(database, backend, throttle=None, now=None):
+    """Remove from the target the dumps purged locally, then send the new weekly/monthly dumps. A dump stored
+    under another filename since it was replicated (recompressed) is sent again, its previous copy is only
+    removed from the target once the new one is complete.
+    Returns:
+        sent (int) bytes sent
+        removed (int) dumps removed from the target
+    """
+    # The database is only locked to read its state and update the manifest, never during a transfer, so
+    # the rotation keeps running. A dump purged or replaced during its transfer is not recorded.
+    with database.lock(blocking=True):
+        manifest = ReplicationManifest(database)
+        local = dict()
+        ## key -> local path and tier/filename on the target
+        for tier in REPLICATED_TIERS:
+            for dt in database.list_datetimes(tier):
+                path = database.dump_path(tier, dt)
+                if path.endswith(MANIFEST_SUFFIX):
+                    # Deduplicated dumps only make sense with the chunk store, they are not replicated
+                    continue
+                local[get_key(tier, dt)] = path, "{}/{}".format(tier, os.path.basename(path))
+        removed = 0
+        for key in sorted(set(manifest.dumps) - set(local)):
+            backend.remove(get_remote_name(database, manifest.dumps[key].get('name', key)))
+            del manifest.dumps[key]
+            removed += 1
+        manifest.save()
+
+    def is_replicated(key):
+        return key in manifest.dumps and manifest.dumps[key].get('name', key) == local[key][1]
+
+    sent = 0
+    for key in sorted([key for key in local if not is_replicated(key)], key=os.path.basename):
+        path, name = local[key]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # The local file of a base must be the one on the target, otherwise the delta copies the wrong bytes
+        bases = [base for base in sorted(manifest.dumps, key=os.path.basename, reverse=True) if base in local and is_replicated(base)]
+        base = next((base for base in bases if base.split('/')[0] == key.split('/')[0]), bases[0] if bases else None)
+        pending = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, base=base, name=name)
+        if manifest.pending.get(key) != pending:
+            # The partial file was made from another version of the dump or another base
+            backend.remove(get_remote_name(database, name))
+            with database.lock(blocking=True):
+                manifest.pending[key] = pending
+                manifest.save()
+        try:
+            sent += transfer(
+                backend, path, get_remote_name(database, name),
+                base and local[base][0], base and get_remote_name(database, local[base][1]), throttle,
+            )
+        except FileNotFoundError:
+            if is_unchanged(path, stat):
+                raise
+        with database.lock(blocking=True):
+            del manifest.pending[key]
+            if not is_unchanged(path, stat):
+                backend.remove(get_remote_name(database, name))
+                manifest.save()
+                continue
+            previous = manifest.dumps.get(key)
+            manifest.dumps[key] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, replicated=now or time.time(), name=name)
+            manifest.save()
+        if previous and previous.get('name', key) != name:
+            backend.remove(get_remote_name(database, previous.get('name', key)))
+    return sent, removed
+
+def get_replication_lag(database, now=None):
+    """
+    Returns:
+        lag (datetime.timedelta or None) age of the oldest weekly/monthly dump not replicated yet, None if all are
+    """
+    now = now or datetime.datetime.now()
+    replicated = ReplicationManifest(database).dumps
+    waiting = [
+        dt for tier in REPLICATED_TIERS for dt in database.list_datetimes(tier)
+        if get_key(tier, dt) not in replicated and not database.dump_path(tier, dt).endswith(MANIFEST_SUFFIX)
+    ]
+    return now - min(waiting) if waiting else None
+
+def replicate_fleet(backup_root=BACKUP_ROOT_PROD, target=REPLICATION_TARGET):
+    """Databases are not locked during their transfers, <backup root>/.replication.lock keeps a second
+    replication from sending the same dumps at the same time
+    """
+    backend = get_backend(target)
+    throttle = Throttle(REPLICATION_MAX_BYTES_PER_SECOND)
+    with open(os.path.join(backup_root, '.replication.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("[replication] another replication is running")
+            return
+        for server, name in iter_databases(backup_root):
+            database = Database(server, name, backup_root, create=False)
+            try:
+                sent, removed = replicate_database(database, backend, throttle)
+            except Exception as e:
+                print("[{}/{}] replication failed: {}".format(server, name, e))
+                continue
+            if sent or removed:
+                print("[{}/{}] {} bytes sent, {} dumps removed from the target".format(server, name, sent, removed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replicate the weekly and monthly dumps to REPLICATION_TARGET, to run after file_rotation.py")
+    parser.add_argument('--target', default=REPLICATION_TARGET)
+    args = parser.parse_args()
+    if not args.target:
+        parser.error("REPLICATION_TARGET is not configured in conf.py, use --target")
+    replicate_fleet(target=args.target)
+
+
+class ReplicationTest(unittest.TestCase):
+    def setUp(self):
+        self.database = Database('localhost', 'Database13', BACKUP_ROOT_TEST)
+        self.backend = LocalBackend(os.path.join(BACKUP_ROOT_TEST, '.target'))
+        self.now = datetime.datetime(2020, 3, 1, 3)
+        self.attachment = os.urandom(1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _generate_zip(self, tier, dt, sql):
+        with zipfile.ZipFile(self.database.dump_path(tier, dt), 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('dump.sql', sql)
+            archive.writestr('filestore/ab/ab12', self.attachment)
+        return self.database.dump_path(tier, dt)
+
+    def _read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_replicate_database(self):
+        first = self._generate_zip('monthly', self.now - datetime.timedelta(days=31), os.urandom(1000))
+        self.assertEqual(get_replication_lag(self.database, self.now), datetime.timedelta(days=31))
+        sent, removed = replicate_database(self.database, self.backend)
+        self.assertGreater(sent, len(self.attachment))
+        self.assertIsNone(get_replication_lag(self.database, self.now))
+
+        # The dump.sql grew: the attachment is found again after it and copied on the target
+        second = self._generate_zip('monthly', self.now, os.urandom(5000))
+        sent, removed = replicate_database(self.database, self.backend)
+        self.assertLess(sent, 100 * 1024)
+        remote = self.backend.path(get_remote_name(self.database, 'monthly/' + os.path.basename(second)))
+        self.assertEqual(self._read(remote), self._read(second))
+
+        # Purged locally, removed from the target
+        os.remove(first)
+        self.assertEqual(replicate_database(self.database, self.backend), (0, 1))
+        self.assertEqual(os.listdir(os.path.dirname(remote)), [os.path.basename(second)])
+
+    def test_resume(self):
+        path = self._generate_zip('weekly', self.now, b'')
+        name = get_remote_name(self.database, 'weekly/' + os.path.basename(path))
+
+        class FailingBackend(LocalBackend):
+            def write(backend, name, offset, data):
+                if offset >= 512 * 1024:
+                    raise OSError("connection lost")
+                super().write(name, offset, data[:512 * 1024 - offset])
+                if offset + len(data) > 512 * 1024:
+                    raise OSError("connection lost")
+
+        with self.assertRaises(OSError):
+            replicate_database(self.database, FailingBackend(self.backend.root))
+        self.assertEqual(self.backend.part_size(name), 512 * 1024)
+        sent, removed = replicate_database(self.database, self.backend)
+        self.assertEqual(sent, os.path.getsize(path) - 512 * 1024)
+        self.assertEqual(self._read(self.backend.path(name)), self._read(path))
+
+    def test_recompressed_dump(self):
+        path = self._generate_zip('monthly', self.now, os.urandom(1000))
+        replicate_database(self.database, self.backend)
+        old = self.backend.path(get_remote_name(self.database, 'monthly/' + os.path.basename(path)))
+        recompressed = path[:-len('.dump.zip')] + LZMA_SUFFIX
+        with zipfile.ZipFile(path) as source, zipfile.ZipFile(recompressed, 'w', zipfile.ZIP_LZMA) as archive:
+            for info in source.infolist():
+                archive.writestr(info.filename, source.read(info))
+        os.remove(path)
+
+        class FailingBackend(LocalBackend):
+            def write(backend, name, offset, data):
+                raise OSError("connection lost")
+
+        # The previous copy stays on the target until the recompressed dump is complete
+        with self.assertRaises(OSError):
+            replicate_database(self.database, FailingBackend(self.backend.root))
+        self.assertTrue(os.path.exists(old))
+        self.assertIsNone(get_replication_lag(self.database, self.now))
+
+        self.assertEqual(replicate_database(self.database, self.backend)[1], 0)
+        self.assertEqual(os.listdir(os.path.dirname(old)), [os.path.basename(recompressed)])
+        self.assertEqual(ReplicationManifest(self.database).dumps['monthly/' + os.path.basename(path)]['name'],
+                         'monthly/' + os.path.basename(recompressed))
+
+    def test_rotation_during_transfer(self):
+        path = self._generate_zip('monthly', self.now, b'')
+        database = self.database
+
+        class RotatingBackend(LocalBackend):
+            def write(backend, name, offset, data):
+                # The rotation can take the lock while a dump is sent...
+                with database.lock():
+                    pass
+                super().write(name, offset, data)
+
+            def commit(backend, name, size):
+                super().commit(name, size)
+                # ...and purge it before the transfer is recorded
+                os.remove(path)
+
+        self.assertEqual(replicate_database(self.database, RotatingBackend(self.backend.root))[1], 0)
+        self.assertEqual(ReplicationManifest(self.database).dumps, {})
+        self.assertEqual(ReplicationManifest(self.database).pending, {})
+        self.assertFalse(os.path.exists(self.backend.path(get_remote_name(self.database, 'monthly/' + os.path.basename(path)))))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import os
+import bz2
+import zlib
+import shutil
+import struct
+import zipfile
+import argparse
+import datetime
+import unittest
+import collections
+
+from conf import BACKUP_ROOT_TEST
+from catalog import Catalog
+from file_rotation import Database, get_filename_from_datetime, get_datetime_from_filename
+from dedup import ChunkStore, MANIFEST_SUFFIX
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+## signature, version, flags, compression, time, date, crc, sizes, name and extra lengths
+
+Member = collections.namedtuple('Member', ['name', 'header_offset', 'compress_size', 'file_size', 'crc', 'compress_type'])
+
+
+class RestoreError(Exception):
+    pass
+
+
+def read_index(path):
+    """Only the central directory at the end of the zip is read
+    Returns:
+        members (list(Member))
+    """
+    with zipfile.ZipFile(path) as archive:
+        return [
+            Member(info.filename, info.header_offset, info.compress_size, info.file_size, info.CRC, info.compress_type)
+            for info in archive.infolist()
+        ]
+
+def get_index(database, tier, dt):
+    """Member index of a dump, cached in the catalog of the database while the file does not change
+    Returns:
+        members (list(Member)) header_offset, compress_size and crc are None for deduplicated dumps
+    """
+    path = database.dump_path(tier, dt)
+    if path.endswith(MANIFEST_SUFFIX):
+        return [Member(member['name'], None, None, member['size'], None, member['compress_type'])
+                for member in ChunkStore.read_manifest(path)['members']]
+    stat = os.stat(path)
+    catalog = database.catalog
+    rows = catalog.get_members(stat)
+    if rows is not None:
+        return [Member(*row) for row in rows]
+    members = read_index(path)
+    catalog.set_members(stat, members)
+    return members
+
+def get_decompressor(compress_type):
+    if compress_type == zipfile.ZIP_STORED:
+        return None
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+def iter_zip_member(path, member):
+    """Seek to the member and decompress it while streaming, the CRC is checked at the end
+    Yields:
+        chunk (bytes)
+    """
+    if member.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2):
+        # LZMA members start with their own properties header, zipfile knows how to read them
+        with zipfile.ZipFile(path) as archive, archive.open(member.name) as file:
+            yield from iter(lambda: file.read(READ_CHUNK_SIZE), b'')
+        return
+    decompressor = get_decompressor(member.compress_type)
+    crc = 0
+    with open(path, 'rb') as file:
+        file.seek(member.header_offset)
+        signature, _, _, _, _, _, _, _, _, name_length, extra_length = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+        if signature != b'PK\x03\x04':
+            raise RestoreError("{} : bad local header for {}".format(path, member.name))
+        file.seek(name_length + extra_length, os.SEEK_CUR)
+        remaining = member.compress_size
+        while remaining:
+            data = file.read(min(READ_CHUNK_SIZE, remaining))
+            if not data:
+                raise RestoreError("{} : {} truncated".format(path, member.name))
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            yield data
+    if crc != member.crc:
+        raise RestoreError("{} : bad CRC for {}".format(path, member.name))
+
+def iter_member(database, tier, dt, member):
+    path = database.dump_path(tier, dt)
+    if path.endswith(MANIFEST_SUFFIX):
+        for stored in ChunkStore.read_manifest(path)['members']:
+            if stored['name'] == member.name:
+                return ChunkStore(database.backup_root).open_member(stored)
+        raise RestoreError("{} not in {}".format(member.name, path))
+    return iter_zip_member(path, member)
+
+def extract(database, tier, dt, names, output):
+    """
+    Args:
+        names (list(str)) members to extract, a name ending with / extracts a whole directory
+        output (str) directory, members keep their path inside it
+    Returns:
+        paths (list(str)) written
+    """
+    members = [member for member in get_index(database, tier, dt)
+               if any(member.name == name or (name.endswith('/') and member.name.startswith(name)) for name in names)]
+    if not members:
+        raise RestoreError("{} not found in {}/{}".format(", ".join(names), tier, get_filename_from_datetime(dt)))
+    paths = []
+    for member in members:
+        if member.name.endswith('/'):
+            continue
+        path = os.path.join(output, member.name)
+        if os.path.commonpath([os.path.abspath(path), os.path.abspath(output)]) != os.path.abspath(output):
+            raise RestoreError("{} is outside of the output directory".format(member.name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The CRC is only checked at the end of the member, a corrupted one must not leave a plausible file
+        try:
+            with open(path + '.part', 'wb') as file:
+                for chunk in iter_member(database, tier, dt, member):
+                    file.write(chunk)
+        except BaseException:
+            os.remove(path + '.part')
+            raise
+        os.replace(path + '.part', path)
+        paths.append(path)
+    return paths
+
+def find_member(database, name):
+    """Newest dump of any tier holding a member, e.g. an attachment of the filestore
+    Args:
+        name (str) member name or its end, such as the store_fname of the attachment (ab/abcdef...)
+    Returns:
+        tier (str or None)
+        dt (datetime.datetime or None)
+        member (Member or None)
+    """
+    dumps = [(dt, tier) for tier in Catalog.tiers for dt in database.list_datetimes(tier)]
+    for dt, tier in sorted(dumps, reverse=True):
+        try:
+            members = get_index(database, tier, dt)
+        except (OSError, zipfile.BadZipFile, ValueError):
+            continue
+        for member in members:
+            if member.name == name or member.name.endswith('/' + name):
+                return tier, dt, member
+    return None, None, None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, extract or find files in the dumps of a database without unzipping them")
+    parser.add_argument('server')
+    parser.add_argument('database')
+    parser.add_argument('--dump', help="tier/filename of the dump, the last daily dump by default")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help="members of the dump")
+    extract_parser = subparsers.add_parser('extract', help="extract members, e.g. dump.sql or filestore/ab/abcdef...")
+    extract_parser.add_argument('members', nargs='+')
+    extract_parser.add_argument('--output', default='.')
+    find_parser = subparsers.add_parser('find', help="newest dump of any tier holding an attachment")
+    find_parser.add_argument('name')
+    args = parser.parse_args()
+
+    database = Database(args.server, args.database, create=False)
+    if args.command == 'find':
+        tier, dt, member = find_member(database, args.name)
+        if member is None:
+            parser.exit(1, "{} not found in any dump\n".format(args.name))
+        print("{}/{}: {} ({} bytes)".format(tier, get_filename_from_datetime(dt), member.name, member.file_size))
+        parser.exit()
+    if args.dump:
+        tier, filename = args.dump.split('/')
+        dt = get_datetime_from_filename(filename)
+    else:
+        tier, dt = 'daily', database.last_daily_datetime
+        if dt is None:
+            parser.exit(1, "no daily dump\n")
+    if args.command == 'list':
+        for member in get_index(database, tier, dt):
+            print("{:>15} {}".format(member.file_size, member.name))
+    else:
+        for path in extract(database, tier, dt, args.members, args.output):
+            print(path)
+
+
+class RestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.database = Database('localhost', 'Database12', BACKUP_ROOT_TEST)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.output = os.path.join(BACKUP_ROOT_TEST, 'restored')
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _generate_zip(self, tier, dt, attachments):
+        with zipfile.ZipFile(self.database.dump_path(tier, dt), 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('dump.sql', 'INSERT INTO res_partner VALUES (1);\n' * 1000)
+            archive.writestr('manifest.json', '{}', compress_type=zipfile.ZIP_STORED)
+            for name, content in attachments.items():
+                archive.writestr('filestore/' + name, content)
+
+    def test_extract(self):
+        self._generate_zip('daily', self.now, {'ab/ab12': b'attachment' * 100})
+        index = get_index(self.database, 'daily', self.now)
+        self.assertEqual([member.name for member in index], ['dump.sql', 'manifest.json', 'filestore/ab/ab12'])
+        # Cached in the catalog
+        stat = os.stat(self.database.dump_path('daily', self.now))
+        self.assertEqual([Member(*row) for row in self.database.catalog.get_members(stat)], index)
+
+        paths = extract(self.database, 'daily', self.now, ['dump.sql', 'manifest.json', 'filestore/'], self.output)
+        self.assertEqual(len(paths), 3)
+        with open(os.path.join(self.output, 'filestore', 'ab', 'ab12'), 'rb') as file:
+            self.assertEqual(file.read(), b'attachment' * 100)
+        with open(os.path.join(self.output, 'dump.sql')) as file:
+            self.assertEqual(len(file.read().splitlines()), 1000)
+
+        with self.assertRaises(RestoreError):
+            extract(self.database, 'daily', self.now, ['missing'], self.output)
+
+    def test_extract_corrupted(self):
+        path = self.database.dump_path('daily', self.now)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('filestore/ab/ab12', b'attachment' * 100)
+        with open(path, 'r+b') as file:
+            data = file.read()
+            file.seek(data.index(b'attachment'))
+            file.write(b'ATTACHMENT')
+        with self.assertRaises(RestoreError):
+            extract(self.database, 'daily', self.now, ['filestore/'], self.output)
+        self.assertEqual(os.listdir(os.path.join(self.output, 'filestore', 'ab')), [])
+
+    def test_find_member(self):
+        self._generate_zip('monthly', self.now - datetime.timedelta(days=40), {'ab/ab12': b'old', 'cd/cd34': b'deleted'})
+        self._generate_zip('daily', self.now - datetime.timedelta(days=1), {'ab/ab12': b'old'})
+        self._generate_zip('daily', self.now, {'ab/ab12': b'new'})
+        tier, dt, member = find_member(self.database, 'ab/ab12')
+        self.assertEqual((tier, dt), ('daily', self.now))
+        tier, dt, member = find_member(self.database, 'cd/cd34')
+        self.assertEqual((tier, dt, member.file_size), ('monthly', self.now - datetime.timedelta(days=40), 7))
+        self.assertEqual(b''.join(iter_member(self.database, tier, dt, member)), b'deleted')
+        self.assertEqual(find_member(self.database, 'ef/ef56'), (None, None, None))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import fcntl
+import struct
+import shutil
+import datetime
+import statistics
+import unittest
+
+from conf import BACKUP_ROOT_TEST
+from catalog import Catalog, to_timestamp
+from measures import sizeof_fmt, linear_fit
+
+
+HEADER = struct.Struct('<4sIII')
+RECORD = struct.Struct('<qq')
+MAGIC = b'OSZH'
+
+SIZE_WINDOW = 30
+## Number of previous daily dumps the last one is compared to
+SIZE_ANOMALY_THRESHOLD = 5
+## A dump is anomalous when it is more than SIZE_ANOMALY_THRESHOLD robust deviations (MAD) from the median...
+SIZE_ANOMALY_MIN_CHANGE = 0.2
+## ...and differs from it by more than 20%
+
+
+class SizeHistory:
+    """Fixed-width ring file of the daily dump sizes of a database, in <server>/<database>/.sizes.bin
+
+    Header: magic, capacity, count, index of the next record. Records: timestamp and size, 16 bytes each.
+    """
+    filename = '.sizes.bin'
+    capacity = 400
+    path = None
+
+    def __init__(self, database_path, capacity=400):
+        self.path = os.path.join(database_path, self.filename)
+        self.capacity = capacity
+
+    def _read(self, file):
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return self.capacity, 0, 0, []
+        magic, capacity, count, head = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("{} is not a size history".format(self.path))
+        data = file.read(capacity * RECORD.size)
+        records = [RECORD.unpack_from(data, index * RECORD.size) for index in range(min(count, capacity))]
+        if count > capacity:
+            records = records[head:] + records[:head]
+        return capacity, count, head, records
+
+    def read(self):
+        """
+        Returns:
+            records (list((int, int))) timestamp and size, oldest first
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                return self._read(file)[3]
+        except FileNotFoundError:
+            return []
+
+    def append(self, records):
+        """Only records newer than the last one are written, so the history never needs a rescan
+        Args:
+            records (list((int, int))) timestamp and size, oldest first
+        Returns:
+            history (list((int, int))) oldest first
+        """
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            capacity, count, head, history = self._read(file)
+            last = history[-1][0] if history else None
+            new = [record for record in records if last is None or record[0] > last]
+            if not new:
+                return history
+            for record in new:
+                file.seek(HEADER.size + head * RECORD.size)
+                file.write(RECORD.pack(*record))
+                head = (head + 1) % capacity
+                count += 1
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, capacity, count, head))
+            return (history + new)[-capacity:]
+
+    def update(self, database):
+        """Record the daily dumps that finished uploading since the last update
+        Args:
+            database (file_rotation.Database)
+        Returns:
+            history (list((int, int))) oldest first
+        """
+        stable_ns = time.time_ns() - Catalog.STABLE_NS
+        return self.append([
+            (to_timestamp(dt), size) for dt, size, mtime_ns in database.entries('daily') if mtime_ns < stable_ns
+        ])
+
+
+def analyze(history, window=SIZE_WINDOW, threshold=SIZE_ANOMALY_THRESHOLD, min_change=SIZE_ANOMALY_MIN_CHANGE):
+    """Compare the last dump to the rolling median/MAD of the previous ones and fit the growth trend
+    Args:
+        history (list((int, int))) timestamp and size, oldest first
+    Returns:
+        anomaly (bool)
+        summary (str)
+    """
+    if len(history) < 7:
+        return False, "Historique insuffisant"
+    timestamp, size = history[-1]
+    baseline = history[-window - 1:-1]
+    sizes = [record[1] for record in baseline]
+    median = statistics.median(sizes)
+    mad = statistics.median([abs(record - median) for record in sizes])
+    # Identical sizes give a MAD of 0, 1% of the median is the smallest deviation considered
+    scale = max(1.4826 * mad, 0.01 * median, 1)
+    change = (size - median) / median if median else 0
+    if abs(size - median) / scale > threshold and abs(change) > min_change:
+        return True, "Taille anormale : {:+.0%} ({} au lieu de {})".format(change, sizeof_fmt(size), sizeof_fmt(median))
+    # Least squares slope in bytes per day over the window, last dump included
+    slope = linear_fit([(record[0] / 86400, record[1]) for record in baseline + [history[-1]]])
+    trend = slope * 30 / median if median else 0
+    return False, "{}, {:+.0%}/mois".format(sizeof_fmt(size), trend)
+
+
+class SizeHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(BACKUP_ROOT_TEST, 'localhost', 'Database11')
+        os.makedirs(self.path, exist_ok=True)
+        self.start = to_timestamp(datetime.datetime(2020, 1, 1, 3))
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_ring(self):
+        history = SizeHistory(self.path, capacity=5)
+        self.assertEqual(history.read(), [])
+        history.append([(self.start + day * 86400, day) for day in range(3)])
+        # Already recorded dumps are ignored
+        history.append([(self.start + day * 86400, day) for day in range(4)])
+        self.assertEqual([size for timestamp, size in history.read()], [0, 1, 2, 3])
+        self.assertEqual(os.path.getsize(history.path), HEADER.size + 4 * RECORD.size)
+        records = history.append([(self.start + day * 86400, day) for day in range(8)])
+        self.assertEqual([size for timestamp, size in records], [3, 4, 5, 6, 7])
+        self.assertEqual(history.read(), records)
+        self.assertEqual(os.path.getsize(history.path), HEADER.size + 5 * RECORD.size)
+
+    def test_analyze(self):
+        history = [(self.start + day * 86400, 100 * 1024 * 1024 + (day % 3) * 1024) for day in range(40)]
+        self.assertEqual(analyze(history[:3]), (False, "Historique insuffisant"))
+        self.assertEqual(analyze(history), (False, "100.0 MiB, +0%/mois"))
+
+        growing = [(timestamp, 100 * 1024 * 1024 + day * 1024 * 1024) for day, (timestamp, size) in enumerate(history)]
+        anomaly, summary = analyze(growing)
+        self.assertFalse(anomaly)
+        self.assertEqual(summary, "139.0 MiB, +24%/mois")
+
+        shrunk = history + [(self.start + 40 * 86400, 20 * 1024 * 1024)]
+        self.assertEqual(analyze(shrunk), (True, "Taille anormale : -80% (20.0 MiB au lieu de 100.0 MiB)"))
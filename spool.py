@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import gzip
+import json
+import zlib
+import hmac
+import shutil
+import hashlib
+import socket
+import tempfile
+import unittest
+import threading
+import socketserver
+
+from conf import BACKUP_ROOT_TEST, REPORT_SECRET
+
+
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+## Compressed bytes accepted from one server
+MAX_DECODED_SIZE = 64 * 1024 * 1024
+## Bytes of JSON once decompressed, so a small gzip bomb cannot exhaust the memory of the collector
+PUSH_TIMEOUT = 30
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def encode_payload(payload):
+    """
+    Args:
+        payload (dict) JSON serializable, values which are not (dates, apt versions) are written as str
+    Returns:
+        data (bytes) gzip compressed JSON
+    """
+    return gzip.compress(json.dumps(payload, default=str).encode())
+
+def decode_payload(data):
+    """
+    Raises:
+        ValueError if data is not a complete gzip JSON or is over MAX_DECODED_SIZE once decompressed
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        decoded = decompressor.decompress(data, MAX_DECODED_SIZE + 1)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if len(decoded) > MAX_DECODED_SIZE:
+        raise ValueError("payload over {} bytes once decompressed".format(MAX_DECODED_SIZE))
+    if not decompressor.eof:
+        raise ValueError("truncated payload")
+    return json.loads(decoded)
+
+def get_spool_filename(server):
+    return re.sub(r'[^\w.-]', '_', server) + '.json.gz'
+
+def write_payload(spool_path, data):
+    """Atomic, the collector never reads a partial report. Only the last report of each server is kept.
+    Args:
+        data (bytes) encoded payload, with a 'server' key
+    Returns:
+        path (str)
+    """
+    payload = decode_payload(data)
+    os.makedirs(spool_path, exist_ok=True)
+    path = os.path.join(spool_path, get_spool_filename(payload['server']))
+    with tempfile.NamedTemporaryFile('wb', dir=spool_path, prefix='.', suffix='.tmp', delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
+    return path
+
+def read_payloads(spool_path):
+    """
+    Returns:
+        payloads (list(dict)) sorted by server, unreadable files are skipped
+    """
+    payloads = []
+    try:
+        filenames = sorted(os.listdir(spool_path))
+    except FileNotFoundError:
+        return payloads
+    for filename in filenames:
+        if not filename.endswith('.json.gz') or filename.startswith('.'):
+            continue
+        try:
+            with open(os.path.join(spool_path, filename), 'rb') as file:
+                payloads.append(decode_payload(file.read()))
+        except (OSError, ValueError, EOFError) as e:
+            print("[spool] {} skipped: {}".format(filename, e))
+    return sorted(payloads, key=lambda payload: payload['server'])
+
+def sign(data, secret):
+    """
+    Returns:
+        signature (bytes) HMAC-SHA256 of the encoded payload, SIGNATURE_SIZE bytes
+    """
+    return hmac.new(secret.encode(), data, hashlib.sha256).digest()
+
+def verify_signature(signed, secret):
+    """
+    Args:
+        signed (bytes) signature followed by the encoded payload, or only the payload if secret is None
+    Returns:
+        data (bytes) encoded payload
+    Raises:
+        ValueError if the signature does not match
+    """
+    if secret is None:
+        return signed
+    signature, data = signed[:SIGNATURE_SIZE], signed[SIGNATURE_SIZE:]
+    if not hmac.compare_digest(signature, sign(data, secret)):
+        raise ValueError("bad signature, REPORT_SECRET differs from the collector")
+    return data
+
+def push(destination, payload, secret=REPORT_SECRET):
+    """
+    Args:
+        destination (str) spool directory (local or mounted from the storage server) or host:port of collector.py --listen
+        payload (dict)
+        secret (str or None) shared with the collector, signs the reports sent over the network
+    """
+    data = encode_payload(payload)
+    if os.path.isabs(destination):
+        write_payload(destination, data)
+        return
+    host, port = destination.rsplit(':', 1)
+    with socket.create_connection((host, int(port)), timeout=PUSH_TIMEOUT) as connection:
+        if secret is not None:
+            connection.sendall(sign(data, secret))
+        connection.sendall(data)
+        connection.shutdown(socket.SHUT_WR)
+        reply = connection.recv(64)
+    if reply != b'OK':
+        raise OSError("collector {} refused the report: {!r}".format(destination, reply))
+
+
+class SpoolHandler(socketserver.StreamRequestHandler):
+    """One report per connection, the client closes its side once the payload is sent"""
+    timeout = PUSH_TIMEOUT
+
+    def handle(self):
+        data = self.rfile.read(SIGNATURE_SIZE + MAX_PAYLOAD_SIZE + 1)
+        try:
+            data = verify_signature(data, self.server.secret)
+            if len(data) > MAX_PAYLOAD_SIZE:
+                raise ValueError("payload over {} bytes".format(MAX_PAYLOAD_SIZE))
+            write_payload(self.server.spool_path, data)
+        except (ValueError, KeyError, EOFError, OSError) as e:
+            print("[spool] report from {} rejected: {}".format(self.client_address[0], e))
+            self.wfile.write(b'ERROR')
+            return
+        self.wfile.write(b'OK')
+
+
+class SpoolServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    spool_path = None
+    secret = None
+
+    def __init__(self, address, spool_path, secret=REPORT_SECRET):
+        """
+        Args:
+            secret (str or None) reports not signed with it are rejected, None accepts any report
+        """
+        super().__init__(address, SpoolHandler)
+        self.spool_path = spool_path
+        self.secret = secret
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.spool_path = os.path.join(BACKUP_ROOT_TEST, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def test_directory(self):
+        push(self.spool_path, dict(server='odoo/1', results=[]))
+        push(self.spool_path, dict(server='odoo/1', results=[1]))
+        self.assertEqual(os.listdir(self.spool_path), ['odoo_1.json.gz'])
+        self.assertEqual(read_payloads(self.spool_path), [dict(server='odoo/1', results=[1])])
+
+    def test_socket(self):
+        server = SpoolServer(('127.0.0.1', 0), self.spool_path, secret=None)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            push("127.0.0.1:{}".format(server.server_address[1]), dict(server='odoo2', results=[]), secret=None)
+            with socket.create_connection(server.server_address) as connection:
+                connection.sendall(b'not gzip')
+                connection.shutdown(socket.SHUT_WR)
+                self.assertEqual(connection.recv(64), b'ERROR')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(read_payloads(self.spool_path), [dict(server='odoo2', results=[])])
+
+    def test_signature(self):
+        server = SpoolServer(('127.0.0.1', 0), self.spool_path, secret='secret')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        destination = "127.0.0.1:{}".format(server.server_address[1])
+        try:
+            push(destination, dict(server='odoo2', results=[]), secret='secret')
+            # Another server can't overwrite the report of odoo2 without the secret
+            with self.assertRaises(OSError):
+                push(destination, dict(server='odoo2', results=[1]), secret='wrong')
+            with self.assertRaises(OSError):
+                push(destination, dict(server='odoo2', results=[1]), secret=None)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(read_payloads(self.spool_path), [dict(server='odoo2', results=[])])
+
+    def test_decompression_bomb(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = b''.join(compressor.compress(b' ' * 1024 * 1024) for _ in range(MAX_DECODED_SIZE // (1024 * 1024) + 1))
+        data += compressor.flush()
+        self.assertLess(len(data), MAX_PAYLOAD_SIZE)
+        with self.assertRaises(ValueError):
+            decode_payload(data)
+        with self.assertRaises(ValueError):
+            write_payload(self.spool_path, data)
+        self.assertFalse(os.path.exists(self.spool_path))
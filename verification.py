@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import zipfile
+import zlib
+import lzma
+import datetime
+import unittest
+import threading
+
+from conf import BACKUP_ROOT_TEST, VERIFY_MAX_BYTES_PER_SECOND
+from file_rotation import Database, iter_databases, get_filename_from_datetime
+from dedup import ChunkStore, MANIFEST_SUFFIX
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class Throttle:
+    """Limits the read throughput of a whole verification run, shared between threads"""
+    rate = None
+
+    def __init__(self, rate=VERIFY_MAX_BYTES_PER_SECOND):
+        """
+        Args:
+            rate (int) bytes per second, None or 0 for no limit
+        """
+        self.rate = rate
+        self.start = time.monotonic()
+        self.consumed = 0
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            self.consumed += size
+            delay = self.consumed / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def verify_zip(path, throttle=None):
+    """Read every member of the zip in bounded memory, zipfile checks the CRC of each member at its end
+    Args:
+        path (str)
+        throttle (Throttle)
+    Returns:
+        error (str or None) None if the zip is valid
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+            if not infos:
+                return "archive vide"
+            for info in infos:
+                with archive.open(info) as member:
+                    while True:
+                        chunk = member.read(READ_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if throttle:
+                            throttle.consume(len(chunk))
+    # bz2 reports a corrupted stream as OSError
+    except (zipfile.BadZipFile, zlib.error, lzma.LZMAError, OSError, EOFError, NotImplementedError) as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def verify_database(database, throttle=None):
+    """Verify the dumps of every tier, only files never seen with the same (inode, size, mtime) are read
+    Args:
+        database (Database)
+        throttle (Throttle)
+    Returns:
+        errors (dict((str, datetime.datetime) -> str)) corrupted dumps by (tier, datetime)
+    """
+    catalog = database.catalog
+    errors = dict()
+    inodes = set()
+    for tier in catalog.tiers:
+        for dt in database.list_datetimes(tier):
+            try:
+                stat = os.stat(database.dump_path(tier, dt))
+            except FileNotFoundError:
+                continue
+            inodes.add(stat.st_ino)
+            verified, error = catalog.get_verification(stat)
+            if not verified:
+                path = database.dump_path(tier, dt)
+                if path.endswith(MANIFEST_SUFFIX):
+                    error = ChunkStore(database.backup_root).verify(path, throttle)
+                else:
+                    error = verify_zip(path, throttle)
+                catalog.set_verification(stat, error)
+            if error:
+                errors[(tier, dt)] = error
+    catalog.prune_verifications(inodes)
+    return errors
+
+
+if __name__ == "__main__":
+    throttle = Throttle()
+    for server, name in iter_databases():
+        database = Database(server, name)
+        for (tier, dt), error in sorted(verify_database(database, throttle).items()):
+            print("{}/{}/{}/{}: {}".format(server, name, tier, get_filename_from_datetime(dt), error))
+
+
+class VerificationTest(unittest.TestCase):
+    def setUp(self):
+        self.database = Database('localhost', 'Database5', BACKUP_ROOT_TEST)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        shutil.rmtree(BACKUP_ROOT_TEST, ignore_errors=True)
+
+    def _generate_zip(self, dt, compression=zipfile.ZIP_DEFLATED):
+        path = self.database.dump_path('daily', dt)
+        with zipfile.ZipFile(path, 'w', compression) as archive:
+            archive.writestr('dump.sql', 'INSERT INTO res_partner VALUES (1);\n' * 1000)
+        return path
+
+    def test_verify_zip(self):
+        path = self._generate_zip(self.now)
+        self.assertIsNone(verify_zip(path))
+
+        # Truncated upload: no central directory
+        with open(path, 'rb') as file:
+            data = file.read()
+        with open(path, 'wb') as file:
+            file.write(data[:len(data) // 2])
+        self.assertEqual(verify_zip(path), "File is not a zip file")
+
+        # Same size but corrupted member
+        path = self._generate_zip(self.now)
+        offset = data.index(b'dump.sql') + len(b'dump.sql') + 20
+        with open(path, 'r+b') as file:
+            file.seek(offset)
+            file.write(b'\0' * 4)
+        self.assertIsNotNone(verify_zip(path))
+
+    def test_verify_zip_corrupted_stream(self):
+        # Recompressed dumps use LZMA members, their decompressors raise their own exceptions
+        for compression in (zipfile.ZIP_LZMA, zipfile.ZIP_BZIP2):
+            path = self._generate_zip(self.now, compression)
+            with zipfile.ZipFile(path) as archive:
+                info = archive.getinfo('dump.sql')
+            with open(path, 'r+b') as file:
+                file.seek(info.header_offset + 30 + len('dump.sql') + info.compress_size // 2)
+                file.write(b'\xff' * 16)
+            self.assertIsNotNone(verify_zip(path))
+
+    def test_verify_database(self):
+        self._generate_zip(self.now)
+        open(self.database.dump_path('daily', self.now - datetime.timedelta(days=1)), 'wb').close()
+        errors = verify_database(self.database)
+        self.assertEqual(list(errors), [('daily', self.now - datetime.timedelta(days=1))])
+
+        # Results are cached by (inode, size, mtime)
+        stat = os.stat(self.database.dump_path('daily', self.now))
+        self.database.catalog.set_verification(stat, "cached")
+        self.assertEqual(verify_database(self.database)[('daily', self.now)], "cached")